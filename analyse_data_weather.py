@@ -1,81 +1,109 @@
-import pandas as pd
+import argparse
 import os
 
+import pandas as pd
+
+from weather_rollups import update_rollups, LEVELS, SEASONS
+
 INPUT_FILE = 'weather_data.csv'
 
-def analyze_weather_data():
+# Namen van de rollup-niveaus voor de uitvoer
+LEVEL_NAMES = {'year': 'jaar', 'month': 'maand', 'week': 'week', 'day': 'dag'}
+
+
+def format_day(day):
+    """Datum als DD-MM-JJJJ, of 'onbekend' als er geen dag is (NaT: geen metingen)."""
+    return "onbekend" if pd.isna(day) else f"{day:%d-%m-%Y}"
+
+
+def print_summary(row):
+    """Print de samenvatting van één station (een rij van de rollups)."""
+    # --- Temperatuur Analyse ---
+    print("\n🌡️ Temperatuur Analyse (in Graden Celsius)")
+    print(f"  Gemiddelde temperatuur: {row['temp_avg_c_mean']:.2f}°C")
+    print(f"  Warmste dag: {row['temp_max_c_max']}°C (op {format_day(row['temp_max_c_max_day'])})")
+    print(f"  Koudste dag: {row['temp_min_c_min']}°C (op {format_day(row['temp_min_c_min_day'])})")
+
+    # --- Neerslag Analyse ---
+    print("\n🌧️ Neerslag Analyse (in Millimeters)")
+    print(f"  Totale neerslag: {row['precip_amount_mm_sum']:.1f} mm")
+    print(f"  Natste dag: {row['precip_amount_mm_max']} mm (op {format_day(row['precip_amount_mm_max_day'])})")
+    print(f"  Aantal dagen zonder meetbare neerslag: {row['dry_days']} dagen")
+
+
+def analyze_weather_data(first_date=None, last_date=None, season=None, year=None, stations=None, per='year'):
     """
-    Laadt de schone CSV met weerdata en print een samenvatting.
+    Print een samenvatting van de weerdata: over alles, over een datumbereik
+    (first_date t/m last_date) of over een seizoen (van één jaar of alle jaren).
+    De cijfers komen uit de voorberekende rollups ('weather_rollups.py'), die
+    alleen worden bijgewerkt als de CSV veranderd is. Met 'per' komt er ook
+    een tabel per jaar, maand, week of dag bij. Geeft de samenvatting terug.
     """
-    
+
     # --- 1. Controleer of het bestand bestaat ---
     if not os.path.exists(INPUT_FILE):
         print(f"FOUT: Bestand '{INPUT_FILE}' niet gevonden.")
         print("Heb je het 'parse_weather.py' script al succesvol gedraaid?")
         return
 
-    print(f"--- Analyse van {INPUT_FILE} ---")
-
-    # --- 2. Laad de data ---
+    # --- 2. Laad de rollups (bijwerken als er nieuwe dagen zijn) ---
     try:
-        # We geven aan dat de 'date'-kolom als datum ingelezen moet worden
-        df = pd.read_csv(INPUT_FILE, parse_dates=['date'])
+        rollups = update_rollups(INPUT_FILE)
     except Exception as e:
-        print(f"FOUT: Kon het bestand '{INPUT_FILE}' niet inlezen. Error: {e}")
+        print(f"FOUT: Kon de rollups van '{INPUT_FILE}' niet laden. Error: {e}")
         return
 
-    # --- 3. Basis-informatie ---
-    print(f"\nData succesvol geladen.")
-    print(f"Totaal aantal dagen met data: {len(df)}")
-    
-    # Datumbereik
-    min_date = df['date'].min().strftime('%d-%m-%Y')
-    max_date = df['date'].max().strftime('%d-%m-%Y')
-    print(f"Datumbereik: van {min_date} tot {max_date}")
-    
-    # --- 4. Temperatuur Analyse ---
-    print("\n🌡️ Temperatuur Analyse (in Graden Celsius)")
-    
-    # Gemiddelde
-    avg_temp = df['temp_avg_c'].mean()
-    print(f"  Gemiddelde temperatuur (hele periode): {avg_temp:.2f}°C")
-    
-    # Warmste dag (hoogste maximum)
-    max_temp_val = df['temp_max_c'].max()
-    max_temp_date = df.loc[df['temp_max_c'].idxmax()]['date'].strftime('%d-%m-%Y')
-    print(f"  Warmste dag ooit gemeten: {max_temp_val}°C (op {max_temp_date})")
-
-    # Koudste dag (laagste minimum)
-    min_temp_val = df['temp_min_c'].min()
-    min_temp_date = df.loc[df['temp_min_c'].idxmin()]['date'].strftime('%d-%m-%Y')
-    print(f"  Koudste dag ooit gemeten: {min_temp_val}°C (op {min_temp_date})")
-
-    # --- 5. Neerslag Analyse ---
-    print("\n🌧️ Neerslag Analyse (in Millimeters)")
-    
-    # Totaal
-    total_precip = df['precip_amount_mm'].sum()
-    print(f"  Totale neerslag (hele periode): {total_precip:.1f} mm")
-    
-    # Natste dag
-    wettest_day_val = df['precip_amount_mm'].max()
-    wettest_day_date = df.loc[df['precip_amount_mm'].idxmax()]['date'].strftime('%d-%m-%Y')
-    print(f"  Natste dag ooit gemeten: {wettest_day_val} mm (op {wettest_day_date})")
-    
-    # Aantal dagen zonder neerslag
-    dry_days = len(df[df['precip_amount_mm'] == 0])
-    print(f"  Aantal dagen zonder meetbare neerslag: {dry_days} dagen")
-
-    # --- 6. Statistische Samenvatting ---
-    print("\n--- Statistische Samenvatting ---")
-    # .describe() geeft een mooi overzicht van alle numerieke kolommen
-    # .round(2) rondt de getallen af op 2 decimalen
-    print(df.describe().round(2))
-    
-    print("\n--- Eerste 5 rijen van de data ---")
-    print(df.head())
+    unknown = [stn for stn in stations or [] if stn not in rollups.stations]
+    if unknown:
+        print(f"FOUT: Onbekende station(s) {unknown}. Beschikbaar: {rollups.stations}")
+        return
+
+    # --- 3. Samenvatting van de gevraagde periode ---
+    if year and not season and not (first_date or last_date):
+        # Alleen een jaar: het hele kalenderjaar
+        first_date, last_date = f"{year}-01-01", f"{year}-12-31"
+    try:
+        if season:
+            period = f"{season} {year}" if year else f"alle {season}s"
+            df_summary = rollups.season(season, year, stations)
+        else:
+            period = f"{first_date or 'begin'} t/m {last_date or 'eind'}"
+            df_summary = rollups.summary(first_date, last_date, stations)
+    except ValueError as e:
+        print(f"FOUT: Ongeldige datum. Gebruik JJJJ-MM-DD. Error: {e}")
+        return
+
+    print(f"--- Analyse van {INPUT_FILE}: {period} ---")
+    if df_summary.empty or not df_summary['n_days'].any():
+        print("Geen weerdata in deze periode.")
+        return df_summary
+
+    for _, row in df_summary.iterrows():
+        print(f"\n=== Station {row['STN']}: {row['n_days']} dagen met data ===")
+        print_summary(row)
+
+    # --- 4. Overzicht per periode ---
+    if per and not season:
+        print(f"\n--- Overzicht per {LEVEL_NAMES[per]} ---")
+        df_periods = rollups.periods(per, first_date, last_date, stations)
+        columns = ['STN', 'start', 'n_days', 'temp_avg_c_mean', 'temp_max_c_max', 'temp_min_c_min',
+                   'precip_amount_mm_sum', 'dry_days']
+        df_table = df_periods[[c for c in columns if c in df_periods.columns]].copy()
+        df_table['start'] = df_table['start'].dt.strftime('%d-%m-%Y')
+        print(df_table.round(2).to_string(index=False))
+
+    return df_summary
 
 
 # --- Voer de functie uit als het script direct wordt gerund ---
 if __name__ == "__main__":
-    analyze_weather_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Samenvatting van de weerdata uit de voorberekende rollups.")
+    parser.add_argument('--from', dest='first_date', help="eerste dag (JJJJ-MM-DD)")
+    parser.add_argument('--to', dest='last_date', help="laatste dag, inclusief (JJJJ-MM-DD)")
+    parser.add_argument('--season', choices=list(SEASONS), help="alleen dit seizoen (winter = dec t/m feb)")
+    parser.add_argument('--year', type=int, help="jaar van het seizoen (zonder --season: het hele kalenderjaar)")
+    parser.add_argument('--station', type=int, action='append', help="alleen dit station (herhaalbaar)")
+    parser.add_argument('--per', choices=LEVELS, default='year', help="tabel per jaar/maand/week/dag")
+    args = parser.parse_args()
+
+    analyze_weather_data(args.first_date, args.last_date, args.season, args.year, args.station, args.per)
@@ -1,72 +1,298 @@
-import json
+import argparse
 import pandas as pd
-from transformers import pipeline
+import numpy as np
 import os
+import time
 
-INPUT_FILE = 'cleaned_reviews.json'
-OUTPUT_FILE = 'reviews_met_sentiment.json'
+from pipeline_state import load_state, save_state, stale_review_ids, mark_processed
+from sentiment_cache import SentimentCache
+from stage_metrics import record_metrics
+from stage_files import read_table, write_table, table_columns, compact_frame, TEXT_COLUMNS
+from near_duplicates import representative_comments
+from comment_text import model_texts
+from sentiment_inference import (
+    score_comments, model_id, BACKENDS, DEFAULT_BACKEND, DEFAULT_BATCH_SIZE, DEFAULT_WORKERS
+)
 
-# 1. Load the clean data into a pandas DataFrame
-print("Step 1: Loading data...")
-if not os.path.exists(INPUT_FILE):
-    print(f"ERROR: '{INPUT_FILE}' not found. Have you run the clean script?")
-    exit()
+INPUT_FILE = 'cleaned_reviews.parquet'
+OUTPUT_FILE = 'reviews_met_sentiment.parquet'
 
-try:
-    with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+# Model used for scoring; the revision is part of the sentiment cache key.
+# It is pinned to a commit hash in MODEL_REVISION_FILE (kept with the code,
+# written by '--pin-model'), so the model cannot change under the cache;
+# UNPINNED_REVISION is only used until it has been pinned.
+MODEL_NAME = "DTAI-KULeuven/robbert-v2-dutch-sentiment"
+MODEL_REVISION_FILE = 'sentiment_model_revision.txt'
+UNPINNED_REVISION = "main"
 
-    df = pd.DataFrame.from_records(data['reviews'])
-    print(f"{len(df)} reviews loaded.")
 
-except Exception as e:
-    print(f"ERROR: Could not load data. {e}")
-    exit()
+def pinned_revision(file_path=MODEL_REVISION_FILE):
+    """The commit hash in 'file_path', or UNPINNED_REVISION if the model has not been pinned."""
+    if not os.path.exists(file_path):
+        return UNPINNED_REVISION
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read().strip() or UNPINNED_REVISION
 
 
-# 2. Filter for reviews that have a comment
-df_comments = df.dropna(subset=['comment']).copy()
-print(f"{len(df_comments)} reviews with comments found for analysis.")
+MODEL_REVISION = pinned_revision()
 
-# 3. Load the Dutch Sentiment Model
-print("Step 2: Loading sentiment model (this may take a while)...")
-model_name = "DTAI-KULeuven/robbert-v2-dutch-sentiment"
-sentiment_pipeline = pipeline(
-    "sentiment-analysis", 
-    model=model_name, 
-    tokenizer=model_name
-)
 
-# 4. Perform sentiment analysis
-print("Step 3: Analyzing sentiment...")
-comments_list = df_comments['comment'].tolist()
+def cached_revision():
+    """
+    The commit UNPINNED_REVISION of MODEL_NAME pointed at when the model was
+    downloaded into the local Hugging Face cache, or None if it is not cached.
+    """
+    hub_cache = os.environ.get('HF_HUB_CACHE') or os.path.join(
+        os.environ.get('HF_HOME', os.path.join(os.path.expanduser('~'), '.cache', 'huggingface')), 'hub'
+    )
+    ref_file = os.path.join(hub_cache, 'models--' + MODEL_NAME.replace('/', '--'), 'refs', UNPINNED_REVISION)
+    if not os.path.exists(ref_file):
+        return None
+    with open(ref_file, 'r', encoding='utf-8') as f:
+        return f.read().strip() or None
+
+
+def pin_model_revision():
+    """
+    Writes the commit hash of MODEL_NAME to MODEL_REVISION_FILE: the commit
+    already in the local cache (the one earlier scores came from), otherwise
+    the commit UNPINNED_REVISION points at now. Returns the hash, or None.
+    """
+    commit = cached_revision()
+    if commit is None:
+        try:
+            from huggingface_hub import HfApi
+            commit = HfApi().model_info(MODEL_NAME, revision=UNPINNED_REVISION).sha
+        except Exception as e:
+            print(f"ERROR: Could not look up the current commit of '{MODEL_NAME}': {e}")
+            return None
+    with open(MODEL_REVISION_FILE, 'w', encoding='utf-8') as f:
+        f.write(commit + '\n')
+    print(f"'{MODEL_NAME}' pinned to commit {commit} in '{MODEL_REVISION_FILE}'.")
+    return commit
+
+
+def load_clean_reviews(columns=None, low_memory=False):
+    """
+    Loads the clean data into a pandas DataFrame, or returns None on failure.
+    With 'columns' only those of them that the file has are read; low_memory
+    gives the compact column types (see 'stage_files.py').
+    """
+    if not os.path.exists(INPUT_FILE):
+        print(f"ERROR: '{INPUT_FILE}' not found. Have you run the clean script?")
+        return None
+
+    try:
+        if columns is not None:
+            columns = [c for c in table_columns(INPUT_FILE) if c in columns]
+        df = read_table(INPUT_FILE, columns=columns, low_memory=low_memory)
+        print(f"{len(df)} reviews loaded.")
+        return df
+
+    except Exception as e:
+        print(f"ERROR: Could not load data. {e}")
+        return None
+
+
+def analyse_sentiment(df=None, incremental=False, batch_size=DEFAULT_BATCH_SIZE,
+                      workers=DEFAULT_WORKERS, threads_per_worker=None, backend=DEFAULT_BACKEND,
+                      write=True, low_memory=False):
+    """
+    Adds 'sentiment_label' and 'sentiment_score' to every review with a comment.
+
+    df: the clean reviews; loaded from the clean file when not given.
+    write: save the result to OUTPUT_FILE (always done in incremental mode,
+    the next incremental run reuses it).
+    Returns the enriched DataFrame, or None if something went wrong.
+
+    incremental: only score new or updated reviews and reuse the earlier results for the rest.
+    batch_size / workers / threads_per_worker: settings of the batched inference engine.
+    backend: 'torch' (full precision) or 'onnx' (int8-quantized ONNX Runtime).
+    low_memory: keep the reviews in compact column types (see 'stage_files.py').
+    """
+
+    # 1. Load the clean data into a pandas DataFrame
+    if df is None:
+        print("Step 1: Loading data...")
+        df = load_clean_reviews(low_memory=low_memory)
+        if df is None:
+            return
+    else:
+        print(f"Step 1: {len(df)} reviews received.")
+        if low_memory:
+            df = compact_frame(df)
+
+    if MODEL_REVISION == UNPINNED_REVISION:
+        print(f"WARNING: '{MODEL_NAME}' is not pinned to a commit, cached scores may come from "
+              f"another version. Run 'python analyse_sentiment.py --pin-model' once and commit "
+              f"'{MODEL_REVISION_FILE}'.")
+
+    # 2. Filter for reviews that have a comment (only the columns the model needs)
+    text_cols = ['reviewId'] + [c for c in TEXT_COLUMNS if c in df.columns]
+    df_comments = df.loc[df['comment'].notna(), text_cols].copy()
+    print(f"{len(df_comments)} reviews with comments found for analysis.")
+
+    # 2.5 Incremental mode: reuse the scores of reviews that did not change
+    df_reused = df_comments.iloc[0:0]
+    if incremental:
+        state = load_state()
+        stale_ids = stale_review_ids(state, 'sentiment', df['reviewId'])
+
+        if os.path.exists(OUTPUT_FILE):
+            df_previous = read_table(OUTPUT_FILE, columns=['reviewId', 'sentiment_label', 'sentiment_score'])
+            df_previous = df_previous.dropna(subset=['sentiment_label']).set_index('reviewId')
+
+            reusable = ~df_comments['reviewId'].isin(stale_ids) & df_comments['reviewId'].isin(df_previous.index)
+            df_reused = df_comments[reusable].copy()
+            previous_rows = df_previous.loc[df_reused['reviewId']]
+            df_reused['sentiment_label'] = previous_rows['sentiment_label'].to_numpy()
+            df_reused['sentiment_score'] = previous_rows['sentiment_score'].to_numpy()
+            df_comments = df_comments[~reusable].copy()
+
+        print(f"Incremental mode: {len(df_reused)} scores reused, {len(df_comments)} comments to analyze.")
+
+    if len(df_comments) > 0:
+        # 3. Look up earlier results in the sentiment cache; near-duplicate comments
+        #    (one 'comment_group') are scored once, with the text of the group's first
+        #    review (the original without Google's translation, see 'comment_text.py')
+        comments_list = representative_comments(df_comments, df).tolist()
+        distinct_count = len(set(comments_list))
+        record_metrics(inference_saved=model_texts(df_comments).nunique() - distinct_count)
+        print(f"{distinct_count} distinct texts to score after grouping near-duplicate comments.")
+        cache = SentimentCache(model_id(MODEL_NAME, MODEL_REVISION, backend))
+        results = cache.get_many(comments_list)
+        cache.report()
+        record_metrics(cache_hits=cache.hits, cache_misses=cache.misses)
+
+        # Every distinct comment that is not cached is sent to the model once
+        missing_comments = list(dict.fromkeys(c for c in comments_list if c not in results))
+
+        if missing_comments:
+            # 4. Load the Dutch Sentiment Model and perform sentiment analysis
+            print(f"Step 2: Loading sentiment model and analyzing {len(missing_comments)} uncached comments...")
+            new_sentiments = score_comments(
+                missing_comments, MODEL_NAME, MODEL_REVISION,
+                batch_size=batch_size, workers=workers, threads_per_worker=threads_per_worker,
+                backend=backend
+            )
+            new_results = dict(zip(missing_comments, new_sentiments))
+            cache.put_many(new_results)
+            results.update(new_results)
+        else:
+            print("Step 2: All comments found in the sentiment cache, model not loaded.")
+        cache.close()
+
+        sentiments = [results[c] for c in comments_list]
+
+        df_comments['sentiment_label'] = [s['label'] for s in sentiments]
+        df_comments['sentiment_score'] = [s['score'] for s in sentiments]
+
+        # 4.5 Validation Step
+        print("\n--- Sentiment Validation Sample (5 random) ---")
+        try:
+            validation_sample = df_comments.sample(n=5, random_state=42)
+            for index, row in validation_sample.iterrows():
+                print(f"Review: {str(row['comment'])[:100]}...")
+                print(f" -> Label: {row['sentiment_label']} (Score: {row['sentiment_score']:.4f})")
+        except ValueError:
+            print("Not enough data for validation sample.")
+
+        print("Analysis completed.")
+    else:
+        df_comments = df_comments.assign(sentiment_label=pd.Series(dtype=object), sentiment_score=pd.Series(dtype=float))
+        print("No new comments to analyze, sentiment model not loaded.")
+
+    # 5. Merge sentiment data with original data
+    df_comments = pd.concat([df_reused, df_comments])
+    df = df.join(df_comments[['sentiment_label', 'sentiment_score']])
+    if low_memory:
+        df = compact_frame(df)
+
+    # 6. Save the enriched file
+    if write or incremental:
+        print(f"Step 3: Saving results to '{OUTPUT_FILE}'...")
+        write_table(df, OUTPUT_FILE)
+
+        print(f"Done! '{OUTPUT_FILE}' has been successfully created.")
+
+    if incremental:
+        mark_processed(state, 'sentiment', df['reviewId'])
+        save_state(state)
+
+    return df
 
-# 'truncation=True' prevents errors with very long reviews
-sentiments = sentiment_pipeline(comments_list, truncation=True, max_length=512)
 
-df_comments['sentiment_label'] = [s['label'] for s in sentiments]
-df_comments['sentiment_score'] = [s['score'] for s in sentiments]
+def check_onnx_accuracy(batch_size=DEFAULT_BATCH_SIZE, threads_per_worker=None):
+    """
+    Scores all comments of the clean file with both backends (bypassing the
+    cache) and prints label agreement, score differences and the speedup.
+    """
+    print("Accuracy check: PyTorch vs. quantized ONNX Runtime")
+    df = load_clean_reviews()
+    if df is None:
+        return
+    comments_list = model_texts(df).dropna().tolist()
+    if not comments_list:
+        print("No comments found to compare.")
+        return
 
-# 4.5 Validation Step
-print("\n--- Sentiment Validation Sample (5 random) ---")
-try:
-    validation_sample = df_comments.sample(n=5, random_state=42)
-    for index, row in validation_sample.iterrows():
-        print(f"Review: {str(row['comment'])[:100]}...")
-        print(f" -> Label: {row['sentiment_label']} (Score: {row['sentiment_score']:.4f})")
-except ValueError:
-    print("Not enough data for validation sample.")
+    timings = {}
+    results = {}
+    for backend in BACKENDS:
+        start_time = time.perf_counter()
+        results[backend] = score_comments(
+            comments_list, MODEL_NAME, MODEL_REVISION,
+            batch_size=batch_size, threads_per_worker=threads_per_worker, backend=backend
+        )
+        timings[backend] = time.perf_counter() - start_time
 
-print("Analysis completed.")
+    torch_labels = np.array([s['label'] for s in results['torch']])
+    onnx_labels = np.array([s['label'] for s in results['onnx']])
+    score_diff = np.abs(
+        np.array([s['score'] for s in results['torch']]) - np.array([s['score'] for s in results['onnx']])
+    )
+    disagree = np.flatnonzero(torch_labels != onnx_labels)
 
-# 5. Merge sentiment data with original data
-df = df.join(df_comments[['sentiment_label', 'sentiment_score']])
+    print("\n--- ONNX Accuracy Report ---")
+    print(f"Comments compared: {len(comments_list)}")
+    print(f"Label agreement: {1 - len(disagree) / len(comments_list):.2%} ({len(disagree)} different)")
+    print(f"Score difference: mean {score_diff.mean():.4f}, max {score_diff.max():.4f}")
+    print(f"Time: torch {timings['torch']:.1f} s, onnx {timings['onnx']:.1f} s "
+          f"(speedup x{timings['torch'] / timings['onnx']:.2f})")
+    for i in disagree[:5]:
+        print(f"  Review: {comments_list[i][:80]!r} -> torch {torch_labels[i]}, onnx {onnx_labels[i]}")
 
-# 6. Save the enriched file
-print(f"Step 4: Saving results to '{OUTPUT_FILE}'...")
-output_data = {"reviews": df.to_dict('records')}
 
-with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-    json.dump(output_data, f, indent=2, ensure_ascii=False)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adds Dutch sentiment scores to the cleaned reviews.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only score new or updated reviews")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="comments per length-bucketed batch")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="number of worker processes, each with its own model replica")
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help="inference threads per worker (default: CPU count / workers)")
+    parser.add_argument('--backend', choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="'onnx' runs an int8-quantized export with ONNX Runtime")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="keep the reviews in compact column types")
+    parser.add_argument('--check-onnx', action='store_true',
+                        help="compare the ONNX backend against PyTorch on the clean file and stop")
+    parser.add_argument('--pin-model', action='store_true',
+                        help=f"pin the model to the commit '{UNPINNED_REVISION}' points at now and stop")
+    args = parser.parse_args()
 
-print(f"Done! '{OUTPUT_FILE}' has been successfully created.")
\ No newline at end of file
+    if args.pin_model:
+        pin_model_revision()
+    elif args.check_onnx:
+        check_onnx_accuracy(batch_size=args.batch_size, threads_per_worker=args.threads_per_worker)
+    else:
+        analyse_sentiment(
+            incremental=args.incremental,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+            backend=args.backend,
+            low_memory=args.low_memory
+        )
@@ -1,111 +1,444 @@
 import json
-import pandas as pd
-from bertopic import BERTopic
-from sentence_transformers import SentenceTransformer
-from sklearn.feature_extraction.text import CountVectorizer # Nieuw: Nodig voor de filter
+from collections import Counter
+from datetime import datetime, timezone
 import os
+import sys
+import time
 import numpy as np
 
-INPUT_FILE = 'reviews_met_sentiment.json'
-OUTPUT_FILE = 'reviews_met_topics.json'
+from analyse_sentiment import load_clean_reviews
+from embedding_store import EmbeddingStore, text_key
+from near_duplicates import representative_comments
+from comment_text import model_texts, MODEL_TEXT_VARIANT
+from stage_files import write_table, compact_frame, TEXT_COLUMNS
+from stage_metrics import record_metrics
+from model_client import remote_embed
 
-def analyze_topics():
+# Topics only need the clean reviews, so this stage can run next to the sentiment stage
+OUTPUT_FILE = 'reviews_met_topics.parquet'
+
+EMBEDDING_MODEL_NAME = "paraphrase-multilingual-MiniLM-L12-v2"
+
+# The fitted model (incl. vectorizer, UMAP and HDBSCAN) and its metadata
+TOPIC_MODEL_FILE = 'topic_model.pkl'
+TOPIC_MODEL_META_FILE = 'topic_model_meta.json'
+
+# A. Define the words we want to IGNORE (The "Stop Words")
+# These words often appear in translated reviews but have no meaning
+# Google's translation markers are removed by the clean stage (see 'comment_text.py')
+STOP_WORDS = [
+    "by", "review",
+    "de", "het", "een", "is", "en", "van", "te", "dat", "die", # Dutch filler words
+    "the", "and", "to", "of", "a", "in", "is", "for" # English filler words
+]
+
+# How the topic model is trained: 'full' fits UMAP and HDBSCAN on all comments
+# at once, 'online' trains on batches of comments with IncrementalPCA,
+# MiniBatchKMeans and an online vectorizer, holding one batch of embeddings at a time
+TRAINING_MODES = ['full', 'online']
+DEFAULT_TRAINING = 'full'
+ONLINE_BATCH_SIZE = 5000
+# Mini-batch clustering needs a fixed number of topics (and has no outlier topic -1)
+ONLINE_TOPICS = 30
+ONLINE_COMPONENTS = 5
+# Per batch, word counts of earlier batches are weighted down by this fraction
+ONLINE_DECAY = 0.01
+
+
+def load_embedding_model():
+    """Loads the sentence transformer (the "brain") that embeds the comments."""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+
+def build_topic_model(sentence_model):
+    """Creates an unfitted BERTopic model with our custom filters."""
+    # The topic libraries are imported here so a skipped stage does not pay for them
+    from bertopic import BERTopic
+    from sklearn.feature_extraction.text import CountVectorizer # Nieuw: Nodig voor de filter
+
+    # B. Create a vectorizer that uses the stop word list
+    vectorizer_model = CountVectorizer(stop_words=STOP_WORDS)
+
+    return BERTopic(
+        embedding_model=sentence_model,
+        vectorizer_model=vectorizer_model, # Use our filter here!
+        language="multilingual",
+        nr_topics="auto",
+        verbose=True
+    )
+
+
+def build_online_topic_model(sentence_model):
+    """Creates an unfitted BERTopic model that is trained with partial_fit()."""
+    from bertopic import BERTopic
+    from bertopic.vectorizers import OnlineCountVectorizer
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.decomposition import IncrementalPCA
+
+    return BERTopic(
+        embedding_model=sentence_model,
+        umap_model=IncrementalPCA(n_components=ONLINE_COMPONENTS),
+        hdbscan_model=MiniBatchKMeans(n_clusters=ONLINE_TOPICS, random_state=0),
+        vectorizer_model=OnlineCountVectorizer(stop_words=STOP_WORDS, decay=ONLINE_DECAY),
+        language="multilingual",
+        verbose=True
+    )
+
+
+def batch_bounds(n, batch_size):
     """
-    Reads the file with sentiment, adds topics, and saves
-    a Power BI-compatible JSON file.
+    (first, last) positions of the batches of 'n' items. A remainder smaller
+    than ONLINE_TOPICS is added to the last batch: the first batch must hold
+    at least one comment per cluster and every batch one per PCA component.
     """
+    bounds = [(first, min(first + batch_size, n)) for first in range(0, n, batch_size)]
+    if len(bounds) > 1 and bounds[-1][1] - bounds[-1][0] < ONLINE_TOPICS:
+        bounds[-2:] = [(bounds[-2][0], n)]
+    return bounds
 
-    # --- 1. Load data with sentiment ---
-    print("Step 1: Loading data with sentiment...")
-    if not os.path.exists(INPUT_FILE):
-        print(f"ERROR: '{INPUT_FILE}' not found. Have you run 'analyse_sentiment.py'?")
-        return
-        
-    try:
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        df = pd.DataFrame.from_records(data['reviews'])
-        print(f"{len(df)} reviews loaded.")
-    except Exception as e:
-        print(f"ERROR: Could not load data. {e}")
+
+def train_online(topic_model, comments, embed, batch_size):
+    """
+    Trains 'topic_model' (see build_online_topic_model) on batches of
+    'comments' and then assigns every comment to a topic of the final model.
+    'embed' returns the embeddings of a list of comments.
+    Returns the topic per comment.
+    """
+    bounds = batch_bounds(len(comments), batch_size)
+    for number, (first, last) in enumerate(bounds, 1):
+        print(f"  Training batch {number}/{len(bounds)} ({last - first} comments)...")
+        batch = comments[first:last]
+        topic_model.partial_fit(batch, embeddings=embed(batch))
+
+    # The clusters moved while training, so earlier batches are assigned again
+    topics = []
+    for first, last in bounds:
+        batch = comments[first:last]
+        batch_topics, _ = topic_model.transform(batch, embeddings=embed(batch))
+        topics.extend(int(t) for t in batch_topics)
+    return topics
+
+
+def load_topic_meta():
+    """Loads the metadata of the saved model (incl. topic assignments), or None."""
+    if not os.path.exists(TOPIC_MODEL_META_FILE):
+        return None
+    with open(TOPIC_MODEL_META_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_topic_model(training=DEFAULT_TRAINING):
+    """
+    Loads the saved model and its metadata, or returns (None, None) if there
+    is no usable saved model (or it was trained in another mode).
+    """
+    meta = load_topic_meta()
+    if meta is None or not os.path.exists(TOPIC_MODEL_FILE):
+        return None, None
+
+    if meta.get('embedding_model') != EMBEDDING_MODEL_NAME:
+        print("Saved topic model uses another embedding model and will be refitted.")
+        return None, None
+
+    if meta.get('stop_words') != STOP_WORDS or meta.get('text_variant', 'comment') != MODEL_TEXT_VARIANT:
+        print("Saved topic model was fitted on other comment texts or stop words and will be refitted.")
+        return None, None
+
+    if meta.get('training', 'full') != training:
+        print(f"Saved topic model was trained in '{meta.get('training', 'full')}' mode "
+              f"and will be refitted in '{training}' mode.")
+        return None, None
+
+    # The embedding model is stored by name only and not pickled with the model
+    from bertopic import BERTopic
+    topic_model = BERTopic.load(TOPIC_MODEL_FILE)
+    return topic_model, meta
+
+
+def save_topic_model(topic_model, meta):
+    """Saves the fitted model without its embedding model, plus the metadata."""
+    topic_model.save(TOPIC_MODEL_FILE, serialization="pickle", save_embedding_model=False)
+    with open(TOPIC_MODEL_META_FILE, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+
+def map_topic_ids(new_topics, old_stable_topics, old_topic_ids, model_topics=()):
+    """
+    Maps the topic numbers of a freshly fitted model onto the stable topic IDs
+    of the previous model.
+
+    new_topics: topic per document from the new model.
+    old_stable_topics: stable topic per document from the previous model
+    (None for documents the previous model never saw).
+    old_topic_ids: all stable IDs used so far.
+    model_topics: every topic of the new model, also those no document was
+    assigned to (a later transform() can still return them).
+
+    Every new topic gets the old ID it shares most documents with (each old
+    ID at most once, largest overlaps first); the rest get fresh IDs. The
+    outlier topic -1 always stays -1. Returns {new topic: stable ID}.
+    """
+    overlap = Counter(
+        (new, old) for new, old in zip(new_topics, old_stable_topics)
+        if new != -1 and old is not None and old != -1
+    )
+
+    topic_id_map = {-1: -1}
+    used_old_ids = set()
+    for (new, old), _ in overlap.most_common():
+        if new not in topic_id_map and old not in used_old_ids:
+            topic_id_map[new] = old
+            used_old_ids.add(old)
+
+    next_id = max([t for t in old_topic_ids if t != -1], default=-1) + 1
+    for new in sorted(set(new_topics) | set(model_topics)):
+        if new not in topic_id_map:
+            topic_id_map[new] = next_id
+            next_id += 1
+    return topic_id_map
+
+
+def report_drift(stable_topics, old_stable_topics, topic_id_map, old_topic_ids):
+    """Prints how much the topic assignment changed by refitting."""
+    compared = [(new, old) for new, old in zip(stable_topics, old_stable_topics) if old is not None]
+    changed = sum(1 for new, old in compared if new != old)
+    new_ids = set(topic_id_map.values())
+    old_ids = set(old_topic_ids)
+
+    print("\n--- Topic Drift after Refit ---")
+    if compared:
+        print(f"  {changed} of {len(compared)} known comments changed topic ({changed / len(compared):.1%}).")
+    print(f"  {len(new_ids & old_ids - {-1})} topics kept their ID, "
+          f"{len(new_ids - old_ids)} new topics, {len(old_ids - new_ids)} topics disappeared.")
+
+
+def analyze_topics(df=None, refit=False, write=True, low_memory=False,
+                   training=DEFAULT_TRAINING, batch_size=ONLINE_BATCH_SIZE):
+    """
+    Reads the clean reviews (or takes the DataFrame 'df'), adds topics,
+    and saves the result as a Parquet table (unless write=False).
+    Returns the DataFrame with 'topic_nr', or None if something went wrong.
+
+    The fitted model is saved and reused: later runs only assign topics to
+    comments that have not been assigned before. With refit=True (or when
+    there is no saved model) the model is trained again and the new topics
+    are mapped onto the existing topic IDs, so 'topic_nr' stays stable.
+
+    With training='online' the model is trained on batches of 'batch_size'
+    comments (see TRAINING_MODES) instead of on all comments at once; a batch
+    must hold at least ONLINE_TOPICS comments.
+
+    With low_memory=True only the reviewId and comment columns are kept (the
+    merge stage only takes 'topic_nr' from this stage) and 'topic_nr' is Int16.
+    """
+
+    if training == 'online' and batch_size < ONLINE_TOPICS:
+        print(f"ERROR: Online training needs batches of at least {ONLINE_TOPICS} comments (got {batch_size}).")
         return
 
+    # --- 1. Load the clean data ---
+    if df is not None:
+        print(f"Step 1: {len(df)} reviews received.")
+    else:
+        print("Step 1: Loading clean data...")
+        df = load_clean_reviews(columns=['reviewId'] + TEXT_COLUMNS if low_memory else None, low_memory=low_memory)
+        if df is None:
+            return
+    if low_memory:
+        df = df[['reviewId'] + [c for c in TEXT_COLUMNS if c in df.columns]]
+
     # --- 2. Filter for reviews with comments ---
-    df_comments = df.dropna(subset=['comment']).copy()
-    comments_list = df_comments['comment'].tolist()
-    print(f"{len(comments_list)} comments found for clustering.")
+    #     Near-duplicate comments (one 'comment_group') are embedded and
+    #     clustered once, with the text of the group's first review (without
+    #     Google's translation, see 'comment_text.py')
+    text_cols = ['reviewId'] + [c for c in TEXT_COLUMNS if c in df.columns]
+    df_comments = df.loc[df['comment'].notna(), text_cols].copy()
+    group_texts = representative_comments(df_comments, df)
+    comments_list = list(dict.fromkeys(group_texts))
+    record_metrics(inference_saved=model_texts(df_comments).nunique() - len(comments_list))
+    print(f"{len(df_comments)} comments found for clustering, "
+          f"{len(comments_list)} distinct after grouping near-duplicates.")
 
     if len(comments_list) == 0:
         print("No comments found to analyze. Script stopping.")
-        df['topic_nr'] = np.nan 
+        df['topic_nr'] = np.nan
     else:
-        # --- 3. Setup Topic Model with Stop Words ---
+        # --- 3. Setup Topic Model ---
         print("Step 2: Loading models for topic modeling...")
-        
-        # A. Define the words we want to IGNORE (The "Stop Words")
-        # These words often appear in translated reviews but have no meaning
-        my_stop_words = [
-            "google", "translated", "by", "original", "review", 
-            "de", "het", "een", "is", "en", "van", "te", "dat", "die", # Dutch filler words
-            "the", "and", "to", "of", "a", "in", "is", "for" # English filler words
-        ]
-        
-        # B. Create a vectorizer that uses this list
-        vectorizer_model = CountVectorizer(stop_words=my_stop_words)
-
-        # C. Load the sentence transformer (the "brain")
-        sentence_model = SentenceTransformer("paraphrase-multilingual-MiniLM-L12-v2")
-
-        # D. Create BERTopic with our custom filters
-        topic_model = BERTopic(
-            embedding_model=sentence_model,
-            vectorizer_model=vectorizer_model, # Use our filter here!
-            language="multilingual",
-            nr_topics="auto",
-            verbose=True
-        )
+        if training == 'online' and len(comments_list) < ONLINE_TOPICS:
+            print(f"Fewer than {ONLINE_TOPICS} distinct comments: training on all comments at once.")
+            training = 'full'
+        topic_model, meta = (None, None) if refit else load_topic_model(training)
+        fit = topic_model is None
+
+        # C. Embed the comments; the sentence transformer is only loaded
+        #    when the embedding store is missing some of them and no model
+        #    server is running
+        sentence_model = None
+        timings = {'model_load_s': 0.0, 'inference_s': 0.0}
+
+        def encode(texts):
+            nonlocal sentence_model
+            start_time = time.perf_counter()
+            vectors = remote_embed(texts, EMBEDDING_MODEL_NAME)
+            if vectors is not None:
+                print(f"{len(texts)} comments embedded by the model server.")
+                timings['inference_s'] += time.perf_counter() - start_time
+                return vectors
 
-        # --- 4. Train model and assign topics ---
-        print("Step 3: Training topics and assigning... (This may take a while)")
-        topics, probabilities = topic_model.fit_transform(comments_list)
+            if sentence_model is None:
+                # Loaded once and reused for every later batch
+                start_time = time.perf_counter()
+                sentence_model = load_embedding_model()
+                timings['model_load_s'] += time.perf_counter() - start_time
 
-        df_comments['topic_nr'] = topics
+            start_time = time.perf_counter()
+            vectors = sentence_model.encode(texts, show_progress_bar=True)
+            timings['inference_s'] += time.perf_counter() - start_time
+            return vectors
+
+        embedding_store = EmbeddingStore(EMBEDDING_MODEL_NAME)
+        comment_keys = [text_key(c) for c in comments_list]
+
+        if fit:
+            # --- 4a. Train model and map its topics onto the existing IDs ---
+            previous_meta = load_topic_meta()
+            old_assignments = previous_meta['assignments'] if previous_meta else {}
+            old_topic_ids = previous_meta['topic_ids'] if previous_meta else []
+
+            if training == 'online':
+                # Embeddings are read (or computed and stored) one batch at a time
+                topic_model = build_online_topic_model(sentence_model)
+                print(f"Step 3: Training topics online on batches of up to {batch_size} comments...")
+                start_time = time.perf_counter()
+                inference_s, model_load_s = timings['inference_s'], timings['model_load_s']
+                topics = train_online(
+                    topic_model, comments_list, lambda texts: embedding_store.embed(texts, encode), batch_size
+                )
+                # encode() counted the embedding time itself; loading a model is not inference
+                timings['inference_s'] = (inference_s + time.perf_counter() - start_time
+                                          - (timings['model_load_s'] - model_load_s))
+            else:
+                embeddings = embedding_store.embed(comments_list, encode)
+                topic_model = build_topic_model(sentence_model)
+
+                print("Step 3: Training topics and assigning... (This may take a while)")
+                start_time = time.perf_counter()
+                topics, probabilities = topic_model.fit_transform(comments_list, embeddings=embeddings)
+                timings['inference_s'] += time.perf_counter() - start_time
+
+            old_stable_topics = [old_assignments.get(key) for key in comment_keys]
+            topic_id_map = map_topic_ids(topics, old_stable_topics, old_topic_ids, topic_model.get_topics())
+            stable_topics = [topic_id_map[t] for t in topics]
+            if previous_meta:
+                report_drift(stable_topics, old_stable_topics, topic_id_map, old_topic_ids)
+
+            meta = {
+                "embedding_model": EMBEDDING_MODEL_NAME,
+                "nr_topics": "auto" if training == 'full' else ONLINE_TOPICS,
+                "training": training,
+                "batch_size": batch_size if training == 'online' else None,
+                "stop_words": STOP_WORDS,
+                "text_variant": MODEL_TEXT_VARIANT,
+                "fitted_at": datetime.now(timezone.utc).isoformat(),
+                "fitted_on": len(comments_list),
+                # Internal topic number of the model -> stable topic ID (JSON keys are strings)
+                "topic_id_map": {str(k): v for k, v in topic_id_map.items()},
+                "topic_ids": sorted(set(old_topic_ids) | set(topic_id_map.values())),
+                "assignments": dict(zip(comment_keys, stable_topics))
+            }
+        else:
+            # --- 4b. Assign topics with the saved model, only for new comments ---
+            topic_id_map = {int(k): v for k, v in meta['topic_id_map'].items()}
+            assignments = meta['assignments']
+            new_positions = [i for i, key in enumerate(comment_keys) if key not in assignments]
+            print(f"Step 3: Saved model loaded (fitted {meta['fitted_at'][:10]}), "
+                  f"{len(new_positions)} new comments to assign.")
+
+            if new_positions:
+                new_comments = [comments_list[i] for i in new_positions]
+                new_embeddings = embedding_store.embed(new_comments, encode)
+                start_time = time.perf_counter()
+                new_topics, _ = topic_model.transform(new_comments, embeddings=new_embeddings)
+                timings['inference_s'] += time.perf_counter() - start_time
+                for i, topic in zip(new_positions, new_topics):
+                    assignments[comment_keys[i]] = topic_id_map[int(topic)]
+
+            stable_topics = [assignments[key] for key in comment_keys]
+
+        df_comments['topic_nr'] = group_texts.map(dict(zip(comments_list, stable_topics)))
+
+        # Inference = embedding new comments plus fitting or assigning topics
+        n_processed = len(comments_list) if fit else len(new_positions)
+        record_metrics(
+            model_load_s=round(timings['model_load_s'], 3), inference_s=round(timings['inference_s'], 3),
+            comments_processed=n_processed, refitted=fit, training=training,
+            comments_per_s=round(n_processed / timings['inference_s'], 1) if timings['inference_s'] else None
+        )
 
         # --- 5. View found topics ---
         print("\n--- Found Topics (Top 5 words per topic) ---")
         top_topics = topic_model.get_topic_info()
+        top_topics['topic_nr'] = top_topics['Topic'].map(topic_id_map)
         # Print columns explicitly to avoid confusion
-        print(top_topics[['Topic', 'Count', 'Name']].head(10))
+        print(top_topics[['topic_nr', 'Count', 'Name']].head(10))
         print("--------------------------------------------------\n")
-        
-        # --- 5.1 Validation: Save visualization ---
-        print("Generating visualization...")
+
+        # Topic names by stable ID, for the Power BI topic table; IDs that are
+        # no longer used keep their last name (keys such as 'nan' or '3.0',
+        # written for topics without an ID by earlier versions, are dropped)
+        meta['topic_names'] = {
+            **{k: v for k, v in meta.get('topic_names', {}).items() if k.lstrip('-').isdigit()},
+            **{str(int(topic_nr)): name for topic_nr, name in zip(top_topics['topic_nr'], top_topics['Name'])}
+        }
+
+        if fit:
+            # --- 5.1 Validation: Save visualization ---
+            print("Generating visualization...")
+            try:
+                fig = topic_model.visualize_topics()
+                fig.write_html("bertopic_visualization.html")
+                print("Visualization saved to 'bertopic_visualization.html'.")
+            except Exception as e:
+                print(f"Warning: Could not save visualization: {e}")
+
+        # --- 5.2 Save the model (new fit) or the new assignments ---
         try:
-            fig = topic_model.visualize_topics()
-            fig.write_html("bertopic_visualization.html")
-            print("Visualization saved to 'bertopic_visualization.html'.")
+            if fit:
+                save_topic_model(topic_model, meta)
+                print(f"Topic model saved to '{TOPIC_MODEL_FILE}'.")
+            else:
+                with open(TOPIC_MODEL_META_FILE, 'w', encoding='utf-8') as f:
+                    json.dump(meta, f, ensure_ascii=False)
         except Exception as e:
-            print(f"Warning: Could not save visualization: {e}")
+            print(f"Warning: Could not save topic model: {e}")
 
         # --- 6. Merge topic data ---
         df = df.join(df_comments[['topic_nr']])
 
-    # --- 7. Save final file ---
-    print(f"Step 4: Saving final file to '{OUTPUT_FILE}'...")
+    if low_memory:
+        df = compact_frame(df)
 
-    # Convert NaN to None (null) for JSON compatibility
-    df_for_json = df.replace({np.nan: None})
+    # --- 7. Save final file ---
+    if write:
+        print(f"Step 4: Saving final file to '{OUTPUT_FILE}'...")
 
-    output_data = {"reviews": df_for_json.to_dict('records')}
-    
-    try:
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=2, ensure_ascii=False)
+        try:
+            write_table(df, OUTPUT_FILE)
+            print(f"\nAll analyses completed! '{OUTPUT_FILE}' created successfully.")
 
-        print(f"\nAll analyses completed! '{OUTPUT_FILE}' created successfully.")
+        except Exception as e:
+            print(f"\nERROR writing Parquet: {e}")
+            return
 
-    except Exception as e:
-        print(f"\nERROR writing JSON: {e}")
+    return df
 
 if __name__ == "__main__":
-    analyze_topics()
\ No newline at end of file
+    # '--refit' trains the topic model again instead of reusing the saved one,
+    # '--low-memory' keeps only the comment columns in compact types,
+    # '--online' trains on batches of comments (see TRAINING_MODES)
+    analyze_topics(
+        refit='--refit' in sys.argv[1:], low_memory='--low-memory' in sys.argv[1:],
+        training='online' if '--online' in sys.argv[1:] else DEFAULT_TRAINING
+    )
@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from stage_files import COMPRESSION
+
+# Reads the Power BI export of 'merge_with_weather.py' and writes a small
+# results table: rating and sentiment per temperature band, rain bucket,
+# topic and location, and their correlation with the weather, each with a
+# bootstrap confidence interval
+INPUT_FILE = 'final_data_for_powerbi.json'
+OUTPUT_FILE = 'weather_effects.parquet'
+
+# 'sentiment_score' is the model's confidence in the label it chose, so the
+# metric is the probability that a review is positive, derived from both
+METRICS = ['rating', 'sentiment_positive']
+SENTIMENT_COLUMNS = ['sentiment_label', 'sentiment_score']
+POSITIVE_LABEL = 'Positive'
+WEATHER = ['temp_max_c', 'precip_amount_mm']
+
+# Band edges (lower bound included) and their labels
+TEMP_BAND_EDGES = [5, 10, 15, 20, 25]
+TEMP_BAND_LABELS = ['< 5 °C', '5-10 °C', '10-15 °C', '15-20 °C', '20-25 °C', '>= 25 °C']
+# Precipitation up to and including each edge
+RAIN_BUCKET_EDGES = [0.0, 1.0, 5.0]
+RAIN_BUCKET_LABELS = ['dry', 'light (<= 1 mm)', 'moderate (1-5 mm)', 'heavy (> 5 mm)']
+
+N_RESAMPLES = 1000
+CONFIDENCE = 0.95
+SEED = 20240101
+# Groups with fewer reviews are left out
+MIN_GROUP_SIZE = 10
+# Resampled values per array operation (resamples x rows), 32 MB per float64 array
+RESAMPLE_CHUNK = 1 << 22
+
+RESULT_SCHEMA = pa.schema([
+    ('analysis', pa.dictionary(pa.int8(), pa.string())),    # 'mean' or 'correlation'
+    ('dimension', pa.dictionary(pa.int8(), pa.string())),   # what the rows are grouped by
+    ('group', pa.string()),
+    ('group_order', pa.int16()),                            # sort order of the groups in a dimension
+    ('metric', pa.dictionary(pa.int8(), pa.string())),
+    ('weather', pa.dictionary(pa.int8(), pa.string())),     # correlations only
+    ('n', pa.int32()),
+    ('estimate', pa.float32()),
+    ('ci_low', pa.float32()),
+    ('ci_high', pa.float32()),
+])
+
+
+def load_reviews(file_path=INPUT_FILE):
+    """The reviews of the Power BI export as a DataFrame, or None."""
+    if not os.path.exists(file_path):
+        print(f"ERROR: '{file_path}' not found. Run 'merge_with_weather.py' first.")
+        return None
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return pd.DataFrame.from_records(json.load(f)['reviews'])
+
+
+def add_positive_probability(df):
+    """Adds 'sentiment_positive': P(positive) of the two-label sentiment model (NaN without a label)."""
+    df = df.copy()
+    score = df['sentiment_score'].to_numpy(float)
+    label = df['sentiment_label']
+    df['sentiment_positive'] = np.where(label.isna(), np.nan, np.where(label == POSITIVE_LABEL, score, 1 - score))
+    return df
+
+
+def add_bands(df):
+    """Adds 'temp_band' and 'rain_bucket' (band numbers, NaN without weather)."""
+    df = df.copy()
+    temp = df['temp_max_c'].to_numpy(float)
+    df['temp_band'] = np.where(np.isnan(temp), np.nan, np.digitize(temp, TEMP_BAND_EDGES))
+    rain = df['precip_amount_mm'].to_numpy(float)
+    df['rain_bucket'] = np.where(np.isnan(rain), np.nan, np.digitize(rain, RAIN_BUCKET_EDGES, right=True))
+    return df
+
+
+def resample_counts(rng, starts, sizes, n_resamples):
+    """
+    (n_resamples, rows) matrix of how often each row is drawn when every group
+    (the consecutive slices starts[g]:starts[g] + sizes[g]) is resampled with
+    replacement within itself. All resamples are drawn in one array operation.
+    """
+    group_of_row = np.repeat(np.arange(len(sizes)), sizes)
+    n_rows = len(group_of_row)
+    draws = rng.random((n_resamples, n_rows))
+    positions = starts[group_of_row] + (draws * sizes[group_of_row]).astype(np.int64)
+    positions += (np.arange(n_resamples) * n_rows)[:, None]
+    return np.bincount(positions.ravel(), minlength=n_resamples * n_rows).reshape(n_resamples, n_rows)
+
+
+def resample_sums(rng, values, starts, sizes, n_resamples):
+    """
+    Per resample and group the column sums of 'values' (rows sorted by group):
+    an (n_resamples, groups, columns) array. Resamples are drawn in chunks of
+    about RESAMPLE_CHUNK values; the sums of one group are a single matrix product.
+    """
+    sums = np.empty((n_resamples, len(sizes), values.shape[1]))
+    per_chunk = max(1, RESAMPLE_CHUNK // max(1, sizes.sum()))
+    for first in range(0, n_resamples, per_chunk):
+        count = min(per_chunk, n_resamples - first)
+        counts = resample_counts(rng, starts, sizes, count).astype(float)
+        for group, (start, size) in enumerate(zip(starts, sizes)):
+            sums[first:first + count, group] = counts[:, start:start + size] @ values[start:start + size]
+    return sums
+
+
+def confidence_interval(statistics):
+    """Percentile interval of bootstrap statistics (resamples along axis 0)."""
+    tail = (1 - CONFIDENCE) / 2 * 100
+    with warnings.catch_warnings():
+        # Correlations of a group whose rating never varies are all NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanpercentile(statistics, [tail, 100 - tail], axis=0)
+
+
+def sorted_groups(keys, *columns):
+    """
+    Drops rows with a missing key or value, sorts by key and keeps groups
+    of at least MIN_GROUP_SIZE. Returns (group keys, starts, sizes, columns).
+    """
+    keep = pd.notna(keys)
+    for column in columns:
+        keep &= ~np.isnan(column)
+    order = np.argsort(keys[keep], kind='stable')
+    keys = keys[keep][order]
+    columns = [column[keep][order] for column in columns]
+
+    group_keys, starts, sizes = np.unique(keys, return_index=True, return_counts=True)
+    large = sizes >= MIN_GROUP_SIZE
+    rows = np.repeat(large, sizes)
+    group_keys, sizes = group_keys[large], sizes[large]
+    starts = np.cumsum(sizes) - sizes
+    return group_keys, starts, sizes, [column[rows] for column in columns]
+
+
+def pearson(n, sx, sy, sxx, syy, sxy):
+    """Pearson correlation from sums (arrays of any shape); NaN when a side is constant."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariance = sxy - sx * sy / n
+        return covariance / np.sqrt((sxx - sx * sx / n) * (syy - sy * sy / n))
+
+
+def group_statistics(rng, keys, y, weather, n_resamples=N_RESAMPLES):
+    """
+    Per group of 'keys': the mean of 'y' and its correlation with each column
+    of 'weather' (a dict of arrays), with bootstrap intervals. All statistics
+    come from the same resamples, as sums of a few columns per group.
+    Returns a DataFrame with group, statistic ('mean' or a weather column),
+    n, estimate, ci_low and ci_high.
+    """
+    group_keys, starts, sizes, (y, *xs) = sorted_groups(keys, y, *weather.values())
+    if len(sizes) == 0:
+        return pd.DataFrame(columns=['group', 'statistic', 'n', 'estimate', 'ci_low', 'ci_high'])
+
+    # Centred per group, so the sums of squares stay accurate
+    def centred(column):
+        return column - np.repeat(np.add.reduceat(column, starts) / sizes, sizes)
+
+    yc = centred(y)
+    columns = [y, yc, yc * yc]
+    for x in xs:
+        xc = centred(x)
+        columns += [xc, xc * xc, xc * yc]
+    values = np.column_stack(columns)
+
+    def statistics(sums):
+        result = {'mean': sums[..., 0] / sizes}
+        for k, name in enumerate(weather):
+            sx, sxx, sxy = sums[..., 3 + 3 * k], sums[..., 4 + 3 * k], sums[..., 5 + 3 * k]
+            result[name] = pearson(sizes, sx, sums[..., 1], sxx, sums[..., 2], sxy)
+        return result
+
+    estimates = statistics(np.add.reduceat(values, starts, axis=0))
+    resampled = statistics(resample_sums(rng, values, starts, sizes, n_resamples))
+    parts = []
+    for name, estimate in estimates.items():
+        ci_low, ci_high = confidence_interval(resampled[name])
+        parts.append(pd.DataFrame({
+            'group': group_keys, 'statistic': name, 'n': sizes,
+            'estimate': estimate, 'ci_low': ci_low, 'ci_high': ci_high
+        }))
+    return pd.concat(parts, ignore_index=True)
+
+
+def dimensions(df):
+    """{dimension: (group key per review, {key: label})} to slice the reviews by."""
+    result = {
+        'all': (np.zeros(len(df)), {0: 'all reviews'}),
+        'temp_band': (df['temp_band'].to_numpy(float), dict(enumerate(TEMP_BAND_LABELS))),
+        'rain_bucket': (df['rain_bucket'].to_numpy(float), dict(enumerate(RAIN_BUCKET_LABELS))),
+    }
+    if 'topic_nr' in df.columns:
+        topics = df['topic_nr'].to_numpy(float)
+        result['topic_nr'] = (topics, {t: f"Topic {t:.0f}" for t in np.unique(topics[~np.isnan(topics)])})
+    if 'locationId' in df.columns:
+        locations = df['locationId'].astype(object).to_numpy()
+        result['locationId'] = (locations, {loc: loc for loc in pd.unique(locations[pd.notna(locations)])})
+    return result
+
+
+def with_labels(df_result, labels):
+    """Replaces the group keys by their labels and adds their sort order."""
+    order = {key: i for i, key in enumerate(labels)}
+    return df_result.assign(group_order=df_result['group'].map(order), group=df_result['group'].map(labels))
+
+
+def analyse_weather_effects(df=None, write=True, n_resamples=N_RESAMPLES):
+    """
+    Computes the results table for the reviews of the Power BI export (or
+    the DataFrame 'df') and saves it to OUTPUT_FILE (unless write=False).
+
+    For every dimension (all reviews, temperature band, rain bucket, topic
+    and, when present, location) it holds the mean of each metric per group
+    and, per group, the correlation of each metric with each weather column.
+    Reviews without weather data are left out. All intervals are percentile
+    bootstrap intervals of 'n_resamples' resamples, drawn for all groups at
+    once. Returns the table, or None.
+    """
+    if df is None:
+        df = load_reviews()
+        if df is None:
+            return
+    missing = [c for c in ['rating'] + SENTIMENT_COLUMNS + WEATHER if c not in df.columns]
+    if missing:
+        print(f"ERROR: Columns {missing} not found; is this the output of 'merge_with_weather.py'?")
+        return
+
+    print(f"Analysing {len(df)} reviews with {n_resamples} bootstrap resamples...")
+    df = add_bands(add_positive_probability(df))
+    rng = np.random.default_rng(SEED)
+    weather = {column: df[column].to_numpy(float) for column in WEATHER}
+    parts = []
+
+    for dimension, (keys, labels) in dimensions(df).items():
+        for metric in METRICS:
+            df_stats = group_statistics(rng, keys, df[metric].to_numpy(float), weather, n_resamples)
+            # Within a weather band the weather hardly varies: only the means are kept
+            if dimension in ('temp_band', 'rain_bucket'):
+                df_stats = df_stats[df_stats['statistic'] == 'mean']
+            is_mean = df_stats['statistic'] == 'mean'
+            df_stats = df_stats.assign(
+                analysis=np.where(is_mean, 'mean', 'correlation'),
+                weather=df_stats['statistic'].where(~is_mean), dimension=dimension, metric=metric
+            )
+            parts.append(with_labels(df_stats, labels))
+
+    parts = [p for p in parts if not p.empty]
+    if parts:
+        df_results = pd.concat(parts, ignore_index=True)[RESULT_SCHEMA.names]
+        print("\n--- Rating and sentiment by weather ---")
+        shown = df_results[df_results['dimension'].isin(['temp_band', 'rain_bucket', 'all'])]
+        print(shown[['analysis', 'dimension', 'group', 'metric', 'weather', 'n', 'estimate', 'ci_low', 'ci_high']]
+              .round(3).to_string(index=False))
+    else:
+        # An empty table (rather than the results of an earlier run) for Power BI
+        df_results = RESULT_SCHEMA.empty_table().to_pandas()
+        print(f"No group has {MIN_GROUP_SIZE} or more reviews with weather data; no results.")
+
+    if write:
+        table = pa.Table.from_pandas(df_results, preserve_index=False).cast(RESULT_SCHEMA, safe=False)
+        pq.write_table(table, OUTPUT_FILE + '.tmp', compression=COMPRESSION)
+        os.replace(OUTPUT_FILE + '.tmp', OUTPUT_FILE)
+        print(f"\n{len(df_results)} result rows saved to '{OUTPUT_FILE}'.")
+    return df_results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rating and sentiment by weather, with bootstrap confidence intervals, for Power BI."
+    )
+    parser.add_argument('--input', default=INPUT_FILE, help="the JSON export of 'merge_with_weather.py'")
+    parser.add_argument('--resamples', type=int, default=N_RESAMPLES, help="bootstrap resamples")
+    args = parser.parse_args()
+
+    df_input = load_reviews(args.input)
+    if df_input is not None:
+        analyse_weather_effects(df_input, n_resamples=args.resamples)
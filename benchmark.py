@@ -0,0 +1,486 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np
+
+from stage_metrics import peak_memory_mb
+
+# Results of every benchmark run, one JSON object per stage per line
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+SCALES = {'10k': 10_000, '100k': 100_000, '1M': 1_000_000}
+
+# Stages in the order they run; each reads the output of the ones before it
+STAGE_NAMES = ['clean_reviews', 'parse_weather', 'analyse_sentiment', 'analyse_topics', 'merge_with_weather']
+
+# Shape of the synthetic data
+N_LOCATIONS = 20
+WEATHER_YEARS = 20
+DUPLICATE_RATE = 0.02
+MISSING_RATING_RATE = 0.01
+MISSING_NAME_RATE = 0.005
+COMMENT_RATE = 0.5
+TRANSLATED_RATE = 0.15
+# Share of the translated comments written in German instead of Dutch
+GERMAN_ORIGINAL_RATE = 0.3
+# Comments that re-post an earlier comment, sometimes with other punctuation
+REPOST_RATE = 0.1
+REPLY_RATE = 0.3
+
+RATINGS = ['ONE', 'TWO', 'THREE', 'FOUR', 'FIVE']
+DUTCH_WORDS = (
+    "lekker eten gezellig personeel vriendelijk snel service prijs kwaliteit mooi terras "
+    "koffie taart lunch diner wachten lang duur koud warm sfeer aanrader zeker terug "
+    "niet goed slecht prima top heerlijk rustig druk bediening kaart keuze"
+).split()
+ENGLISH_WORDS = (
+    "tasty food cozy staff friendly fast service price quality nice terrace coffee cake "
+    "lunch dinner waiting long expensive cold warm atmosphere recommended definitely back "
+    "not good bad fine great delicious quiet busy menu choice"
+).split()
+GERMAN_WORDS = (
+    "lecker essen gemütlich personal freundlich schnell service preis qualität schön terrasse "
+    "kaffee kuchen mittagessen abendessen warten lange teuer kalt warm stimmung empfehlenswert "
+    "nicht gut schlecht sehr ruhig voll bedienung karte auswahl"
+).split()
+
+KNMI_HEADER = """\
+# BRON: KONINKLIJK NEDERLANDS METEOROLOGISCH INSTITUUT (KNMI)
+# SOURCE: ROYAL NETHERLANDS METEOROLOGICAL INSTITUTE (KNMI)
+# Synthetische data voor benchmarks / synthetic benchmark data
+#
+# STN         LON(east)   LAT(north)  ALT(m)      NAME
+{stations}
+# TG        : Etmaalgemiddelde temperatuur (in 0.1 graden Celsius) / Daily mean temperature in (0.1 degrees Celsius)
+# TN        : Minimum temperatuur (in 0.1 graden Celsius) / Minimum temperature (in 0.1 degrees Celsius)
+# TX        : Maximum temperatuur (in 0.1 graden Celsius) / Maximum temperature (in 0.1 degrees Celsius)
+# DR        : Duur van de neerslag (in 0.1 uur) / Precipitation duration (in 0.1 hour)
+# RH        : Etmaalsom van de neerslag (in 0.1 mm) (-1 voor <0.05 mm) / Daily precipitation amount (in 0.1 mm) (-1 for <0.05 mm)
+# RHX       : Hoogste uursom van de neerslag (in 0.1 mm) (-1 voor <0.05 mm) / Maximum hourly precipitation amount (in 0.1 mm) (-1 for <0.05 mm)
+# STN,YYYYMMDD,   TG,   TN,   TX,   DR,   RH,  RHX
+"""
+
+
+# --- Synthetic data ---
+
+def weather_period():
+    """First day and number of days (as datetime64) covered by the synthetic weather."""
+    n_days = WEATHER_YEARS * 365
+    first_day = np.datetime64('2025-12-31') - n_days + 1
+    return first_day, n_days
+
+
+def random_text(rng, words, n_words):
+    return ' '.join(rng.choice(words, size=n_words))
+
+
+def translated_comment(rng, n_words):
+    """
+    A comment with Google's English translation, in one of the two layouts
+    of the export (see 'comment_text.py'); the original is Dutch or German.
+    """
+    words = GERMAN_WORDS if rng.random() < GERMAN_ORIGINAL_RATE else DUTCH_WORDS
+    original = random_text(rng, words, n_words)
+    translation = random_text(rng, ENGLISH_WORDS, n_words)
+    if rng.random() < 0.5:
+        return f"{original}\n\n(Translated by Google)\n{translation}"
+    return f"(Translated by Google) {translation}\n\n(Original)\n{original}"
+
+
+def generate_reviews(n_reviews, file_path, rng):
+    """
+    Writes a Google Business Profile export ('terspegelt.json' schema) with
+    duplicates, reviews without rating or reviewer name, re-posted comments
+    and comments that were translated by Google.
+    """
+    first_day, n_days = weather_period()
+    start = first_day.astype('datetime64[s]').astype(np.int64)
+    seconds = rng.integers(start, start + n_days * 86400, size=n_reviews)
+    locations = rng.integers(1_000_000, 10**19, size=N_LOCATIONS, dtype=np.uint64)
+
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write('{"reviews": [\n')
+        previous = []
+        previous_comments = []
+        for i in range(n_reviews):
+            if previous and rng.random() < DUPLICATE_RATE:
+                # Same review again (same 'name'), as in overlapping exports
+                review = previous[rng.integers(len(previous))]
+            else:
+                created = datetime.fromtimestamp(int(seconds[i]), timezone.utc)
+                timestamp = created.strftime('%Y-%m-%dT%H:%M:%S.') + f"{rng.integers(10**6):06d}Z"
+                location = locations[rng.integers(N_LOCATIONS)]
+                review = {
+                    "reviewer": {"displayName": f"Reviewer {i}"},
+                    "starRating": RATINGS[rng.integers(5)],
+                    "createTime": timestamp,
+                    "updateTime": timestamp,
+                    "name": f"accounts/1/locations/{location}/reviews/bench{i:09d}"
+                }
+                if rng.random() < MISSING_RATING_RATE:
+                    del review['starRating']
+                if rng.random() < MISSING_NAME_RATE:
+                    del review['reviewer']['displayName']
+                if rng.random() < COMMENT_RATE:
+                    if previous_comments and rng.random() < REPOST_RATE:
+                        comment = previous_comments[rng.integers(len(previous_comments))]
+                        comment = comment + '!' if rng.random() < 0.5 else comment.capitalize()
+                    else:
+                        n_words = int(rng.integers(3, 80))
+                        if rng.random() < TRANSLATED_RATE:
+                            comment = translated_comment(rng, n_words)
+                        else:
+                            comment = random_text(rng, DUTCH_WORDS, n_words)
+                        if len(previous_comments) < 1000:
+                            previous_comments.append(comment)
+                    review['comment'] = comment
+                if rng.random() < REPLY_RATE:
+                    review['reviewReply'] = {"comment": "Bedankt voor uw review!", "updateTime": timestamp}
+                if len(previous) < 1000:
+                    previous.append(review)
+            f.write(('' if i == 0 else ',\n') + json.dumps(review, ensure_ascii=False))
+        f.write('\n]}\n')
+
+    return locations
+
+
+def generate_knmi(n_rows, file_path, rng):
+    """
+    Writes a KNMI daily-data download ('result.txt' layout) with enough
+    stations to reach about 'n_rows' data lines. Returns the station table.
+    """
+    first_day, n_days = weather_period()
+    n_stations = max(1, -(-n_rows // n_days))
+    stations = {
+        'STN': 200 + np.arange(n_stations),
+        'lon': rng.uniform(3.4, 7.2, n_stations),
+        'lat': rng.uniform(50.8, 53.5, n_stations),
+    }
+    station_lines = '\n'.join(
+        f"# {stn:<11d} {lon:<11.3f} {lat:<11.3f} {0.0:<11.2f} Station {stn}"
+        for stn, lon, lat in zip(stations['STN'], stations['lon'], stations['lat'])
+    )
+
+    days = first_day + np.arange(n_days)
+    dates = np.char.replace(days.astype(str), '-', '')
+    seasonal = 100 - 70 * np.cos(2 * np.pi * np.arange(n_days) / 365.25)
+
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write(KNMI_HEADER.format(stations=station_lines))
+        for stn in stations['STN']:
+            tg = (seasonal + rng.normal(0, 30, n_days)).astype(int)
+            tn = tg - rng.integers(10, 80, n_days)
+            tx = tg + rng.integers(10, 80, n_days)
+            rh = np.where(rng.random(n_days) < 0.5, 0, rng.integers(-1, 300, n_days))
+            rhx = np.minimum(rh, rng.integers(-1, 60, n_days))
+            dr = np.where(rh > 0, rng.integers(1, 240, n_days), 0)
+            block = np.column_stack([tg, tn, tx, dr, rh, rhx])
+            f.writelines(
+                f"  {stn},{date}," + ','.join(f"{v:>5d}" for v in row) + '\n'
+                for date, row in zip(dates, block.tolist())
+            )
+
+    return stations
+
+
+def write_locations(file_path, location_ids, rng):
+    """locations.csv with random coordinates in the Netherlands."""
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write('locationId,name,lat,lon\n')
+        for i, location in enumerate(location_ids):
+            f.write(f"{location},Location {i},{rng.uniform(50.8, 53.5):.4f},{rng.uniform(3.4, 7.2):.4f}\n")
+
+
+def generate_dataset(n_rows, work_dir, seed):
+    """Writes the synthetic review export, KNMI download and locations to 'work_dir'."""
+    import clean_reviews
+    import parse_weather
+    import station_lookup
+
+    rng = np.random.default_rng(seed)
+    start_time = time.perf_counter()
+    location_ids = generate_reviews(n_rows, os.path.join(work_dir, clean_reviews.INPUT_FILE), rng)
+    generate_knmi(n_rows, os.path.join(work_dir, parse_weather.INPUT_FILE), rng)
+    write_locations(os.path.join(work_dir, station_lookup.LOCATIONS_FILE), location_ids, rng)
+    print(f"Synthetic data ({n_rows} rows) generated in {time.perf_counter() - start_time:.1f} s.")
+
+
+# --- Stand-in models (offline, no downloads) ---
+
+class LexiconSentiment:
+    """Tiny stand-in for the transformers sentiment pipeline: counts positive/negative words."""
+
+    POSITIVE = {"lekker", "gezellig", "vriendelijk", "mooi", "aanrader", "prima", "top", "heerlijk", "goed"}
+    NEGATIVE = {"slecht", "duur", "koud", "lang", "niet", "wachten"}
+
+    def __call__(self, texts, batch_size=None, truncation=True, max_length=None):
+        results = []
+        for text in texts:
+            words = text.lower().split()[:max_length]
+            balance = sum(w in self.POSITIVE for w in words) - sum(w in self.NEGATIVE for w in words)
+            score = 1 / (1 + np.exp(-balance))
+            results.append({'label': 'Positive' if balance >= 0 else 'Negative',
+                            'score': float(max(score, 1 - score))})
+        return results
+
+
+def hashing_embedder(dim=64):
+    """Tiny stand-in for the sentence transformer: hashed bag-of-words vectors."""
+    try:
+        from bertopic.backend import BaseEmbedder
+    except ImportError:
+        BaseEmbedder = object
+
+    class HashingEmbedder(BaseEmbedder):
+        def encode(self, texts, show_progress_bar=False):
+            vectors = np.zeros((len(texts), dim), dtype=np.float32)
+            for row, text in enumerate(texts):
+                for word in text.lower().split():
+                    vectors[row, zlib.crc32(word.encode('utf-8')) % dim] += 1
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            return vectors / np.maximum(norms, 1e-9)
+
+        def embed(self, documents, verbose=False):
+            return self.encode(documents)
+
+    return HashingEmbedder()
+
+
+def use_stand_in_models():
+    """Swaps the downloaded models of the model stages for the stand-ins above."""
+    import analyse_sentiment
+    import analyse_topics
+    import sentiment_inference
+
+    sentiment_inference.load_sentiment_pipeline = lambda *args, **kwargs: LexiconSentiment()
+    analyse_sentiment.MODEL_NAME = 'benchmark/lexicon-stand-in'
+    analyse_topics.load_embedding_model = hashing_embedder
+    analyse_topics.EMBEDDING_MODEL_NAME = 'benchmark/hashing-stand-in'
+
+
+# --- Running and measuring the stages ---
+
+def run_stage(stage_name, low_memory=False):
+    """Runs one stage on the files in the current directory. Returns its output."""
+    if stage_name == 'clean_reviews':
+        import clean_reviews
+        return clean_reviews.clean_review_data()
+    if stage_name == 'parse_weather':
+        import parse_weather
+        return parse_weather.parse_knmi_data()
+    if stage_name == 'analyse_sentiment':
+        import analyse_sentiment
+        return analyse_sentiment.analyse_sentiment(low_memory=low_memory)
+    if stage_name == 'analyse_topics':
+        import analyse_topics
+        return analyse_topics.analyze_topics(low_memory=low_memory)
+    if stage_name == 'merge_with_weather':
+        import merge_with_weather
+        return merge_with_weather.merge_data(low_memory=low_memory)
+    raise ValueError(f"unknown stage '{stage_name}'")
+
+
+def stage_process(stage_name, work_dir, stand_in_models, low_memory, connection):
+    """
+    Runs in a fresh process per stage, so the peak memory is that of the stage
+    alone. Sends {'status', 'seconds', 'peak_rss_mb', 'rows', 'error'} back.
+    """
+    os.chdir(work_dir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # Stage output goes to a log file, the benchmark prints the summary
+    sys.stdout = open(f"{stage_name}.log", 'w', encoding='utf-8')
+
+    result = {'status': 'ok', 'error': None, 'rows': None}
+    try:
+        if stand_in_models:
+            use_stand_in_models()
+        start_time = time.perf_counter()
+        output = run_stage(stage_name, low_memory)
+        result['seconds'] = time.perf_counter() - start_time
+        if output is None:
+            result.update(status='failed', error=f"stage returned nothing, see {stage_name}.log")
+        elif not isinstance(output, str):
+            result['rows'] = len(output)
+    except Exception as e:
+        result.update(status='failed', error=f"{type(e).__name__}: {e}")
+    result['peak_rss_mb'] = peak_memory_mb()
+    connection.send(result)
+    sys.stdout.close()
+
+
+def measure_stage(stage_name, work_dir, stand_in_models, low_memory=False):
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=stage_process, args=(stage_name, work_dir, stand_in_models, low_memory, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'status': 'failed', 'error': f"process exited with code {process.exitcode}", 'rows': None}
+    process.join()
+    return result
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results():
+    if not os.path.exists(RESULTS_FILE):
+        return []
+    with open(RESULTS_FILE, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def result_key(record):
+    """Runs with the same key are compared with each other."""
+    return record['scale'], record['stage'], record['models'], record.get('memory_mode', 'default')
+
+
+def print_summary(records, earlier_records):
+    """Prints this run next to the previous run of the same scale, stage, models and memory mode."""
+    previous = {}
+    for record in earlier_records:
+        if record['status'] == 'ok':
+            previous[result_key(record)] = record
+
+    print("\n--- Benchmark Results ---")
+    print(f"  {'scale':<6} {'stage':<20} {'memory':<8} {'status':<8} {'seconds':>9} {'rows/s':>11} "
+          f"{'peak MB':>9} {'vs previous':>14}")
+    for record in records:
+        seconds = f"{record['seconds']:.2f}" if record.get('seconds') is not None else '-'
+        rate = f"{record['rows_per_s']:.0f}" if record.get('rows_per_s') else '-'
+        memory = f"{record['peak_rss_mb']:.0f}" if record.get('peak_rss_mb') is not None else '-'
+        before = previous.get(result_key(record))
+        change = '-'
+        if before and record.get('seconds') is not None:
+            change = f"{record['seconds'] / before['seconds'] - 1:+.0%} ({before['commit']})"
+        print(f"  {record['scale']:<6} {record['stage']:<20} {record.get('memory_mode', 'default'):<8} {record['status']:<8} "
+              f"{seconds:>9} {rate:>11} {memory:>9} {change:>14}")
+        if record.get('error'):
+            print(f"         {record['error']}")
+
+
+def print_memory_comparison(records):
+    """Peak memory per stage in the default and the low-memory mode, side by side."""
+    peaks = {}
+    for record in records:
+        if record['status'] == 'ok' and record.get('peak_rss_mb') is not None:
+            peaks[(record['scale'], record['stage'], record['memory_mode'])] = record['peak_rss_mb']
+
+    print("\n--- Peak Memory: default -> low-memory ---")
+    for scale, stage, mode in peaks:
+        if mode == 'default' and (scale, stage, 'low') in peaks:
+            before, after = peaks[(scale, stage, 'default')], peaks[(scale, stage, 'low')]
+            print(f"  {scale:<6} {stage:<20} {before:>8.0f} MB -> {after:>6.0f} MB ({after / before - 1:+.0%})")
+
+
+def run_benchmark(scales, stages, stand_in_models=False, seed=42, keep=False, memory_modes=('default',)):
+    """
+    Generates the data for every scale, runs the stages and appends the
+    results to RESULTS_FILE. Each memory mode ('default', 'low') runs on its
+    own copy of the data, so caches of one mode do not speed up the other.
+    """
+    commit = current_commit()
+    earlier_records = load_results()
+    records = []
+
+    for scale in scales:
+        work_dir = tempfile.mkdtemp(prefix=f"benchmark_{scale}_")
+        print(f"\n=== Scale {scale} ({SCALES[scale]} rows) in '{work_dir}' ===")
+        generate_dataset(SCALES[scale], work_dir, seed)
+
+        for memory_mode in memory_modes:
+            mode_dir = work_dir
+            if len(memory_modes) > 1:
+                mode_dir = f"{work_dir}_{memory_mode}"
+                shutil.copytree(work_dir, mode_dir)
+
+            failed = set()
+            for stage_name in STAGE_NAMES:
+                if stage_name not in stages:
+                    continue
+                record = {
+                    'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                    'commit': commit,
+                    'scale': scale,
+                    'stage': stage_name,
+                    'models': 'stand-in' if stand_in_models else 'real',
+                    'memory_mode': memory_mode,
+                }
+                # Later stages read the output of the earlier ones
+                if failed:
+                    record.update(status='skipped', error=f"after failed {', '.join(sorted(failed))}")
+                else:
+                    print(f"Running {stage_name} ({memory_mode} memory)...")
+                    record.update(measure_stage(stage_name, mode_dir, stand_in_models, memory_mode == 'low'))
+                    if record['status'] != 'ok':
+                        failed.add(stage_name)
+                if record.get('rows') and record.get('seconds'):
+                    record['rows_per_s'] = record['rows'] / record['seconds']
+                records.append(record)
+
+            if mode_dir != work_dir:
+                if keep:
+                    print(f"Work directory kept: '{mode_dir}'")
+                else:
+                    shutil.rmtree(mode_dir, ignore_errors=True)
+
+        if keep:
+            print(f"Work directory kept: '{work_dir}'")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(RESULTS_FILE, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+    print_summary(records, earlier_records)
+    if len(memory_modes) > 1:
+        print_memory_comparison(records)
+    print(f"\nResults appended to '{RESULTS_FILE}'.")
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks every pipeline stage on synthetic data.")
+    parser.add_argument('--scale', action='append', choices=list(SCALES),
+                        help="data size to run (repeatable, default: 10k)")
+    parser.add_argument('--stage', action='append', choices=STAGE_NAMES,
+                        help="only run this stage (repeatable, default: all); "
+                             "the stages before it must be included too")
+    parser.add_argument('--stand-in-models', action='store_true',
+                        help="use tiny local stand-ins instead of the downloaded models (runs offline)")
+    parser.add_argument('--seed', type=int, default=42, help="seed of the synthetic data")
+    parser.add_argument('--keep', action='store_true', help="keep the generated data and stage logs")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="run the stages in low-memory mode (compact column types)")
+    parser.add_argument('--compare-memory', action='store_true',
+                        help="run every stage in the default and the low-memory mode and compare peak memory")
+    args = parser.parse_args()
+
+    if args.compare_memory:
+        memory_modes = ('default', 'low')
+    else:
+        memory_modes = ('low',) if args.low_memory else ('default',)
+
+    run_benchmark(
+        args.scale or ['10k'], args.stage or STAGE_NAMES,
+        stand_in_models=args.stand_in_models, seed=args.seed, keep=args.keep, memory_modes=memory_modes
+    )
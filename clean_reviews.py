@@ -1,8 +1,20 @@
 import json
 import os
+import re
+import sys
+
+from pipeline_state import load_state, save_state, mark_processed
+from stage_metrics import record_metrics
+from stage_files import (CLEAN_SCHEMA, RecordWriter, write_records, read_records, read_table, iter_table,
+                         table_columns, set_column)
+from near_duplicates import group_near_duplicates, group_near_duplicates_in_batches, has_text
+from comment_text import split_translation, detect_language, model_text, model_texts
 
 INPUT_FILE = 'terspegelt.json'
-OUTPUT_FILE = 'cleaned_reviews.json'
+OUTPUT_FILE = 'cleaned_reviews.parquet'
+
+# Number of characters read from the export per step in streaming mode
+STREAM_CHUNK_SIZE = 1 << 16
 
 # 1. Mapping to convert string ratings to numbers
 RATING_MAP = {
@@ -13,49 +25,82 @@ RATING_MAP = {
     "ONE": 1
 }
 
-def clean_review_data():
+# Matches the start of the top-level 'reviews' array in a Google Business Profile export
+REVIEWS_ARRAY_START = re.compile(r'"reviews"\s*:\s*\[')
+
+
+def iter_export_reviews(file_path, chunk_size=STREAM_CHUNK_SIZE):
     """
-    Reads the combined JSON file, cleans the data,
-    and saves it to a new file.
+    Yields the reviews of an export one by one without loading the whole file.
+
+    The file is read in chunks; each element of the 'reviews' array is decoded
+    as soon as it is complete, so memory use is bounded by a single review.
+    Raises ValueError if the file has no 'reviews' array or ends mid-review.
     """
-    
-    # --- 1. Load the file ---
-    if not os.path.exists(INPUT_FILE):
-        print(f"ERROR: File '{INPUT_FILE}' not found.")
-        print("Please run 'combined_reviews.py' first.")
-        return
+    decoder = json.JSONDecoder()
 
-    try:
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-    except json.JSONDecodeError:
-        print(f"ERROR: Could not read JSON from '{INPUT_FILE}'. Is the file corrupt?")
-        return
+    with open(file_path, 'r', encoding='utf-8') as f:
+        # --- 1. Skip ahead to the opening bracket of the 'reviews' array ---
+        buffer = ''
+        while True:
+            match = REVIEWS_ARRAY_START.search(buffer)
+            if match:
+                buffer = buffer[match.end():]
+                break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError("no 'reviews' list found")
+            # Keep a small tail so a key split over two chunks is still found
+            buffer = buffer[-32:] + chunk
 
-    if 'reviews' not in data or not isinstance(data['reviews'], list):
-        print(f"ERROR: '{INPUT_FILE}' does not have the expected structure (no 'reviews' list).")
-        return
+        # --- 2. Decode one array element at a time ---
+        eof = False
+        while True:
+            pos = 0
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            buffer = buffer[pos:]
+
+            if buffer.startswith(']'):
+                return
+
+            try:
+                review, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # The element is not complete yet: read more, or fail at the end of the file
+                if eof:
+                    raise ValueError("unexpected end of the 'reviews' list")
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer += chunk
+                continue
+
+            yield review
+            buffer = buffer[end:]
 
-    original_count = len(data['reviews'])
-    print(f"Starting cleaning process... {original_count} reviews found in '{INPUT_FILE}'.")
 
-    # --- 2. Clean data ---
-    cleaned_reviews_list = []
+def clean_reviews(reviews, stats):
+    """
+    Filters and converts raw reviews one at a time.
+
+    Yields the cleaned review objects and keeps the counters in 'stats'
+    ('total', 'duplicates', 'skipped') up to date. Only the set of seen
+    review IDs is kept in memory.
+    """
     processed_ids = set()  # Set to track duplicates
-    skipped_count = 0
-    duplicate_count = 0
 
-    for review in data['reviews']:
-        
+    for review in reviews:
+        stats['total'] += 1
+
         # 2a. Check for duplicates
         review_id_full = review.get('name')
         if not review_id_full:
             print("WARNING: Review found without 'name' (ID). Skipping.")
-            skipped_count += 1
+            stats['skipped'] += 1
             continue
-            
+
         if review_id_full in processed_ids:
-            duplicate_count += 1
+            stats['duplicates'] += 1
             continue  # This is a duplicate, skip
         processed_ids.add(review_id_full)
 
@@ -68,36 +113,284 @@ def clean_review_data():
 
         # 2d. Filter: Skip reviews without rating or name
         if not rating_int or not reviewer_name:
-            skipped_count += 1
+            stats['skipped'] += 1
             continue
 
-        # 2e. Build the new, clean object
-        cleaned_review = {
+        # 2e. Split Google translations from the text the reviewer wrote
+        comment = review.get('comment')  # Get review comment (if present)
+        comment_original, comment_translated = split_translation(comment)
+
+        # 2f. Build the new, clean object
+        yield {
             "reviewId": review_id_full.split('/')[-1],  # A shorter, cleaner ID
+            "locationId": location_id_of(review_id_full),  # Location the review belongs to
             "reviewerName": reviewer_name,
             "rating": rating_int,
             "createTime": review.get('createTime'),
-            "comment": review.get('comment'),  # Get review comment (if present)
+            "comment": comment,
+            "comment_original": comment_original,
+            "comment_translated": comment_translated,  # Google's translation (if any)
+            "comment_language": detect_language(comment_original),  # Language of the original
             "replyComment": review.get('reviewReply', {}).get('comment') # Get reply (if present)
         }
-        
-        cleaned_reviews_list.append(cleaned_review)
 
-    # --- 3. Save the result ---
-    cleaned_data_output = {"reviews": cleaned_reviews_list}
 
+def review_id_of(review):
+    """Returns the short review ID (last segment of 'name'), or None."""
+    review_id_full = review.get('name')
+    return review_id_full.split('/')[-1] if review_id_full else None
+
+
+def location_id_of(review_name):
+    """Returns the location ID from 'accounts/<a>/locations/<id>/reviews/<r>', or None."""
+    parts = review_name.split('/')
+    if 'locations' in parts[:-1]:
+        return parts[parts.index('locations') + 1]
+    return None
+
+
+def comment_groups(review_ids, comments):
+    """
+    The 'comment_group' of every review: the reviewId of the first review
+    whose model text ('comments', see 'comment_text.py') is identical or
+    nearly identical (see 'near_duplicates.py'), or None for reviews without
+    a comment. The sentiment and topic stages run their models once per group.
+    """
+    representatives = group_near_duplicates(comments)
+    groups = [review_ids[r] if r is not None else None for r in representatives]
+    report_groups(groups, len({c for c, group in zip(comments, groups) if group is not None}))
+    return groups
+
+
+def file_comment_groups(file_path):
+    """
+    comment_groups() for the clean reviews in a Parquet file. The comment
+    columns are read one row group at a time (twice, see
+    'near_duplicates.py'), so the texts of all reviews are never in memory together.
+    """
+    review_ids = read_table(file_path, columns=['reviewId'])['reviewId'].tolist()
+    text_hashes = set()
+
+    def read_batches():
+        for df_comments in iter_table(file_path, columns=['comment', 'comment_original', 'comment_translated']):
+            comments = model_texts(df_comments).tolist()
+            text_hashes.update(hash(c) for c in comments if has_text(c))
+            yield comments
+
+    representatives = group_near_duplicates_in_batches(read_batches)
+    groups = [review_ids[r] if r is not None else None for r in representatives]
+    report_groups(groups, len(text_hashes))
+    return groups
+
+
+def report_groups(groups, distinct_count):
+    """Records and prints how many model calls the comment groups save."""
+    # Identical comments were already scored once; the saving is in the near-duplicates
+    group_count = len(set(groups) - {None})
+    saved = distinct_count - group_count
+    record_metrics(comment_groups=group_count, inference_saved=saved)
+    print(f"  {distinct_count} distinct comments in {group_count} groups of near-identical text: "
+          f"{saved} model calls saved per model.")
+
+
+def add_comment_groups(reviews):
+    """Sets 'comment_group' on a list of cleaned reviews."""
+    groups = comment_groups(
+        [r['reviewId'] for r in reviews],
+        [model_text(r['comment_original'], r['comment_translated']) for r in reviews]
+    )
+    for review, group in zip(reviews, groups):
+        review['comment_group'] = group
+
+
+def filter_changed_reviews(reviews, processed_versions, current_versions):
+    """
+    Passes on only the reviews that are new or whose updateTime changed
+    compared to 'processed_versions'. The version of every review seen is
+    recorded in 'current_versions'.
+    """
+    for review in reviews:
+        review_id = review_id_of(review)
+        if review_id:
+            version = review.get('updateTime') or review.get('createTime')
+            current_versions[review_id] = version
+            if processed_versions.get(review_id) == version:
+                continue  # Unchanged since the last run
+        yield review
+
+
+def clean_review_data(stream=False, incremental=False, write=True):
+    """
+    Reads the combined JSON file, cleans the data,
+    and saves it to a new file (unless write=False).
+
+    Returns the list of cleaned reviews, or None if something went wrong.
+
+    The result is saved as a Parquet table (OUTPUT_FILE). With stream=True
+    the export is parsed incrementally and the cleaned reviews are written in
+    row groups as they come. They are not kept in memory; the path of the
+    output file is returned instead. The comment groups are added afterwards
+    from the comment columns, read back one row group at a time.
+
+    With incremental=True only reviews that are new or have a new updateTime
+    since the last run (see 'pipeline_state.py') are cleaned; they are merged
+    into the existing output file, which is always written.
+    """
+
+    # --- 1. Load the file ---
+    if not os.path.exists(INPUT_FILE):
+        print(f"ERROR: File '{INPUT_FILE}' not found.")
+        print("Please run 'combined_reviews.py' first.")
+        return
+
+    stats = {'total': 0, 'duplicates': 0, 'skipped': 0}
+    output_file = OUTPUT_FILE
+
+    if incremental:
+        return clean_incremental(output_file, stream, stats)
+
+    if stream:
+        print(f"Starting streaming cleaning process of '{INPUT_FILE}'...")
+    else:
+        try:
+            with open(INPUT_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except json.JSONDecodeError:
+            print(f"ERROR: Could not read JSON from '{INPUT_FILE}'. Is the file corrupt?")
+            return
+
+        if 'reviews' not in data or not isinstance(data['reviews'], list):
+            print(f"ERROR: '{INPUT_FILE}' does not have the expected structure (no 'reviews' list).")
+            return
+
+        print(f"Starting cleaning process... {len(data['reviews'])} reviews found in '{INPUT_FILE}'.")
+
+    # --- 2. Clean data and 3. save the result ---
+    # The versions are recorded so a later incremental run can start from here
+    current_versions = {}
     try:
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cleaned_data_output, f, indent=2, ensure_ascii=False)
-        
+        if stream:
+            reviews = filter_changed_reviews(iter_export_reviews(INPUT_FILE), {}, current_versions)
+            with RecordWriter(output_file, CLEAN_SCHEMA) as writer:
+                for cleaned_review in clean_reviews(reviews, stats):
+                    writer.write(cleaned_review)
+            clean_count = writer.count
+            set_column(output_file, 'comment_group', file_comment_groups(output_file))
+        else:
+            reviews = filter_changed_reviews(data['reviews'], {}, current_versions)
+            cleaned_reviews_list = list(clean_reviews(reviews, stats))
+            clean_count = len(cleaned_reviews_list)
+            add_comment_groups(cleaned_reviews_list)
+
+            if write:
+                write_records(cleaned_reviews_list, output_file, CLEAN_SCHEMA)
+
+        record_metrics(reviews_read=stats['total'], duplicates_dropped=stats['duplicates'],
+                       reviews_skipped=stats['skipped'])
+
         print("\n--- Cleaning Completed ---")
-        print(f"Total {original_count} reviews processed.")
-        print(f"  {duplicate_count} duplicates removed.")
-        print(f"  {skipped_count} reviews skipped (missing rating or name).")
-        print(f"**{len(cleaned_reviews_list)} clean reviews** saved in '{OUTPUT_FILE}'.")
+        print(f"Total {stats['total']} reviews processed.")
+        print(f"  {stats['duplicates']} duplicates removed.")
+        print(f"  {stats['skipped']} reviews skipped (missing rating or name).")
+        if stream or write:
+            print(f"**{clean_count} clean reviews** saved in '{output_file}'.")
+        else:
+            print(f"**{clean_count} clean reviews** ready.")
+
+        state = load_state()
+        state['reviews'] = current_versions
+        mark_processed(state, 'clean', current_versions)
+        save_state(state)
+
+        return output_file if stream else cleaned_reviews_list
 
+    except (ValueError, json.JSONDecodeError) as e:
+        print(f"ERROR: Could not read JSON from '{INPUT_FILE}' ({e}). Is the file corrupt?")
     except Exception as e:
-        print(f"\nERROR: Could not write clean file '{OUTPUT_FILE}': {e}")
+        print(f"\nERROR: Could not write clean file '{output_file}': {e}")
+
+
+def clean_incremental(output_file, stream, stats):
+    """
+    Cleans only new and updated reviews and merges them into 'output_file'.
+    Returns the merged list of cleaned reviews, or None on failure.
+    """
+    state = load_state()
+
+    # Without an earlier output everything has to be cleaned again
+    existing_reviews = []
+    processed_versions = state['stages'].get('clean', {})
+    if os.path.exists(output_file):
+        try:
+            if set(CLEAN_SCHEMA.names) - set(table_columns(output_file)):
+                print(f"Existing '{output_file}' misses columns of the current format. Cleaning everything.")
+                processed_versions = {}
+            else:
+                existing_reviews = read_records(output_file)
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Could not read existing '{output_file}' ({e}). Cleaning everything.")
+            processed_versions = {}
+    else:
+        processed_versions = {}
+
+    print(f"Starting incremental cleaning process of '{INPUT_FILE}'...")
+
+    current_versions = {}
+    try:
+        if stream:
+            reviews = iter_export_reviews(INPUT_FILE)
+        else:
+            with open(INPUT_FILE, 'r', encoding='utf-8') as f:
+                reviews = json.load(f)['reviews']
+        changed_reviews = list(clean_reviews(
+            filter_changed_reviews(reviews, processed_versions, current_versions), stats
+        ))
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"ERROR: Could not read JSON from '{INPUT_FILE}' ({e}). Is the file corrupt?")
+        return
+
+    # --- Merge: replace updated reviews in place, add new ones, drop removed ones ---
+    # Every changed review loses its old row first, so one that is now
+    # filtered out (e.g. its rating was removed) does not keep a stale row
+    changed_ids = {
+        review_id for review_id, version in current_versions.items()
+        if processed_versions.get(review_id) != version
+    }
+    removed_count = sum(1 for r in existing_reviews if r['reviewId'] not in current_versions)
+    merged = {
+        r['reviewId']: r for r in existing_reviews
+        if r['reviewId'] in current_versions and r['reviewId'] not in changed_ids
+    }
+    merged.update((r['reviewId'], r) for r in changed_reviews)
+    # Groups can span old and new reviews, so they are rebuilt over all of them
+    merged_reviews = list(merged.values())
+    add_comment_groups(merged_reviews)
+
+    try:
+        write_records(merged_reviews, output_file, CLEAN_SCHEMA)
+    except Exception as e:
+        print(f"\nERROR: Could not write clean file '{output_file}': {e}")
+        return
+
+    state['reviews'] = current_versions
+    mark_processed(state, 'clean', current_versions)
+    save_state(state)
+
+    record_metrics(reviews_read=len(current_versions), reviews_changed=stats['total'],
+                   duplicates_dropped=stats['duplicates'], reviews_skipped=stats['skipped'],
+                   reviews_removed=removed_count)
+
+    print("\n--- Incremental Cleaning Completed ---")
+    print(f"Total {len(current_versions)} reviews in export, {stats['total']} new or updated.")
+    print(f"  {stats['duplicates']} duplicates removed.")
+    print(f"  {stats['skipped']} reviews skipped (missing rating or name).")
+    print(f"  {removed_count} reviews no longer in the export removed.")
+    print(f"**{len(merged)} clean reviews** saved in '{output_file}'.")
+
+    return merged_reviews
 
 if __name__ == "__main__":
-    clean_review_data()
\ No newline at end of file
+    clean_review_data(
+        stream='--stream' in sys.argv[1:],
+        incremental='--incremental' in sys.argv[1:]
+    )
@@ -1,69 +1,233 @@
-import json
+import argparse
 import glob
+import hashlib
+import json
 import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from pipeline_fingerprints import file_digest
+
+OUTPUT_FILE = 'combined_reviews.json'
+
+# Bronbestanden: één glob-patroon of pad per regel in het manifest
+# ('#' is commentaar); zonder manifest worden DEFAULT_PATTERNS gebruikt
+MANIFEST_FILE = 'exports_manifest.txt'
+DEFAULT_PATTERNS = ['exports/*.json']
+
+# Uitvoer van de pipeline zelf, nooit een export
+EXCLUDED_FILES = {
+    'cleaned_reviews.json', 'reviews_met_sentiment.json', 'reviews_met_topics.json',
+    'final_data_for_powerbi.json', 'topic_model_meta.json', 'embeddings_index.json',
+    'weather_store.json', 'pipeline_fingerprints.json', 'pipeline_state.json'
+}
+
+# Per bronbestand de geparste reviews, zodat ongewijzigde bestanden niet opnieuw worden geparsed
+CACHE_DIR = 'combine_cache'
+CACHE_INDEX_FILE = os.path.join(CACHE_DIR, 'index.json')
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+
+def find_source_files(patterns=None, output_filename=OUTPUT_FILE):
+    """
+    Zoekt de exportbestanden via de patronen (of het manifest / DEFAULT_PATTERNS).
+    Geeft een gesorteerde lijst paden zonder dubbelen en zonder pipeline-uitvoer.
+    """
+    if not patterns:
+        if os.path.exists(MANIFEST_FILE):
+            with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+                patterns = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        else:
+            patterns = DEFAULT_PATTERNS
+
+    files = set()
+    for pattern in patterns:
+        files.update(glob.glob(pattern, recursive=True))
+
+    excluded = EXCLUDED_FILES | {os.path.basename(output_filename)}
+    return sorted(
+        os.path.normpath(path) for path in files
+        if os.path.basename(path) not in excluded
+        and os.path.normpath(path).split(os.sep)[0] != CACHE_DIR
+    )
+
+
+def cache_paths(file_path):
+    """Cachebestanden (reviews, versies) van één bronbestand."""
+    key = hashlib.sha256(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+    return (os.path.join(CACHE_DIR, f"{key}.reviews.pkl"),
+            os.path.join(CACHE_DIR, f"{key}.versions.pkl"))
+
+
+def review_version(review):
+    return review.get('updateTime') or review.get('createTime') or ''
+
+
+def parse_export(file_path):
+    """
+    Draait in een werkproces: leest één export en schrijft de reviews en per
+    review-'name' de versie (updateTime) naar de cache.
+    Geeft (aantal reviews, None) terug, of (None, foutmelding).
+    """
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except json.JSONDecodeError:
+        return None, "Kon JSON niet lezen. Is het een geldig JSON-bestand?"
+    except Exception as e:
+        return None, f"Onverwachte error: {e}"
 
-def combine_json_reviews(output_filename='combined_reviews.json'):
+    # Controleer of de structuur klopt (een 'reviews'-key met een lijst)
+    if not isinstance(data, dict) or not isinstance(data.get('reviews'), list):
+        return None, "Heeft geen 'reviews'-lijst."
+
+    reviews = data['reviews']
+    versions = [(review.get('name'), review_version(review)) for review in reviews]
+
+    reviews_file, versions_file = cache_paths(file_path)
+    for path, content in ((reviews_file, reviews), (versions_file, versions)):
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+    return len(reviews), None
+
+
+def load_cache_index():
+    if not os.path.exists(CACHE_INDEX_FILE):
+        return {'files': {}, 'output': None}
+    with open(CACHE_INDEX_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_cache_index(index):
+    with open(CACHE_INDEX_FILE + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+    os.replace(CACHE_INDEX_FILE + '.tmp', CACHE_INDEX_FILE)
+
+
+def load_cached(file_path, which):
+    """Laadt de gecachete reviews (which=0) of versies (which=1) van een bronbestand."""
+    with open(cache_paths(file_path)[which], 'rb') as f:
+        return pickle.load(f)
+
+
+def combine_json_reviews(output_filename=OUTPUT_FILE, patterns=None, workers=DEFAULT_WORKERS):
     """
-    Zoekt naar alle .json-bestanden in de huidige map, 
-    leest de 'reviews'-lijsten en voegt ze samen in één nieuw bestand.
+    Leest de exportbestanden (patronen, manifest of DEFAULT_PATTERNS) en voegt
+    hun 'reviews'-lijsten samen in één nieuw bestand.
+
+    Gewijzigde bestanden worden parallel in werkprocessen geparsed; voor
+    ongewijzigde bestanden (zelfde inhoud) wordt de cache gebruikt. Reviews
+    met dezelfde 'name' komen één keer in het resultaat, in de nieuwste versie.
+    Geeft het aantal samengevoegde reviews terug, of None bij een fout.
     """
-    
-    # Zoek alle json-bestanden in de map waar het script draait
-    json_files = glob.glob('*.json')
-    
-    # Zorg ervoor dat we het output-bestand niet per ongeluk meenemen
-    # als het al bestaat van een eerdere uitvoering.
-    if output_filename in json_files:
-        json_files.remove(output_filename)
-
-    print(f"Gevonden JSON-bestanden om te verwerken: {json_files}")
-
-    all_reviews_list = []
-    files_processed = 0
+    json_files = find_source_files(patterns, output_filename)
+    if not json_files:
+        print("FOUT: Geen exportbestanden gevonden.")
+        print(f"Zet de exports in '{DEFAULT_PATTERNS[0]}' of zet patronen in '{MANIFEST_FILE}'.")
+        return
+
+    print(f"Gevonden exportbestanden om te verwerken: {len(json_files)}")
+
+    # --- 1. Vergelijk de vingerafdrukken met de cache ---
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    index = load_cache_index()
+    digests = {path: file_digest(path) for path in json_files}
+
+    to_parse = [
+        path for path in json_files
+        if index['files'].get(path, {}).get('digest') != digests[path]
+        or not all(os.path.exists(p) for p in cache_paths(path))
+    ]
+    print(f"{len(json_files) - len(to_parse)} bestand(en) ongewijzigd (cache), {len(to_parse)} te parsen.")
+
+    # --- 2. Parse de gewijzigde bestanden parallel ---
     files_failed = []
+    if to_parse:
+        if workers > 1 and len(to_parse) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(to_parse))) as executor:
+                results = list(executor.map(parse_export, to_parse))
+        else:
+            results = [parse_export(path) for path in to_parse]
+
+        for path, (count, error) in zip(to_parse, results):
+            if error:
+                print(f"WAARSCHUWING: {path}: {error} Wordt overgeslagen.")
+                files_failed.append(path)
+                index['files'].pop(path, None)
+            else:
+                index['files'][path] = {'digest': digests[path], 'reviews': count}
+
+    # Bestanden die niet meer gevonden worden uit de cache halen
+    for path in set(index['files']) - set(json_files):
+        for cache_file in cache_paths(path):
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+        del index['files'][path]
+
+    sources = [path for path in json_files if path not in files_failed]
+    source_state = {path: digests[path] for path in sources}
+    if index.get('output') == {'file': output_filename, 'sources': source_state} and os.path.exists(output_filename):
+        save_cache_index(index)
+        print(f"\nNiets gewijzigd, '{output_filename}' is al actueel.")
+        return index.get('output_reviews')
 
-    # Loop door elk gevonden bestand
-    for file_path in json_files:
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-                # Controleer of de structuur klopt (een 'reviews'-key met een lijst)
-                if 'reviews' in data and isinstance(data['reviews'], list):
-                    all_reviews_list.extend(data['reviews'])
-                    files_processed += 1
-                else:
-                    print(f"WAARSCHUWING: Bestand {file_path} heeft geen 'reviews'-lijst. Wordt overgeslagen.")
-                    files_failed.append(file_path)
-                    
-        except json.JSONDecodeError:
-            print(f"FOUT: Kon JSON niet lezen uit {file_path}. Is het een geldig JSON-bestand? Wordt overgeslagen.")
-            files_failed.append(file_path)
-        except Exception as e:
-            print(f"FOUT: Onverwachte error bij verwerken van {file_path}: {e}. Wordt overgeslagen.")
-            files_failed.append(file_path)
-
-    # Maak de nieuwe datastructuur voor het gecombineerde bestand
-    combined_data = {"reviews": all_reviews_list}
-
-    # Schrijf de gecombineerde data naar het nieuwe bestand
+    # --- 3. Bepaal per review-'name' de nieuwste versie over alle bestanden ---
+    newest = {}
+    for file_nr, path in enumerate(sources):
+        for position, (name, version) in enumerate(load_cached(path, 1)):
+            if not name:
+                continue
+            best = newest.get(name)
+            if best is None or version > best[0]:
+                newest[name] = (version, file_nr, position)
+    duplicates = sum(index['files'][path]['reviews'] for path in sources) - len(newest)
+
+    # --- 4. Schrijf de reviews bestand voor bestand weg ---
+    total = 0
     try:
-        with open(output_filename, 'w', encoding='utf-8') as f:
-            # 'indent=2' maakt het bestand leesbaar
-            # 'ensure_ascii=False' zorgt dat speciale tekens goed worden opgeslagen
-            json.dump(combined_data, f, indent=2, ensure_ascii=False)
-        
-        print("\n--- Voltooid ---")
-        print(f"Succesvol {files_processed} bestand(en) verwerkt.")
-        print(f"Totaal aantal reviews samengevoegd: {len(all_reviews_list)}")
-        print(f"Resultaat opgeslagen in: {output_filename}")
-        
-        if files_failed:
-            print(f"\nMislukt of overgeslagen: {len(files_failed)} bestand(en): {files_failed}")
-            
+        with open(output_filename + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('{"reviews": [\n')
+            for file_nr, path in enumerate(sources):
+                for position, review in enumerate(load_cached(path, 0)):
+                    name = review.get('name')
+                    # Reviews zonder 'name' gaan mee; 'clean_reviews.py' slaat ze over
+                    if name and newest[name][1:] != (file_nr, position):
+                        continue
+                    if total:
+                        f.write(',\n')
+                    # 'ensure_ascii=False' zorgt dat speciale tekens goed worden opgeslagen
+                    f.write(json.dumps(review, ensure_ascii=False))
+                    total += 1
+            f.write('\n]}\n')
+        os.replace(output_filename + '.tmp', output_filename)
     except Exception as e:
         print(f"\nFOUT: Kon het gecombineerde bestand niet wegschrijven: {e}")
+        return
+
+    index['output'] = {'file': output_filename, 'sources': source_state}
+    index['output_reviews'] = total
+    save_cache_index(index)
+
+    print("\n--- Voltooid ---")
+    print(f"Succesvol {len(sources)} bestand(en) verwerkt.")
+    print(f"Totaal aantal reviews samengevoegd: {total} ({duplicates} dubbele verwijderd)")
+    print(f"Resultaat opgeslagen in: {output_filename}")
+
+    if files_failed:
+        print(f"\nMislukt of overgeslagen: {len(files_failed)} bestand(en): {files_failed}")
+
+    return total
 
 # --- Voer de functie uit als het script direct wordt gerund ---
 if __name__ == "__main__":
-    combine_json_reviews()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Voegt Google-review-exports samen tot één bestand.")
+    parser.add_argument('patterns', nargs='*',
+                        help=f"glob-patronen van de exports (standaard: '{MANIFEST_FILE}' of {DEFAULT_PATTERNS})")
+    parser.add_argument('--output', default=OUTPUT_FILE, help="naam van het gecombineerde bestand")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="aantal werkprocessen voor het parsen")
+    args = parser.parse_args()
+
+    combine_json_reviews(args.output, patterns=args.patterns, workers=args.workers)
@@ -0,0 +1,78 @@
+import re
+
+# Google Business Profile adds its machine translation to a review in one of two forms:
+#   "<original>\n\n(Translated by Google)\n<translation>"
+#   "(Translated by Google) <translation>\n\n(Original)\n<original>"
+TRANSLATED_MARKER = '(Translated by Google)'
+ORIGINAL_MARKER = '(Original)'
+
+# Text of a translated comment that the sentiment and topic models get:
+# 'original' (what the reviewer wrote) or 'translated' (Google's translation)
+MODEL_TEXT_VARIANT = 'original'
+
+# Frequent words per language; a text gets the language with the most of them
+LANGUAGE_WORDS = {
+    'nl': set("de het een en van ik je niet dat die is was zijn met voor op ook maar heel erg zeer "
+              "wij we er naar bij lekker gezellig goed mooi vriendelijk personeel".split()),
+    'en': set("the and a an of to is was it i we you they with for on not but very this that are "
+              "were great nice good friendly staff".split()),
+    'de': set("der die das und ein eine ist war ich wir nicht mit für auf sehr auch aber es sind "
+              "waren schön gut freundlich personal".split()),
+    'fr': set("le la les et un une est était je nous pas avec pour sur très aussi mais il sont "
+              "étaient bien bon beau sympa personnel".split()),
+}
+# Fewer matching words than this: language unknown
+MIN_LANGUAGE_WORDS = 2
+
+WORD = re.compile(r'\w+')
+
+
+def split_translation(comment):
+    """
+    Splits a comment into (original, translated). 'translated' is None when
+    Google did not translate the comment; 'original' is then the comment.
+    """
+    if not comment or TRANSLATED_MARKER not in comment:
+        return comment, None
+
+    before, after = comment.split(TRANSLATED_MARKER, 1)
+    if ORIGINAL_MARKER in after:
+        translated, original = after.split(ORIGINAL_MARKER, 1)
+    else:
+        original, translated = before, after
+    original, translated = original.strip(), translated.strip()
+
+    # A marker without text on one side: keep what there is as the original
+    if not original:
+        return translated or None, None
+    return original, translated or None
+
+
+def detect_language(text):
+    """Language code of the text ('nl', 'en', 'de', 'fr'), or None if unsure."""
+    if not text:
+        return None
+    words = WORD.findall(text.lower())
+    counts = {language: sum(word in vocabulary for word in words) for language, vocabulary in LANGUAGE_WORDS.items()}
+    language = max(counts, key=counts.get)
+    return language if counts[language] >= MIN_LANGUAGE_WORDS else None
+
+
+def model_text(original, translated):
+    """The variant of a comment the models get (see MODEL_TEXT_VARIANT)."""
+    if MODEL_TEXT_VARIANT == 'translated' and translated:
+        return translated
+    return original
+
+
+def model_texts(df):
+    """
+    The model text of every row of a reviews DataFrame. Tables from before
+    the split (without 'comment_original') fall back to the full comment.
+    """
+    if 'comment_original' not in df.columns:
+        return df['comment']
+    texts = df['comment_original']
+    if MODEL_TEXT_VARIANT == 'translated':
+        texts = df['comment_translated'].where(df['comment_translated'].notna(), texts)
+    return texts.where(texts.notna(), df['comment'])
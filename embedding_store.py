@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Persistent store of sentence embeddings, one row per distinct comment
+EMBEDDINGS_FILE = 'embeddings.bin'
+INDEX_FILE = 'embeddings_index.json'
+DEFAULT_DTYPE = 'float16'
+
+
+def text_key(text):
+    """Content address of a comment."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Append-only matrix of embeddings in a memory-mapped file, indexed by the
+    hash of the comment text.
+
+    The index file records the model name, vector size, dtype and the key of
+    every row. When the model changes the store is started over.
+    """
+
+    def __init__(self, model_name, dtype=DEFAULT_DTYPE,
+                 embeddings_file=EMBEDDINGS_FILE, index_file=INDEX_FILE):
+        self.model_name = model_name
+        self.dtype = np.dtype(dtype)
+        self.embeddings_file = embeddings_file
+        self.index_file = index_file
+        self.dim = None
+        self.keys = []
+
+        if os.path.exists(index_file) and os.path.exists(embeddings_file):
+            with open(index_file, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('model') == model_name and index.get('dtype') == self.dtype.name:
+                self.dim = index['dim']
+                self.keys = index['keys']
+            else:
+                print("Embedding store: model or dtype changed, starting a new store.")
+
+        if self.keys:
+            # Drop rows written after the last saved index (interrupted run)
+            expected_size = len(self.keys) * self.dim * self.dtype.itemsize
+            if os.path.getsize(embeddings_file) > expected_size:
+                os.truncate(embeddings_file, expected_size)
+        elif os.path.exists(embeddings_file):
+            os.remove(embeddings_file)
+
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def matrix(self):
+        """Read-only memory map of all stored embeddings."""
+        if not self.keys:
+            return np.empty((0, self.dim or 0), dtype=self.dtype)
+        return np.memmap(self.embeddings_file, dtype=self.dtype, mode='r',
+                         shape=(len(self.keys), self.dim))
+
+    def embed(self, texts, encode):
+        """
+        Returns a float32 matrix with one embedding per text (in order).
+
+        Only texts that are not in the store yet are passed to
+        'encode(list_of_texts) -> 2D array'; their vectors are appended to
+        the store. 'encode' is not called at all when everything is known.
+        """
+        keys = [text_key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self.rows and key not in missing:
+                missing[key] = text
+
+        print(f"Embedding store: {len(texts) - sum(k in missing for k in keys)} of {len(texts)} "
+              f"comments already embedded, {len(missing)} new.")
+
+        if missing:
+            new_vectors = np.asarray(encode(list(missing.values())), dtype=np.float32)
+            self.append(list(missing), new_vectors)
+
+        rows = np.fromiter((self.rows[key] for key in keys), dtype=np.int64, count=len(keys))
+        return np.asarray(self.matrix()[rows], dtype=np.float32)
+
+    def append(self, keys, vectors):
+        """Adds rows to the end of the file and saves the index."""
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"expected vectors of size {self.dim}, got {vectors.shape[1]}")
+
+        with open(self.embeddings_file, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype=self.dtype).tobytes())
+
+        for key in keys:
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({"model": self.model_name, "dim": self.dim,
+                       "dtype": self.dtype.name, "keys": self.keys}, f)
+        os.replace(tmp_file, self.index_file)
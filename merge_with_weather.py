@@ -1,93 +1,233 @@
+import argparse
+import hashlib
 import pandas as pd
 import json
 import os
-import numpy as np
+import textwrap
 
-# File names
-INPUT_REVIEWS = 'reviews_met_topics.json'
+from pipeline_state import load_state, save_state, stale_review_ids, mark_processed
+from stage_files import read_table, table_columns, compact_frame, iso_times, FLOAT32_EXACT_COLUMNS
+from station_lookup import build_station_index, DEFAULT_STATION
+from weather_store import WeatherStore, review_days
+from powerbi_export import export_star_schema, MANIFEST_FILE
+
+# File names; the inputs are Parquet tables, the output is JSON for Power BI
+INPUT_REVIEWS = 'reviews_met_sentiment.parquet'
+INPUT_TOPICS = 'reviews_met_topics.parquet'
 INPUT_WEATHER = 'weather_data.csv'
 OUTPUT_FILE = 'final_data_for_powerbi.json'
 
-def merge_data():
+# 'json': one JSON file (OUTPUT_FILE); 'star': month-partitioned Parquet star
+# schema (see 'powerbi_export.py'); 'both': write both
+EXPORT_FORMATS = ['json', 'star', 'both']
+
+# Reviews converted to JSON objects at a time
+JSON_CHUNK_ROWS = 10000
+
+# Weather columns added to every review (when present in the weather store)
+WEATHER_FEATURES = [
+    'temp_max_c', 'precip_amount_mm', 'temp_avg_c',
+    'precip_3d_mm', 'precip_7d_mm', 'temp_anomaly_c'
+]
+
+def load_reviews_file(file_path, columns=None, low_memory=False):
+    """Reads (the given columns of) an intermediate table, or returns None."""
+    if not os.path.exists(file_path):
+        print(f"ERROR: '{file_path}' not found.")
+        return None
+
+    return read_table(file_path, columns=columns, low_memory=low_memory)
+
+
+def json_records(df):
+    """
+    The rows of 'df' as dicts for JSON: missing values as None. The compact
+    types of low-memory mode are written like the default ones: timestamps
+    as the original ISO text, float32 by its shortest representation (model
+    scores exactly, see FLOAT32_EXACT_COLUMNS) and nullable integers with
+    missing values as floats (in default mode those columns are float64).
+    """
+    df = df.copy(deep=False)
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.DatetimeTZDtype):
+            df[column] = iso_times(df[column])
+        elif df[column].dtype == 'float32' and column in FLOAT32_EXACT_COLUMNS:
+            df[column] = df[column].astype('float64')
+        elif df[column].dtype == 'float32':
+            df[column] = df[column].astype(str).astype('float64')
+        elif df[column].dtype.kind == 'i' and df[column].isna().any():
+            df[column] = df[column].astype('float64')
+    df = df.astype(object)
+    return df.where(df.notna(), None).to_dict('records')
+
+
+def write_json_export(df_final, file_path):
+    """
+    Writes {"reviews": [...]} like json.dump(..., indent=2), but converts
+    JSON_CHUNK_ROWS reviews at a time instead of copying the whole frame.
+    """
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write('{\n  "reviews": [')
+        for start in range(0, len(df_final), JSON_CHUNK_ROWS):
+            for i, record in enumerate(json_records(df_final.iloc[start:start + JSON_CHUNK_ROWS])):
+                separator = '\n' if start + i == 0 else ',\n'
+                f.write(separator + textwrap.indent(json.dumps(record, indent=2, ensure_ascii=False), '    '))
+        f.write('\n  ]\n}' if len(df_final) else ']\n}')
+
+
+def output_file(export='json'):
+    """The file that shows whether the export in format 'export' is up to date."""
+    return MANIFEST_FILE if export == 'star' else OUTPUT_FILE
+
+
+def merge_data(df_reviews=None, df_topics=None, df_weather=None, incremental=False, write=True, export='json',
+               low_memory=False):
+    """
+    Joins the topic columns onto the reviews with sentiment (by 'reviewId')
+    and adds the weather of the local review day, measured at the KNMI
+    station nearest to the review's location, to every review.
+
+    df_reviews / df_topics / df_weather: the input DataFrames; when not given
+    they are loaded from INPUT_REVIEWS, INPUT_TOPICS and the weather store
+    (or INPUT_WEATHER if there is no store yet).
+    write: save the result (always done in incremental mode) in the format
+    'export' (see EXPORT_FORMATS).
+    low_memory: keep the reviews in compact column types (see 'stage_files.py').
+    Returns the final DataFrame, or None if something went wrong.
+
+    With incremental=True the export is only rewritten when it changed
+    since the last run (see export_up_to_date); the weather is still looked
+    up for every review.
+    """
     print("Starting integration with weather data...")
 
-    # 1. Load reviews
-    if not os.path.exists(INPUT_REVIEWS):
-        print(f"ERROR: '{INPUT_REVIEWS}' not found.")
-        return
-        
-    with open(INPUT_REVIEWS, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    df_reviews = pd.DataFrame.from_records(data['reviews'])
+    # 1. Load reviews and combine sentiment and topics
+    if df_reviews is None:
+        df_reviews = load_reviews_file(INPUT_REVIEWS, low_memory=low_memory)
+        if df_reviews is None:
+            return
+    elif low_memory:
+        df_reviews = compact_frame(df_reviews)
     print(f"{len(df_reviews)} reviews loaded.")
 
-    # 2. Load weather data
-    if not os.path.exists(INPUT_WEATHER):
-        print(f"ERROR: '{INPUT_WEATHER}' not found.")
-        return
-        
-    df_weather = pd.read_csv(INPUT_WEATHER)
-    print(f"{len(df_weather)} days of weather data loaded.")
-    
-    # DEBUG: Show found columns
-    print(f"Weather columns found: {list(df_weather.columns)}")
-
-    # 3. Clean and prepare for merge
-    # Extract date from 'createTime' (YYYY-MM-DD)
-    df_reviews['datum'] = df_reviews['createTime'].str[:10]
-    
-    # FIX 1: Check specifically for lowercase 'date' and rename to 'datum'
-    if 'date' in df_weather.columns:
-        df_weather = df_weather.rename(columns={'date': 'datum'})
-    elif 'Date' in df_weather.columns:
-        df_weather = df_weather.rename(columns={'Date': 'datum'})
-        
-    # Check if rename was successful
-    if 'datum' not in df_weather.columns:
-        print("ERROR: Could not find 'date' column in weather CSV.")
-        return
-
-    # Ensure date columns are strings for matching
-    df_weather['datum'] = df_weather['datum'].astype(str)
-
-    # 4. Merge on date
-    print("Merging data based on date...")
-    
-    # FIX 2: Use the exact column names from your CSV file
-    # We want: 'datum' + max temp + precipitation
-    weather_cols_to_keep = ['datum']
-    
-    if 'temp_max_c' in df_weather.columns:
-        weather_cols_to_keep.append('temp_max_c')
-    if 'precip_amount_mm' in df_weather.columns:
-        weather_cols_to_keep.append('precip_amount_mm')
-    if 'temp_avg_c' in df_weather.columns:
-        weather_cols_to_keep.append('temp_avg_c')
-
-    # Merge!
-    df_final = pd.merge(
-        df_reviews, 
-        df_weather[weather_cols_to_keep], 
-        on='datum', 
-        how='left'
-    )
-    
-    # Remove temporary date column used for merging
-    df_final = df_final.drop(columns=['datum'])
-    
+    if df_topics is None:
+        # Only read the columns the topic stage added
+        if not os.path.exists(INPUT_TOPICS):
+            print(f"ERROR: '{INPUT_TOPICS}' not found.")
+            return
+        topic_cols = [c for c in table_columns(INPUT_TOPICS) if c not in df_reviews.columns]
+        df_topics = load_reviews_file(INPUT_TOPICS, columns=['reviewId'] + topic_cols)
+    else:
+        topic_cols = [c for c in df_topics.columns if c not in df_reviews.columns]
+
+    df_reviews = df_reviews.merge(df_topics[['reviewId'] + topic_cols], on='reviewId', how='left')
+    print(f"Topic columns added: {topic_cols}")
+
+    # 2. Load the weather store (built by parse_weather.py)
+    if df_weather is not None:
+        store = WeatherStore.from_frame(df_weather)
+    else:
+        store = WeatherStore.load()
+        if store is None:
+            # No store yet: build it from the parsed CSV
+            if not os.path.exists(INPUT_WEATHER):
+                print(f"ERROR: '{INPUT_WEATHER}' not found.")
+                return
+            store = WeatherStore.from_frame(pd.read_csv(INPUT_WEATHER))
+    print(f"{store.n_days} days of weather data loaded for station(s) {store.stations.tolist()}.")
+
+    weather_cols = [c for c in WEATHER_FEATURES if c in store.features]
+    print(f"Weather columns added: {weather_cols}")
+
+    # 3. Assign every review the weather station nearest to its location
+    station_index = None
+    if 'locationId' in df_reviews.columns:
+        station_index = build_station_index(df_reviews['locationId'], store.stations)
+        print(f"Weather station per location:\n{station_index.to_string()}")
+        df_reviews['weather_station'] = (
+            df_reviews['locationId'].map(station_index['station']).fillna(DEFAULT_STATION).astype(int)
+        )
+    else:
+        print(f"WARNING: Reviews have no 'locationId', using station {DEFAULT_STATION} for all.")
+        df_reviews['weather_station'] = DEFAULT_STATION
+
+    # 4. Look up the weather of the local review day at the review's station
+    print("Looking up weather by station and day...")
+    days = review_days(df_reviews['createTime'])
+    df_weather_rows = store.lookup(df_reviews['weather_station'], days, weather_cols)
+    df_weather_rows.index = df_reviews.index
+    df_final = df_reviews.join(df_weather_rows)
+
+    if low_memory:
+        df_final = compact_frame(df_final)
     print(f"Final DataFrame ready with {len(df_final.columns)} columns.")
 
+    # Incremental: the export is always written, unless nothing changed
+    rewrite = write or incremental
+    if incremental:
+        state = load_state()
+        weather_digest = store.digest()
+        export_digest = frame_digest(df_final)
+        if export_up_to_date(state, df_final, weather_digest, export_digest, export):
+            print("Incremental mode: nothing changed since the last run, the export is not rewritten.")
+            rewrite = False
+
     # 5. Save final file
-    print(f"Saving to '{OUTPUT_FILE}'...")
-    
-    # Convert NaN to None (null) for Power BI compatibility
-    df_final_for_json = df_final.replace({np.nan: None})
-    output_data = {"reviews": df_final_for_json.to_dict('records')}
-    
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(output_data, f, indent=2, ensure_ascii=False)
+    if rewrite and export in ('json', 'both'):
+        print(f"Saving to '{OUTPUT_FILE}'...")
+
+        # NaN becomes None (null) for Power BI compatibility
+        write_json_export(df_final, OUTPUT_FILE)
+
+        print(f"\nDone! '{OUTPUT_FILE}' is the final file for Power BI.")
 
-    print(f"\nDone! '{OUTPUT_FILE}' is the final file for Power BI.")
+    # 5b. Or as a star schema with one partition per month
+    if rewrite and export in ('star', 'both'):
+        print("Saving the star schema for Power BI...")
+        export_star_schema(df_final, weather_cols, station_index)
+
+    if incremental:
+        mark_processed(state, 'merge', df_final['reviewId'])
+        state['weather_digest'] = weather_digest
+        state['export_digest'] = export_digest
+        save_state(state)
+
+    return df_final
+
+
+def frame_digest(df):
+    """SHA-256 of the contents of a DataFrame (column names and values)."""
+    digest = hashlib.sha256(json.dumps([str(c) for c in df.columns]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def export_up_to_date(state, df_final, weather_digest, export_digest, export='json'):
+    """
+    Whether the previous export in format 'export' can be kept: it exists,
+    no review was added, updated or removed and the weather store did not
+    change since the last run ('weather_digest', see WeatherStore.digest),
+    and the merged reviews are the same ('export_digest', see frame_digest;
+    this catches changed topic or sentiment columns).
+    """
+    files = [OUTPUT_FILE, MANIFEST_FILE] if export == 'both' else [output_file(export)]
+    if not all(os.path.exists(f) for f in files):
+        return False
+    if state.get('weather_digest') != weather_digest or state.get('export_digest') != export_digest:
+        return False
+    review_ids = df_final['reviewId']
+    if stale_review_ids(state, 'merge', review_ids):
+        return False
+    return set(state['stages'].get('merge', {})) == set(review_ids)
 
 if __name__ == "__main__":
-    merge_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Adds topics and weather to the reviews and exports them for Power BI.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only rewrite the export when it changed since the last run")
+    parser.add_argument('--export', choices=EXPORT_FORMATS, default='json',
+                        help="'star' writes month-partitioned Parquet fact and dimension tables")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="keep the reviews in compact column types")
+    args = parser.parse_args()
+
+    merge_data(incremental=args.incremental, export=args.export, low_memory=args.low_memory)
@@ -0,0 +1,64 @@
+import os
+from multiprocessing.connection import Client, AuthenticationError
+
+# Address of 'model_server.py'; the server writes a fresh key to AUTHKEY_FILE on start
+SERVER_ADDRESS = ('127.0.0.1', 6011)
+AUTHKEY_FILE = 'model_server.key'
+
+# Texts per request, keeps single messages small
+REQUEST_CHUNK = 2048
+
+
+def connect():
+    """
+    Connects to a running model server, or returns None when there is none
+    (or when the environment variable MODEL_SERVER is set to 'off').
+    """
+    if os.environ.get('MODEL_SERVER', '').lower() == 'off' or not os.path.exists(AUTHKEY_FILE):
+        return None
+    try:
+        with open(AUTHKEY_FILE, 'rb') as f:
+            authkey = f.read()
+        return Client(SERVER_ADDRESS, authkey=authkey)
+    except (OSError, EOFError, AuthenticationError):
+        return None
+
+
+def request_chunks(op, model, texts, **options):
+    """
+    Sends 'texts' in chunks to the server and returns the concatenated
+    results, or None if there is no server or it could not do the work.
+    """
+    connection = connect()
+    if connection is None:
+        return None
+
+    results = []
+    try:
+        with connection:
+            for start in range(0, len(texts), REQUEST_CHUNK):
+                connection.send({'op': op, 'model': model, 'texts': texts[start:start + REQUEST_CHUNK], **options})
+                reply = connection.recv()
+                if not reply.get('ok'):
+                    print(f"Model server: {reply.get('error')}. Loading the model in-process instead.")
+                    return None
+                results.append(reply['result'])
+    except (OSError, EOFError) as e:
+        print(f"Model server stopped answering ({e}). Loading the model in-process instead.")
+        return None
+    return results
+
+
+def remote_score(texts, model_id, batch_size):
+    """Sentiment of every text from the server ({'label', 'score'} dicts), or None."""
+    chunks = request_chunks('score', model_id, texts, batch_size=batch_size)
+    return None if chunks is None else [result for chunk in chunks for result in chunk]
+
+
+def remote_embed(texts, model_name):
+    """Embedding matrix of the texts from the server, or None."""
+    chunks = request_chunks('embed', model_name, texts)
+    if chunks is None:
+        return None
+    import numpy as np
+    return np.concatenate(chunks) if chunks else np.empty((0, 0), dtype=np.float32)
@@ -0,0 +1,137 @@
+import argparse
+import os
+import threading
+import time
+from multiprocessing.connection import Listener, AuthenticationError
+
+import numpy as np
+
+import analyse_sentiment
+import analyse_topics
+from model_client import SERVER_ADDRESS, AUTHKEY_FILE
+from sentiment_inference import (
+    load_sentiment_pipeline, score_in_buckets, model_id, BACKENDS, DEFAULT_BACKEND, DEFAULT_BATCH_SIZE
+)
+
+
+class ModelHost:
+    """
+    Keeps the sentiment pipeline and the sentence transformer loaded and
+    serves requests for them. Each model is used by one request at a time.
+    """
+
+    def __init__(self, backend=DEFAULT_BACKEND, threads=None):
+        self.backend = backend
+        self.threads = threads
+        self.sentiment_id = model_id(analyse_sentiment.MODEL_NAME, analyse_sentiment.MODEL_REVISION, backend)
+        self.embedding_name = analyse_topics.EMBEDDING_MODEL_NAME
+        self.sentiment_pipeline = None
+        self.embedding_model = None
+        self.sentiment_lock = threading.Lock()
+        self.embedding_lock = threading.Lock()
+
+    def load_sentiment(self):
+        if self.sentiment_pipeline is None:
+            start_time = time.perf_counter()
+            self.sentiment_pipeline = load_sentiment_pipeline(
+                analyse_sentiment.MODEL_NAME, analyse_sentiment.MODEL_REVISION, self.threads, self.backend
+            )
+            print(f"Sentiment model '{self.sentiment_id}' loaded in {time.perf_counter() - start_time:.1f} s.")
+        return self.sentiment_pipeline
+
+    def load_embedding(self):
+        if self.embedding_model is None:
+            start_time = time.perf_counter()
+            self.embedding_model = analyse_topics.load_embedding_model()
+            print(f"Embedding model '{self.embedding_name}' loaded in {time.perf_counter() - start_time:.1f} s.")
+        return self.embedding_model
+
+    def handle(self, message):
+        """Answers one request with {'ok': True, 'result': ...} or {'ok': False, 'error': ...}."""
+        op = message.get('op')
+        if op == 'score':
+            if message.get('model') != self.sentiment_id:
+                return {'ok': False, 'error': f"serves '{self.sentiment_id}', not '{message.get('model')}'"}
+            with self.sentiment_lock:
+                results = score_in_buckets(
+                    self.load_sentiment(), message['texts'], message.get('batch_size', DEFAULT_BATCH_SIZE)
+                )
+            return {'ok': True, 'result': results}
+
+        if op == 'embed':
+            if message.get('model') != self.embedding_name:
+                return {'ok': False, 'error': f"serves '{self.embedding_name}', not '{message.get('model')}'"}
+            with self.embedding_lock:
+                vectors = self.load_embedding().encode(message['texts'], show_progress_bar=False)
+            return {'ok': True, 'result': np.asarray(vectors, dtype=np.float32)}
+
+        if op == 'info':
+            return {'ok': True, 'result': {
+                'sentiment': self.sentiment_id, 'sentiment_loaded': self.sentiment_pipeline is not None,
+                'embedding': self.embedding_name, 'embedding_loaded': self.embedding_model is not None
+            }}
+
+        return {'ok': False, 'error': f"unknown operation '{op}'"}
+
+
+def serve_connection(host, connection):
+    """Answers the requests of one client until it disconnects."""
+    with connection:
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                reply = host.handle(message)
+            except Exception as e:
+                reply = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+            connection.send(reply)
+
+
+def write_authkey():
+    """A fresh random key, readable only by this user; clients read it from AUTHKEY_FILE."""
+    authkey = os.urandom(32)
+    fd = os.open(AUTHKEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    return authkey
+
+
+def run_server(backend=DEFAULT_BACKEND, threads=None, preload=True):
+    host = ModelHost(backend, threads)
+    if preload:
+        host.load_sentiment()
+        host.load_embedding()
+
+    authkey = write_authkey()
+    try:
+        with Listener(SERVER_ADDRESS, authkey=authkey) as listener:
+            print(f"Model server listening on {SERVER_ADDRESS[0]}:{SERVER_ADDRESS[1]} (stop with Ctrl+C).")
+            while True:
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    print(f"Refused a connection: {e}")
+                    continue
+                threading.Thread(target=serve_connection, args=(host, connection), daemon=True).start()
+    except KeyboardInterrupt:
+        print("\nModel server stopped.")
+    finally:
+        # Without the key file clients load their models in-process again
+        if os.path.exists(AUTHKEY_FILE):
+            os.remove(AUTHKEY_FILE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Keeps the sentiment and embedding models loaded for the pipeline stages."
+    )
+    parser.add_argument('--backend', choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="sentiment backend; clients asking for the other one load it themselves")
+    parser.add_argument('--threads', type=int, default=None, help="inference threads for the models")
+    parser.add_argument('--lazy', action='store_true',
+                        help="load each model on its first request instead of at start")
+    args = parser.parse_args()
+
+    run_server(backend=args.backend, threads=args.threads, preload=not args.lazy)
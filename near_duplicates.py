@@ -0,0 +1,226 @@
+import re
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from comment_text import model_texts
+
+# MinHash signature length and LSH banding: 16 bands of 4 rows make pairs
+# with a similarity of about 0.5 and up candidates, which are then checked
+# against SIMILARITY_THRESHOLD
+NUM_PERM = 64
+BANDS = 16
+SHINGLE_SIZE = 5
+SIMILARITY_THRESHOLD = 0.8
+
+# Shingles hashed per numpy step (times NUM_PERM uint64 values: about 64 MB)
+SIGNATURE_CHUNK = 1 << 17
+
+# Multiply-shift hash family: the high 32 bits of (a * x + b) mod 2**64,
+# with random odd a and random b per permutation
+_SHINGLE_WEIGHTS = np.uint64(257) ** np.arange(SHINGLE_SIZE, dtype=np.uint64)
+_rng = np.random.default_rng(20240101)
+_A = _rng.integers(0, np.iinfo(np.uint64).max, NUM_PERM, dtype=np.uint64, endpoint=True) | np.uint64(1)
+_B = _rng.integers(0, np.iinfo(np.uint64).max, NUM_PERM, dtype=np.uint64, endpoint=True)
+# Combines the rows of one LSH band into a single bucket key
+_BAND_MIX = _rng.integers(0, np.iinfo(np.uint64).max, NUM_PERM // BANDS, dtype=np.uint64, endpoint=True) | np.uint64(1)
+
+NON_WORD = re.compile(r'[^\w\s]+')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(text):
+    """Lowercase, without punctuation and with single spaces."""
+    return WHITESPACE.sub(' ', NON_WORD.sub(' ', text.lower())).strip()
+
+
+def signatures(texts):
+    """
+    MinHash signatures (one row per text) of the byte shingles of the texts.
+    Texts are concatenated and hashed in chunks of about SIGNATURE_CHUNK
+    shingles; texts shorter than a shingle are padded to one shingle.
+    """
+    encoded = [text.encode('utf-8').ljust(SHINGLE_SIZE, b'\0') for text in texts]
+    lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded))
+    shingle_counts = lengths - SHINGLE_SIZE + 1
+    result = np.empty((len(encoded), NUM_PERM), dtype=np.uint64)
+
+    # Consecutive texts with about SIGNATURE_CHUNK shingles together are hashed in one step
+    first_shingle = np.cumsum(shingle_counts) - shingle_counts
+    chunk_of = first_shingle // SIGNATURE_CHUNK
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(chunk_of)) + 1, [len(encoded)]])
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        data = np.frombuffer(b''.join(encoded[first:last]), dtype=np.uint8).astype(np.uint64)
+        window_hashes = sliding_window_view(data, SHINGLE_SIZE) @ _SHINGLE_WEIGHTS
+
+        # Only windows that lie within one text are shingles: shingle j of a
+        # text starting at byte 'start' is window start + j
+        counts = shingle_counts[first:last]
+        text_starts = np.cumsum(lengths[first:last]) - lengths[first:last]
+        shingle_starts = np.cumsum(counts) - counts
+        hashes = window_hashes[np.arange(counts.sum()) + np.repeat(text_starts - shingle_starts, counts)]
+
+        permuted = (_A[:, None] * hashes[None, :] + _B[:, None]) >> np.uint64(32)
+        result[first:last] = np.minimum.reduceat(permuted, shingle_starts, axis=1).T
+    return result
+
+
+def band_keys(text_signatures):
+    """The LSH bucket key of every text in every band: shape (texts, BANDS)."""
+    rows = NUM_PERM // BANDS
+    return np.stack(
+        [text_signatures[:, band * rows:(band + 1) * rows] @ _BAND_MIX for band in range(BANDS)], axis=1
+    ).reshape(len(text_signatures), BANDS)
+
+
+def candidate_pairs(keys):
+    """
+    (first, other) index arrays of the texts that share an LSH bucket with
+    the bucket's first text, over all bands, without repeated pairs.
+    """
+    firsts, others = [], []
+    for band in range(BANDS):
+        _, bucket_of, bucket_sizes = np.unique(keys[:, band], return_inverse=True, return_counts=True)
+        bucket_of = bucket_of.reshape(-1)
+        # Texts sorted by bucket, in text order within a bucket
+        by_bucket = np.argsort(bucket_of, kind='stable')
+        bucket_starts = np.cumsum(bucket_sizes) - bucket_sizes
+        is_first = np.zeros(len(by_bucket), dtype=bool)
+        is_first[bucket_starts] = True
+        others.append(by_bucket[~is_first])
+        firsts.append(by_bucket[bucket_starts][bucket_of[by_bucket[~is_first]]])
+    pairs = np.unique(np.stack([np.concatenate(firsts), np.concatenate(others)], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def group_roots(keys, signature_of):
+    """
+    Per text (row of 'keys', see band_keys) the index of the first text of
+    its group. Candidates from the LSH buckets are compared on the estimated
+    Jaccard similarity; 'signature_of(rows)' returns the MinHash signatures
+    of a sorted array of text indices. Pairs with equal keys in every band
+    have equal signatures, so only the other pairs need them.
+    """
+    roots = np.arange(len(keys))
+    if len(keys) < 2:
+        return roots
+    first, other = candidate_pairs(keys)
+    accepted = (keys[first] == keys[other]).all(axis=1)
+    check = np.flatnonzero(~accepted)
+    if len(check):
+        rows = np.unique(np.concatenate([first[check], other[check]]))
+        checked = signature_of(rows)
+        matches = (checked[np.searchsorted(rows, first[check])]
+                   == checked[np.searchsorted(rows, other[check])]).sum(axis=1)
+        accepted[check] = matches >= SIMILARITY_THRESHOLD * NUM_PERM
+
+    # Union-find; the root is always the smallest index
+    def find(k):
+        while roots[k] != k:
+            roots[k] = roots[roots[k]]
+            k = roots[k]
+        return k
+
+    for a, b in zip(first[accepted], other[accepted]):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            roots[max(root_a, root_b)] = min(root_a, root_b)
+    return np.array([find(k) for k in range(len(keys))])
+
+
+def model_input(text):
+    """The text that is shingled: normalized, or as it is when only punctuation."""
+    return normalize(text) or text
+
+
+def has_text(text):
+    return isinstance(text, str) and bool(text.strip())
+
+
+def group_near_duplicates(texts):
+    """
+    Groups identical and near-identical texts.
+
+    Returns, per position in 'texts', the position of the first text of its
+    group (itself when it has no near-duplicates), or None for missing or empty texts.
+    Candidates come from LSH buckets; within a bucket every text is compared
+    with the bucket's first text on the estimated Jaccard similarity.
+    """
+    positions = [i for i, text in enumerate(texts) if has_text(text)]
+    representatives = [None] * len(texts)
+    if not positions:
+        return representatives
+
+    normalized = [model_input(texts[i]) for i in positions]
+    # Identical after normalization: one signature for all of them
+    unique_texts, first_of_text = {}, []
+    for k, text in enumerate(normalized):
+        first_of_text.append(unique_texts.setdefault(text, k))
+    unique_positions = sorted(set(first_of_text))
+    text_signatures = signatures([normalized[k] for k in unique_positions])
+    roots = group_roots(band_keys(text_signatures), lambda rows: text_signatures[rows])
+
+    unique_index = {k: u for u, k in enumerate(unique_positions)}
+    for k, position in enumerate(positions):
+        representatives[position] = positions[unique_positions[roots[unique_index[first_of_text[k]]]]]
+    return representatives
+
+
+def group_near_duplicates_in_batches(read_batches):
+    """
+    group_near_duplicates() for texts that do not fit in memory together.
+    'read_batches()' yields the texts as lists, batch by batch, and is called
+    again for a second pass. Only the LSH bucket keys of every text are kept
+    (BANDS numbers per text); the full signatures are computed in the second
+    pass for the texts that share a bucket without being identical.
+    """
+    position_parts, key_parts = [], []
+    n_texts = 0
+    for texts in read_batches():
+        present = [i for i, text in enumerate(texts) if has_text(text)]
+        if present:
+            key_parts.append(band_keys(signatures([model_input(texts[i]) for i in present])))
+            position_parts.append(n_texts + np.asarray(present, dtype=np.int64))
+        n_texts += len(texts)
+
+    representatives = [None] * n_texts
+    if not key_parts:
+        return representatives
+    positions = np.concatenate(position_parts)
+    keys = np.concatenate(key_parts)
+    # Equal keys in every band (identical after normalization): grouped as one text
+    _, first_of_keys, same_keys = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    unique_rows = np.sort(first_of_keys)
+    unique_of_row = np.searchsorted(unique_rows, first_of_keys[same_keys.reshape(-1)])
+
+    def signature_of(rows):
+        wanted = positions[unique_rows[rows]]
+        result = np.empty((len(rows), NUM_PERM), dtype=np.uint64)
+        done = offset = 0
+        for texts in read_batches():
+            stop = np.searchsorted(wanted, offset + len(texts))
+            if stop > done:
+                result[done:stop] = signatures([model_input(texts[p - offset]) for p in wanted[done:stop]])
+                done = stop
+            offset += len(texts)
+        return result
+
+    roots = group_roots(keys[unique_rows], signature_of)
+    for position, unique in zip(positions, unique_of_row):
+        representatives[position] = int(positions[unique_rows[roots[unique]]])
+    return representatives
+
+
+def representative_comments(df_rows, df_all=None):
+    """
+    The text the models should see for every row of 'df_rows': the model
+    text (see 'comment_text.py') of its group's first review ('comment_group',
+    set by the clean stage), found in 'df_all' (default: 'df_rows' itself).
+    """
+    own_texts = model_texts(df_rows)
+    if 'comment_group' not in df_rows.columns:
+        return own_texts
+    df_all = (df_rows if df_all is None else df_all).drop_duplicates('reviewId')
+    texts = pd.Series(model_texts(df_all).to_numpy(), index=df_all['reviewId'])
+    return df_rows['comment_group'].map(texts).fillna(own_texts)
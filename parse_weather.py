@@ -2,27 +2,147 @@ import pandas as pd
 import io
 import re
 import os
+from itertools import islice
+
+from weather_store import WeatherStore, STORE_FILE
+from weather_rollups import update_rollups
 
 INPUT_FILE = 'result.txt'
 OUTPUT_FILE = 'weather_data.csv'
+# Map met één CSV per station (weather_<STN>.csv)
+STATION_DIR = 'weather_stations'
+
+# Aantal dataregels dat per keer wordt ingelezen en omgezet
+CHUNK_ROWS = 100_000
 
 # 1. Definieer de kolomnaam-vertalingen
 # Gebaseerd op de KNMI-beschrijvingen in het bestand
+# Kolommen die hier niet in staan houden hun KNMI-code
 RENAME_MAP = {
     'TG': 'temp_avg_c',
     'TN': 'temp_min_c',
     'TX': 'temp_max_c',
     'DR': 'precip_duration_h',
     'RH': 'precip_amount_mm',
-    'RHX': 'precip_max_hourly_mm'
+    'RHX': 'precip_max_hourly_mm',
+    'FG': 'wind_speed_avg_ms',
+    'FHX': 'wind_speed_max_hourly_ms',
+    'FXX': 'wind_gust_max_ms',
+    'SQ': 'sunshine_duration_h',
+    'SP': 'sunshine_pct',
+    'Q': 'radiation_jcm2',
+    'PG': 'pressure_avg_hpa',
+    'UG': 'humidity_avg_pct',
+    'NG': 'cloud_cover_octants',
+    'EV24': 'evaporation_mm'
 }
-# Kolommen die we moeten delen door 10
-# (Allemaal behalve de ID's)
-COLS_TO_CONVERT = ['TG', 'TN', 'TX', 'DR', 'RH', 'RHX']
 
-def parse_knmi_data():
+# Regels uit de KNMI-header
+STATION_LINE = re.compile(r'^#\s*(\d+)\s+(-?[\d.]+)\s+(-?[\d.]+)\s+(-?[\d.]+)\s+(.*?)\s*$')
+VARIABLE_LINE = re.compile(r'^#\s*(\w+)\s*:\s*(.*)$')
+# Eenheid in stappen van 0.1 / 0.01: '(in 0.1 mm)'
+UNIT_SCALE = re.compile(r'\(in (0\.0*1)\b')
+# '-1 voor <0.05 mm': -1 betekent "minder dan de halve eenheid", we maken er 0 van
+MINUS_ONE_RULE = re.compile(r'-1 (?:voor|for) <')
+
+
+def read_knmi_header(f):
+    """
+    Leest de commentaarregels van een KNMI-bestand tot en met de kolomregel
+    ('# STN,YYYYMMDD,...'). Het bestand staat daarna op de eerste dataregel.
+
+    Geeft een dict terug met:
+      'columns':  de kolomnamen uit de header
+      'divisors': per kolom het getal waardoor gedeeld wordt (10 voor 'in 0.1 ...')
+      'minus_one_zero': kolommen waarbij -1 voor 0 staat
+      'stations': {STN: {'lon', 'lat', 'alt', 'name'}}
+    of None als er geen kolomregel is.
+    """
+    header = {'columns': None, 'divisors': {}, 'minus_one_zero': set(), 'stations': {}}
+
+    for line in f:
+        stripped_line = line.strip()
+        if not stripped_line.startswith('#'):
+            # Data zonder kolomregel ervoor
+            return None
+
+        if 'STN,YYYYMMDD' in stripped_line:
+            # Maak de header schoon (verwijder '#' en extra spaties)
+            header['columns'] = [c.strip() for c in stripped_line.lstrip('#').split(',')]
+            return header
+
+        station = STATION_LINE.match(stripped_line)
+        if station:
+            stn, lon, lat, alt, name = station.groups()
+            header['stations'][int(stn)] = {
+                'lon': float(lon), 'lat': float(lat), 'alt': float(alt), 'name': name
+            }
+            continue
+
+        variable = VARIABLE_LINE.match(stripped_line)
+        if variable:
+            code, description = variable.groups()
+            scale = UNIT_SCALE.search(description)
+            if scale:
+                header['divisors'][code] = round(1 / float(scale.group(1)))
+            if MINUS_ONE_RULE.search(description):
+                header['minus_one_zero'].add(code)
+
+    return None
+
+
+def iter_data_lines(f, n_columns):
+    """
+    Geeft de dataregels één voor één terug. Een regel met te weinig velden is
+    afgebroken en wordt aangevuld met de volgende regel(s).
+    """
+    pending = ''
+    for line in f:
+        stripped_line = line.strip()
+        if not stripped_line or stripped_line.startswith('#'):
+            continue
+        pending += stripped_line
+        if pending.count(',') < n_columns - 1:
+            continue
+        yield pending + '\n'
+        pending = ''
+    if pending:
+        yield pending + '\n'
+
+
+def convert_chunk(df, header):
+    """Zet de ruwe KNMI-getallen van één blok regels om naar schone eenheden."""
+    df['YYYYMMDD'] = pd.to_datetime(df['YYYYMMDD'].astype(str), format='%Y%m%d')
+    df = df.rename(columns={'YYYYMMDD': 'date'})
+
+    value_cols = [c for c in header['columns'] if c not in ('STN', 'YYYYMMDD')]
+    # Lege velden zijn al NaN; eventuele tekst wordt ook NaN
+    df[value_cols] = df[value_cols].apply(pd.to_numeric, errors='coerce')
+
+    # Speciale waarde: -1 (bv. voor neerslag) betekent <0.05, we maken er 0 van
+    minus_one_cols = [c for c in value_cols if c in header['minus_one_zero']]
+    df[minus_one_cols] = df[minus_one_cols].mask(df[minus_one_cols] == -1, 0)
+
+    # Converteer de eenheid (0.1 graden/mm/uur naar 1.0), per kolom uit de header
+    for divisor in set(header['divisors'].values()):
+        cols = [c for c in value_cols if header['divisors'].get(c) == divisor]
+        df[cols] = df[cols] / float(divisor)
+
+    return df.rename(columns=RENAME_MAP)
+
+
+def parse_knmi_data(write=True):
     """
-    Leest het complexe KNMI-tekstbestand, schoont het op en slaat het op als CSV.
+    Leest het KNMI-tekstbestand (één of meer stations) in blokken van
+    CHUNK_ROWS regels, zet de eenheden om en slaat het resultaat op als CSV:
+    alle stations samen in OUTPUT_FILE en per station in STATION_DIR.
+    Daarnaast wordt de weer-store (per station en dag, met afgeleide
+    kenmerken) voor 'merge_with_weather.py' gebouwd (alles tenzij write=False). Geeft de schone DataFrame terug, of None bij een fout.
+
+    Met write=True wordt elk blok meteen weggeschreven en niet bewaard; de
+    volledige DataFrame wordt daarna één keer uit OUTPUT_FILE gelezen (de
+    weer-store heeft alle dagen nodig). Alleen met write=False worden de
+    blokken in het geheugen samengevoegd.
     """
     if not os.path.exists(INPUT_FILE):
         print(f"FOUT: '{INPUT_FILE}' niet gevonden.")
@@ -30,100 +150,91 @@ def parse_knmi_data():
         return
 
     print(f"Starten met parsen van '{INPUT_FILE}'...")
-    
-    header_line = None
-    data_lines = []
-
-    # --- Stap 1: Lees het bestand en scheid data van commentaar ---
-    with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-        for line in f:
-            stripped_line = line.strip()
-            
-            # Check voor commentaar/header regels
-            if stripped_line.startswith('#'):
-                # Zoek de daadwerkelijke data-header
-                if 'STN,YYYYMMDD' in stripped_line:
-                    header_line = stripped_line.replace('#', '').strip()
-                continue
-            
-            # Als het geen commentaar is, is het een (fragment van een) data-regel
-            if stripped_line:
-                data_lines.append(stripped_line)
-
-    if not header_line:
-        print("FOUT: Kon de header-regel ('# STN,YYYYMMDD,...') niet vinden in het bestand.")
-        return
 
-    # --- Stap 2: Repareer gebroken dataregels ---
-    # Voeg alle data-fragmenten samen tot één lange string
-    # Vervang newlines door spaties (voor het geval dat)
-    full_data_string = " ".join(data_lines).replace('\n', ' ')
-    
-    # Split de string op basis van de '370,' stationcode
-    # Dit zorgt ervoor dat elke dataregel correct begint
-    # We gebruiken een 'positive lookahead' '(?=370,)' om te splitten *voor* de code
-    processed_lines = re.split(r'(?=370,)', full_data_string)
-
-    # Filter eventuele lege strings uit het resultaat
-    clean_data_rows = [line.strip() for line in processed_lines if line.strip()]
-
-    # --- Stap 3: Maak een "virtueel" CSV-bestand in het geheugen ---
-    
-    # Maak de header schoon (verwijder extra spaties)
-    header = re.sub(r'\s*,\s*', ',', header_line)
-    cols = header.split(',')
-    
-    csv_data_io = io.StringIO()
-    csv_data_io.write(header + '\n') # Schrijf de schone header
-    
-    for line in clean_data_rows:
-        # Maak de dataregel schoon (verwijder extra spaties)
-        clean_line = re.sub(r'\s*,\s*', ',', line)
-        csv_data_io.write(clean_line + '\n')
-        
-    # Spoel terug naar het begin van het virtuele bestand
-    csv_data_io.seek(0)
-
-    # --- Stap 4: Lees het virtuele bestand in met Pandas ---
-    print("Data inlezen in pandas...")
+    chunks = []
+    written_stations = set()
+    seen_stations = set()
+    n_rows = 0
+    tmp_file = OUTPUT_FILE + '.tmp'
+
     try:
-        df = pd.read_csv(csv_data_io, sep=',')
+        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
+            # --- Stap 1: Lees de header (kolommen, eenheden, stations) ---
+            header = read_knmi_header(f)
+            if header is None:
+                print("FOUT: Kon de header-regel ('# STN,YYYYMMDD,...') niet vinden in het bestand.")
+                return
+
+            missing_units = [c for c in header['columns'][2:] if c not in header['divisors']]
+            if missing_units:
+                print(f"Let op: geen eenheid gevonden voor {missing_units}, waarden blijven ongewijzigd.")
+
+            if write:
+                os.makedirs(STATION_DIR, exist_ok=True)
+
+            # --- Stap 2: Lees de data blok voor blok in met Pandas ---
+            print("Data inlezen in pandas...")
+            lines = iter_data_lines(f, len(header['columns']))
+            while True:
+                block = list(islice(lines, CHUNK_ROWS))
+                if not block:
+                    break
+
+                df_chunk = pd.read_csv(
+                    io.StringIO(''.join(block)), header=None, names=header['columns'],
+                    skipinitialspace=True
+                )
+
+                # --- Stap 3: Data opschonen en converteren ---
+                df_chunk = convert_chunk(df_chunk, header)
+
+                # --- Stap 4: Schrijf het blok weg, in OUTPUT_FILE en per station ---
+                if not write:
+                    chunks.append(df_chunk)
+                else:
+                    df_chunk.to_csv(tmp_file, mode='w' if n_rows == 0 else 'a', header=n_rows == 0,
+                                    index=False, date_format='%Y-%m-%d')
+                    for stn, df_station in df_chunk.groupby('STN', sort=False):
+                        station_file = os.path.join(STATION_DIR, f"weather_{stn}.csv")
+                        first = stn not in written_stations
+                        df_station.to_csv(station_file, mode='w' if first else 'a', header=first,
+                                          index=False, date_format='%Y-%m-%d')
+                        written_stations.add(stn)
+                seen_stations.update(df_chunk['STN'].unique())
+                n_rows += len(df_chunk)
+
     except Exception as e:
         print(f"FOUT: Er ging iets mis bij het inlezen van de data in pandas: {e}")
         return
 
-    # --- Stap 5: Data opschonen en converteren ---
-    print("Data opschonen (eenheden converteren, datums omzetten)...")
-    
-    # Converteer datumkolom
-    df['YYYYMMDD'] = pd.to_datetime(df['YYYYMMDD'], format='%Y%m%d')
-    df.rename(columns={'YYYYMMDD': 'date'}, inplace=True)
-    
-    # Converteer de meetwaarden
-    for col in COLS_TO_CONVERT:
-        if col in df.columns:
-            # Converteer naar numeriek, fouten worden 'NaN' (Not a Number)
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-            
-            # Speciale waarde: -1 (voor neerslag) betekent <0.05, we maken er 0 van
-            df[col] = df[col].replace(-1, 0)
-            
-            # Converteer de eenheid (0.1 graden/mm/uur naar 1.0)
-            df[col] = df[col] / 10.0
-        
-    # Hernoem kolommen naar duidelijke namen
-    df.rename(columns=RENAME_MAP, inplace=True)
-    
-    # Verwijder kolommen die we niet hebben hernoemd (als die er zijn)
-    # Dit ruimt eventuele lege kolommen op
-    df = df[[col for col in df.columns if col in ['STN', 'date'] + list(RENAME_MAP.values())]]
-
-    # --- Stap 6: Opslaan als schone CSV ---
+    if n_rows == 0:
+        print("FOUT: Geen dataregels gevonden in het bestand.")
+        return
+
+    stations = sorted(seen_stations)
+    names = [header['stations'].get(stn, {}).get('name', '?') for stn in stations]
+    print(f"Stations: {', '.join(f'{stn} ({name})' for stn, name in zip(stations, names))}")
+
+    if not write:
+        print(f"\nSuccesvol {n_rows} dataregels verwerkt.")
+        return pd.concat(chunks, ignore_index=True)
+
+    # --- Stap 5: De schone CSV is compleet; bouw de weer-store ---
     try:
-        df.to_csv(OUTPUT_FILE, index=False, date_format='%Y-%m-%d')
+        os.replace(tmp_file, OUTPUT_FILE)
+        df = pd.read_csv(OUTPUT_FILE, parse_dates=['date'])
+
+        # Weer per station en dag als array, met 3/7-daagse neerslag en temperatuurafwijking
+        store = WeatherStore.from_frame(df)
+        store.save()
+
+        # Rollups per week/maand/jaar voor 'analyse_data_weather.py', alleen nieuwe of gewijzigde dagen
+        update_rollups(OUTPUT_FILE, df)
         print("\n--- Voltooid ---")
         print(f"Succesvol {len(df)} dataregels verwerkt.")
-        print(f"Schone data opgeslagen in: '{OUTPUT_FILE}'")
+        print(f"Schone data opgeslagen in: '{OUTPUT_FILE}' en per station in '{STATION_DIR}/'")
+        print(f"Weer-store met {len(store.features)} kenmerken opgeslagen in: '{STORE_FILE}'")
+        return df
     except Exception as e:
         print(f"\nFOUT: Kon het CSV-bestand niet wegschrijven: {e}")
 
@@ -131,4 +242,4 @@ def parse_knmi_data():
 # --- Voer de functie uit als het script direct wordt gerund ---
 # DEZE REGELS ZIJN ESSENTIEEL!
 if __name__ == "__main__":
-    parse_knmi_data()
\ No newline at end of file
+    parse_knmi_data()
@@ -0,0 +1,75 @@
+import ast
+import hashlib
+import json
+import os
+
+# Fingerprints of the last successful run of every pipeline stage
+FINGERPRINTS_FILE = 'pipeline_fingerprints.json'
+
+
+def file_digest(file_path):
+    """SHA-256 of a file's contents, or 'missing' if it does not exist."""
+    if not os.path.exists(file_path):
+        return 'missing'
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_files(file_path):
+    """
+    'file_path' and the source files of the local modules it imports,
+    directly or through other local modules (in import order). Modules that
+    are not next to 'file_path' (the standard library, packages) are left out.
+    """
+    folder = os.path.dirname(file_path)
+    files = [file_path]
+    for path in files:
+        with open(path, 'r', encoding='utf-8') as f:
+            tree = ast.parse(f.read(), filename=path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                modules = [node.module]
+            else:
+                continue
+            for module in modules:
+                module_path = os.path.join(folder, module.split('.')[0] + '.py')
+                if os.path.exists(module_path) and module_path not in files:
+                    files.append(module_path)
+    return files
+
+
+def combine(components):
+    """One fingerprint for a dict of named component digests."""
+    return hashlib.sha256(json.dumps(components, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_fingerprints():
+    """Returns {stage: {'fingerprint': ..., 'components': {...}}} of earlier runs."""
+    if not os.path.exists(FINGERPRINTS_FILE):
+        return {}
+    try:
+        with open(FINGERPRINTS_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError):
+        print(f"WARNING: Could not read '{FINGERPRINTS_FILE}', all stages will run.")
+        return {}
+
+
+def save_fingerprints(fingerprints):
+    tmp_file = FINGERPRINTS_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(fingerprints, f, indent=2)
+    os.replace(tmp_file, FINGERPRINTS_FILE)
+
+
+def changed_components(components, previous):
+    """Names of the components that differ from the previous run."""
+    if not previous:
+        return None
+    old = previous.get('components', {})
+    return sorted(name for name in set(components) | set(old) if components.get(name) != old.get(name))
@@ -0,0 +1,55 @@
+import json
+import os
+
+# State store for incremental runs of the pipeline
+STATE_FILE = 'pipeline_state.json'
+
+
+def load_state():
+    """
+    Loads the incremental state.
+
+    'reviews' maps every reviewId in the current export to its updateTime
+    (as last seen by 'clean_reviews.py'). 'stages' holds, per stage, the
+    reviewId -> updateTime versions that stage has already processed.
+    """
+    if not os.path.exists(STATE_FILE):
+        return {"reviews": {}, "stages": {}}
+
+    try:
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        print(f"WARNING: Could not read '{STATE_FILE}' ({e}). Starting from an empty state.")
+        return {"reviews": {}, "stages": {}}
+
+    state.setdefault("reviews", {})
+    state.setdefault("stages", {})
+    return state
+
+
+def save_state(state):
+    """Writes the state atomically so an interrupted run never leaves a half file."""
+    tmp_file = STATE_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_file, STATE_FILE)
+
+
+def stale_review_ids(state, stage, review_ids):
+    """
+    Returns the subset of 'review_ids' that 'stage' still has to (re)process:
+    reviews it has never seen or whose updateTime changed since its last run.
+    """
+    versions = state["reviews"]
+    processed = state["stages"].get(stage, {})
+    return {
+        review_id for review_id in review_ids
+        if review_id not in processed or processed[review_id] != versions.get(review_id)
+    }
+
+
+def mark_processed(state, stage, review_ids):
+    """Records that 'stage' is now up to date for exactly these reviews."""
+    versions = state["reviews"]
+    state["stages"][stage] = {review_id: versions.get(review_id) for review_id in review_ids}
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from analyse_topics import load_topic_meta
+from stage_files import COMPRESSION
+from station_lookup import load_locations
+from weather_store import review_days, MISSING_DAY
+
+# Star schema for Power BI: a review fact table with date, weather, topic and
+# location dimensions as Parquet files. The fact and weather tables get one
+# folder per month, so an incremental refresh only reloads changed months.
+EXPORT_DIR = 'powerbi_export'
+MANIFEST_FILE = os.path.join(EXPORT_DIR, 'manifest.json')
+
+# Partition of reviews without a valid createTime
+UNKNOWN_MONTH = 'unknown'
+
+# Meteorological seasons
+SEASONS = {
+    12: 'winter', 1: 'winter', 2: 'winter', 3: 'spring', 4: 'spring', 5: 'spring',
+    6: 'summer', 7: 'summer', 8: 'summer', 9: 'autumn', 10: 'autumn', 11: 'autumn'
+}
+
+# Low-cardinality text columns are dictionary-encoded
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+FACT_SCHEMA = pa.schema([
+    ('reviewId', pa.string()),
+    ('locationId', CATEGORY),
+    ('date_key', pa.int32()),       # local review day as YYYYMMDD -> dim_date
+    ('weather_key', pa.int64()),    # station * 10**8 + date_key -> dim_weather
+    ('topic_nr', pa.int16()),       # -> dim_topics
+    ('createTime', pa.timestamp('ms', tz='UTC')),
+    ('reviewerName', pa.string()),
+    ('rating', pa.int8()),
+    ('sentiment_label', CATEGORY),
+    ('sentiment_score', pa.float32()),
+    ('comment_language', CATEGORY),
+    ('comment_group', pa.string()),
+    ('comment_original', pa.string()),
+    ('comment_translated', pa.string()),
+    ('replyComment', CATEGORY),     # replies are mostly the same few texts
+])
+
+
+def table_digest(table):
+    """SHA-256 of a table's schema and contents (Arrow IPC serialization)."""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return hashlib.sha256(sink.getvalue()).hexdigest()
+
+
+def to_table(df, schema):
+    """
+    Converts the columns of 'schema' that 'df' has into an Arrow table of
+    those types (narrowing casts: timestamps to ms, floats to float32).
+    """
+    fields = [field for field in schema if field.name in df.columns]
+    table = pa.Table.from_pandas(df[[f.name for f in fields]], preserve_index=False)
+    return table.cast(pa.schema(fields), safe=False)
+
+
+def build_fact_reviews(df_final):
+    """The fact rows: keys to the dimensions plus the review's own columns, and its month."""
+    days = review_days(df_final['createTime'])
+    valid = days != MISSING_DAY
+    dates = pd.to_datetime(np.where(valid, days, 0), unit='D')
+    date_keys = pd.Series(dates.year * 10000 + dates.month * 100 + dates.day, index=df_final.index, dtype='Int32')
+    date_keys[~valid] = pd.NA
+
+    df_fact = df_final.copy()
+    df_fact['date_key'] = date_keys
+    df_fact['month'] = np.where(valid, dates.strftime('%Y-%m'), UNKNOWN_MONTH)
+    if 'weather_station' in df_fact.columns:
+        df_fact['weather_key'] = df_fact['weather_station'].astype('Int64') * 10**8 + date_keys.astype('Int64')
+    df_fact['createTime'] = pd.to_datetime(df_fact['createTime'], utc=True, format='ISO8601', errors='coerce')
+    if 'topic_nr' in df_fact.columns:
+        df_fact['topic_nr'] = df_fact['topic_nr'].astype('Int16')
+    return df_fact.sort_values(['createTime', 'reviewId'], na_position='last')
+
+
+def build_dim_weather(df_fact, weather_cols):
+    """One row per station and day that has reviews, with the weather of that day."""
+    if 'weather_key' not in df_fact.columns:
+        return None
+    df_weather = df_fact.dropna(subset=['weather_key']).drop_duplicates('weather_key')
+    df_weather = df_weather[['weather_key', 'weather_station', 'date_key', 'month'] + weather_cols]
+    schema = pa.schema(
+        [('weather_key', pa.int64()), ('weather_station', pa.int16()), ('date_key', pa.int32())]
+        + [(c, pa.float32()) for c in weather_cols]
+    )
+    return df_weather.sort_values('weather_key'), schema
+
+
+def build_dim_date(date_keys):
+    """Every day from the first to the last review day, with calendar attributes."""
+    date_keys = date_keys.dropna()
+    if date_keys.empty:
+        return pd.DataFrame(columns=['date_key'])
+    first = pd.to_datetime(str(date_keys.min()), format='%Y%m%d')
+    last = pd.to_datetime(str(date_keys.max()), format='%Y%m%d')
+    dates = pd.date_range(first, last, freq='D')
+    return pd.DataFrame({
+        'date_key': dates.year * 10000 + dates.month * 100 + dates.day,
+        'date': dates.date,
+        'year': dates.year,
+        'month': dates.month,
+        'year_month': dates.strftime('%Y-%m'),
+        'day_of_week': dates.dayofweek + 1,  # 1 = Monday
+        'is_weekend': dates.dayofweek >= 5,
+        'season': dates.month.map(SEASONS),
+    })
+
+
+DIM_DATE_SCHEMA = pa.schema([
+    ('date_key', pa.int32()), ('date', pa.date32()), ('year', pa.int16()), ('month', pa.int8()),
+    ('year_month', pa.string()), ('day_of_week', pa.int8()), ('is_weekend', pa.bool_()), ('season', CATEGORY),
+])
+
+
+def build_dim_topics(df_fact):
+    """Stable topic IDs with the names from the topic model and their review counts."""
+    if 'topic_nr' not in df_fact.columns:
+        return None
+    meta = load_topic_meta() or {}
+    names = {int(k): v for k, v in meta.get('topic_names', {}).items()}
+    counts = df_fact['topic_nr'].value_counts()
+    topic_ids = sorted(set(names) | set(counts.index.astype(int)))
+    return pd.DataFrame({
+        'topic_nr': topic_ids,
+        'topic_name': [names.get(t, f"Topic {t}") for t in topic_ids],
+        'reviews': [int(counts.get(t, 0)) for t in topic_ids],
+    })
+
+
+DIM_TOPICS_SCHEMA = pa.schema([('topic_nr', pa.int16()), ('topic_name', pa.string()), ('reviews', pa.int32())])
+
+
+def build_dim_locations(df_fact, station_index=None):
+    """Every location with its coordinates and the weather station used for it."""
+    if 'locationId' not in df_fact.columns:
+        return None
+    location_ids = sorted(df_fact['locationId'].dropna().unique())
+    df_locations = load_locations().reindex(location_ids)
+    df_locations.index.name = 'locationId'
+    if station_index is not None:
+        df_locations = df_locations.join(station_index[['station', 'distance_km']])
+    return df_locations.reset_index().rename(columns={'station': 'weather_station', 'distance_km': 'station_distance_km'})
+
+
+DIM_LOCATIONS_SCHEMA = pa.schema([
+    ('locationId', pa.string()), ('name', pa.string()), ('lat', pa.float64()), ('lon', pa.float64()),
+    ('weather_station', pa.int16()), ('station_distance_km', pa.float32()),
+])
+
+
+def star_schema_tables(df_final, weather_cols, station_index=None):
+    """All export files as {path relative to EXPORT_DIR: Arrow table}."""
+    df_fact = build_fact_reviews(df_final)
+    tables = {}
+
+    for month, df_month in df_fact.groupby('month', sort=True):
+        tables[f"fact_reviews/month={month}/fact_reviews_{month}.parquet"] = to_table(df_month, FACT_SCHEMA)
+
+    dim_weather = build_dim_weather(df_fact, weather_cols)
+    if dim_weather is not None:
+        df_weather, schema = dim_weather
+        for month, df_month in df_weather.groupby('month', sort=True):
+            tables[f"dim_weather/month={month}/dim_weather_{month}.parquet"] = to_table(df_month, schema)
+
+    tables['dim_date.parquet'] = to_table(build_dim_date(df_fact['date_key']), DIM_DATE_SCHEMA)
+
+    df_topics = build_dim_topics(df_fact)
+    if df_topics is not None:
+        tables['dim_topics.parquet'] = to_table(df_topics, DIM_TOPICS_SCHEMA)
+
+    df_locations = build_dim_locations(df_fact, station_index)
+    if df_locations is not None:
+        tables['dim_locations.parquet'] = to_table(df_locations, DIM_LOCATIONS_SCHEMA)
+
+    return tables
+
+
+def load_manifest():
+    """{path: {'digest', 'rows'}} of the files written by the previous export."""
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    try:
+        with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f).get('files', {})
+    except (json.JSONDecodeError, OSError):
+        print(f"WARNING: Could not read '{MANIFEST_FILE}', all export files will be written.")
+        return {}
+
+
+def export_star_schema(df_final, weather_cols, station_index=None):
+    """
+    Writes the merged reviews as a star schema to EXPORT_DIR. Files whose
+    contents did not change since the previous export are left untouched,
+    partitions of months that no longer have reviews are removed.
+    Returns the path of the manifest.
+    """
+    tables = star_schema_tables(df_final, weather_cols, station_index)
+    previous = load_manifest()
+    files = {}
+    written = 0
+
+    for path, table in sorted(tables.items()):
+        file_path = os.path.join(EXPORT_DIR, path)
+        digest = table_digest(table)
+        files[path] = {'digest': digest, 'rows': table.num_rows}
+        if previous.get(path, {}).get('digest') == digest and os.path.exists(file_path):
+            continue
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        pq.write_table(table, file_path + '.tmp', compression=COMPRESSION)
+        os.replace(file_path + '.tmp', file_path)
+        written += 1
+
+    removed = [path for path in previous if path not in files]
+    for path in removed:
+        file_path = os.path.join(EXPORT_DIR, path)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        folder = os.path.dirname(file_path)
+        if folder != EXPORT_DIR and os.path.isdir(folder) and not os.listdir(folder):
+            os.rmdir(folder)
+
+    tmp_file = MANIFEST_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({'files': files}, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, MANIFEST_FILE)
+
+    print(f"Star schema in '{EXPORT_DIR}': {written} files written, "
+          f"{len(files) - written} unchanged, {len(removed)} removed.")
+    return MANIFEST_FILE
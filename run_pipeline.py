@@ -1,52 +1,424 @@
-import subprocess
+import argparse
+import json
+import os
 import sys
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def run_script(script_name):
+import pandas as pd
+
+import clean_reviews
+import parse_weather
+import analyse_sentiment
+import analyse_topics
+import merge_with_weather
+import powerbi_export
+import station_lookup
+from pipeline_fingerprints import (
+    file_digest, combine, load_fingerprints, save_fingerprints, changed_components, source_files
+)
+from sentiment_inference import model_id
+from stage_files import read_table, compact_frame, frame_memory_mb
+from stage_metrics import StageMetrics, append_run_log, cpu_seconds, new_run_id, peak_memory_mb, RUN_LOG_FILE
+
+
+def load_reviews_file(file_path):
+    """Reads the {"reviews": [...]} JSON export back into a DataFrame."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return pd.DataFrame.from_records(json.load(f)['reviews'])
+
+
+def set_torch_threads(threads):
+    """
+    Sets torch's intra-op thread count. The setting is process-wide, not per
+    stage: every model stage running in this process uses up to 'threads'
+    threads per call, so it is set once for the whole run.
+    """
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+
+
+def load_weather(file_path):
+    """
+    Output of a parse_weather stage that did not run: nothing, so the merge
+    opens the weather store written by that earlier run (WeatherStore.load)
+    instead of rebuilding it from 'file_path'.
+    """
+    return None
+
+
+# --- Stage adapters: explicit inputs (outputs of earlier stages) and options ---
+
+def run_clean(inputs, options, write):
+    reviews = clean_reviews.clean_review_data(incremental=options.incremental, write=write)
+    if reviews is None:
+        return None
+    df = pd.DataFrame.from_records(reviews)
+    return compact_frame(df) if options.low_memory else df
+
+def run_weather(inputs, options, write):
+    if not os.path.exists(parse_weather.INPUT_FILE) and os.path.exists(parse_weather.OUTPUT_FILE):
+        # No raw KNMI download available: use the weather data parsed earlier
+        print(f"'{parse_weather.INPUT_FILE}' not found, using existing '{parse_weather.OUTPUT_FILE}'.")
+        return pd.read_csv(parse_weather.OUTPUT_FILE)
+    return parse_weather.parse_knmi_data(write=write)
+
+def run_sentiment(inputs, options, write):
+    return analyse_sentiment.analyse_sentiment(
+        df=inputs['clean_reviews'], incremental=options.incremental, write=write,
+        threads_per_worker=options.model_threads, low_memory=options.low_memory, backend=options.backend
+    )
+
+def run_topics(inputs, options, write):
+    return analyse_topics.analyze_topics(
+        df=inputs['clean_reviews'], write=write, low_memory=options.low_memory,
+        training=options.topic_training, batch_size=options.topic_batch_size
+    )
+
+def run_merge(inputs, options, write):
+    return merge_with_weather.merge_data(
+        df_reviews=inputs['analyse_sentiment'], df_topics=inputs['analyse_topics'],
+        df_weather=inputs['parse_weather'], incremental=options.incremental, write=write,
+        export=options.export, low_memory=options.low_memory
+    )
+
+
+# The pipeline as a dependency graph, listed in a valid execution order.
+# 'code' lists the source files whose changes make a stage run again (the
+# stage's module and every local module it imports, see source_files),
+# 'inputs' the data files it reads itself. 'models' marks the stages that
+# share the CPU thread budget for model inference. 'options' lists the
+# command line options that change the stage's output.
+STAGES = [
+    {
+        'name': 'clean_reviews',
+        'run': run_clean,
+        'depends_on': [],
+        'code': source_files('clean_reviews.py'),
+        'inputs': [clean_reviews.INPUT_FILE],
+        'models': [],
+        'options': ['low_memory'],
+        'output': clean_reviews.OUTPUT_FILE,
+        'load': read_table,
+    },
+    {
+        'name': 'parse_weather',
+        'run': run_weather,
+        'depends_on': [],
+        'code': source_files('parse_weather.py'),
+        'inputs': [parse_weather.INPUT_FILE],
+        'models': [],
+        'options': [],
+        'output': parse_weather.OUTPUT_FILE,
+        'load': load_weather,
+    },
+    {
+        'name': 'analyse_sentiment',
+        'run': run_sentiment,
+        'depends_on': ['clean_reviews'],
+        'code': source_files('analyse_sentiment.py'),
+        'inputs': [],
+        'models': [model_id(analyse_sentiment.MODEL_NAME, analyse_sentiment.MODEL_REVISION)],
+        'options': ['low_memory', 'backend'],
+        'output': analyse_sentiment.OUTPUT_FILE,
+        'load': read_table,
+    },
+    {
+        'name': 'analyse_topics',
+        'run': run_topics,
+        'depends_on': ['clean_reviews'],
+        'code': source_files('analyse_topics.py'),
+        'inputs': [],
+        'models': [analyse_topics.EMBEDDING_MODEL_NAME],
+        'options': ['low_memory', 'topic_training', 'topic_batch_size'],
+        'output': analyse_topics.OUTPUT_FILE,
+        'load': read_table,
+    },
+    {
+        'name': 'merge_with_weather',
+        'run': run_merge,
+        'depends_on': ['analyse_sentiment', 'analyse_topics', 'parse_weather'],
+        'code': source_files('merge_with_weather.py'),
+        'inputs': [station_lookup.LOCATIONS_FILE],
+        'models': [],
+        'options': ['low_memory', 'export'],
+        'output': merge_with_weather.OUTPUT_FILE,
+        'load': load_reviews_file,
+    },
+]
+STAGE_NAMES = [stage['name'] for stage in STAGES]
+
+# Run log status of stages that did not run
+SKIP_STATUS = {'skip': 'skipped', 'load': 'loaded'}
+
+
+def compute_fingerprints(options):
+    """
+    Fingerprint of every stage: its code, input files, models, the values of
+    its 'options' in 'options' (the parsed command line) and the fingerprints
+    of the stages it depends on. Returns {name: (fingerprint, components)}.
+    """
+    current = {}
+    for stage in STAGES:
+        components = {f"code:{path}": file_digest(path) for path in stage['code']}
+        components.update({f"input:{path}": file_digest(path) for path in stage['inputs']})
+        if stage['models']:
+            components['models'] = ';'.join(stage['models'])
+        components.update({f"option:{name}": str(getattr(options, name)) for name in stage['options']})
+        components.update({f"after:{dep}": current[dep][0] for dep in stage['depends_on']})
+        current[stage['name']] = (combine(components), components)
+    return current
+
+
+def plan_pipeline(current, previous, force):
+    """
+    Decides per stage whether to 'run' it, 'load' its output from disk or
+    'skip' it. Returns {name: (action, reason)}.
+
+    A stage runs when forced, when its fingerprint differs from the last
+    successful run, or when a stage that runs needs its output and the file
+    on disk is not the one written by that run. The final stage also runs
+    when its output is gone or changed.
+    """
+    plan = {}
+    for stage in reversed(STAGES):
+        name = stage['name']
+        previous_run = previous.get(name)
+        consumers = [s['name'] for s in STAGES if name in s['depends_on']]
+        running_consumers = [c for c in consumers if plan[c][0] == 'run']
+        output_exists = bool(
+            previous_run and previous_run.get('output_digest')
+            and file_digest(stage['output']) == previous_run['output_digest']
+        )
+
+        if name in force:
+            plan[name] = ('run', "forced")
+        elif not previous_run:
+            plan[name] = ('run', "no earlier successful run")
+        elif previous_run['fingerprint'] != current[name][0]:
+            changed = changed_components(current[name][1], previous_run)
+            plan[name] = ('run', "changed: " + ", ".join(changed))
+        elif not consumers and not output_exists:
+            plan[name] = ('run', f"output '{stage['output']}' missing or changed")
+        elif running_consumers and not output_exists:
+            plan[name] = ('run', f"up to date, but '{stage['output']}' is needed by {', '.join(running_consumers)}")
+        elif running_consumers:
+            plan[name] = ('load', f"up to date, '{stage['output']}' is read for {', '.join(running_consumers)}")
+        else:
+            plan[name] = ('skip', "up to date")
+    return plan
+
+
+def print_plan(plan):
+    print("\n--- Pipeline Plan ---")
+    for name in STAGE_NAMES:
+        action, reason = plan[name]
+        print(f"  {action.upper():<5} {name:<20} ({reason})")
+
+
+def run_stage(stage_name, stage_function, inputs, options, write):
     """
-    Runs a Python script and stops the pipeline if an error occurs.
+    Runs one pipeline stage in this process and stops the pipeline if an
+    error occurs. Stages return their output, or None when they failed.
+    The metrics of the stage are appended to the run log.
     """
     print(f"\n{'='*60}")
-    print(f"STARTING: {script_name}")
+    print(f"STARTING: {stage_name}")
     print(f"{'='*60}")
-    
-    start_time = time.time()
-    
-    try:
-        # Run the script
-        result = subprocess.run([sys.executable, script_name], check=True)
-        
-        elapsed = time.time() - start_time
-        print(f"DONE: {script_name} successfully executed in {elapsed:.1f} seconds.")
-        
-    except subprocess.CalledProcessError:
-        print(f"\nERROR: Something went wrong while executing '{script_name}'.")
+
+    rows_in = sum(len(df) for df in inputs.values() if df is not None)
+
+    with StageMetrics(options.run_id, stage_name, profile=options.profile) as metrics:
+        try:
+            result = stage_function(inputs=inputs, options=options, write=write)
+        except Exception:
+            traceback.print_exc()
+            result = None
+
+    if result is None:
+        metrics.finish('failed', rows_in=rows_in)
+        print(f"\nERROR: Something went wrong while executing '{stage_name}'.")
         print("The pipeline has stopped. Fix the error and try again.")
         sys.exit(1)
-    except FileNotFoundError:
-        print(f"\nERROR: Could not find file '{script_name}'.")
-        print("Ensure you are in the correct folder and the filename is correct.")
-        sys.exit(1)
+
+    record = metrics.finish('ok', rows_in=rows_in, rows_out=len(result), frame_mb=round(frame_memory_mb(result), 1))
+    print(f"DONE: {stage_name} successfully executed in {record['wall_s']:.1f} seconds "
+          f"(CPU {record['cpu_s']:.1f} s, {rows_in} -> {len(result)} rows).")
+    return result
+
+
+def stage_threads(stage, options):
+    """Threads a stage takes from the budget: its model share, or one for light stages."""
+    return options.model_threads if stage['models'] else 1
+
+
+def run_graph(plan, current, previous, options, write_intermediate):
+    """
+    Runs the stages of the plan as soon as their dependencies are done, with
+    independent branches in parallel threads. A stage only starts when its
+    threads fit in the remaining budget ('--max-threads').
+    Returns {name: output}, or None when a stage failed.
+    """
+    results = {}
+    done = set()
+    pending = []
+
+    for stage in STAGES:
+        name = stage['name']
+        action, reason = plan[name]
+        if action == 'run':
+            pending.append(stage)
+            continue
+        print(f"\nSKIPPED: {name} ({reason}).")
+        if action == 'load':
+            results[name] = stage['load'](stage['output'])
+            if options.low_memory and isinstance(results[name], pd.DataFrame):
+                results[name] = compact_frame(results[name])
+        append_run_log({'run_id': options.run_id, 'stage': name, 'status': SKIP_STATUS[action], 'reason': reason})
+        done.add(name)
+
+    running = {}
+    threads_in_use = 0
+    failed = False
+
+    with ThreadPoolExecutor(max_workers=len(STAGES)) as executor:
+        while (pending and not failed) or running:
+            # Start every stage whose dependencies are done and that fits in the budget
+            for stage in list(pending):
+                if failed:
+                    break
+                threads = stage_threads(stage, options)
+                ready = all(dep in done for dep in stage['depends_on'])
+                fits = threads_in_use + threads <= options.max_threads or not running
+                if options.profile:
+                    # cProfile measures one stage at a time, so profiled stages run one by one
+                    fits = not running
+                if ready and fits:
+                    is_final = not any(stage['name'] in s['depends_on'] for s in STAGES)
+                    write = write_intermediate or is_final
+                    inputs = {dep: results[dep] for dep in stage['depends_on']}
+                    future = executor.submit(run_stage, stage['name'], stage['run'], inputs, options, write)
+                    running[future] = (stage, write)
+                    threads_in_use += threads
+                    pending.remove(stage)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, write = running.pop(future)
+                threads_in_use -= stage_threads(stage, options)
+                name = stage['name']
+                try:
+                    results[name] = future.result()
+                except SystemExit:
+                    # Let the stages that are already running finish, start nothing new
+                    failed = True
+                    continue
+                done.add(name)
+
+                # Record the successful run right away, so a later failure keeps this progress.
+                # The output digest tells later runs whether the file on disk belongs to this run.
+                previous[name] = {
+                    'fingerprint': current[name][0],
+                    'components': current[name][1],
+                    'output_digest': file_digest(stage['output']) if write else None,
+                }
+                save_fingerprints(previous)
+
+    return None if failed else results
+
 
 def main():
-    print("--- STARTING AUTOMATIC DATA PIPELINE ---")
-    
-    # STEP 1: Clean Data
-    run_script('clean_reviews.py')
+    parser = argparse.ArgumentParser(description="Runs the full review pipeline in one process.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only process reviews that are new or updated since the last run")
+    parser.add_argument('--write-intermediate', action='store_true',
+                        help="also save the output of every stage, not only the final file")
+    parser.add_argument('--force', action='append', default=[], metavar='STAGE',
+                        choices=STAGE_NAMES + ['all'],
+                        help="run this stage even if it is up to date (repeatable, or 'all')")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only show which stages would run and why")
+    parser.add_argument('--profile', action='store_true',
+                        help="run every stage under cProfile (one stage at a time), stats go to 'profiles/'")
+    parser.add_argument('--max-threads', type=int, default=os.cpu_count() or 1,
+                        help="total CPU threads for all stages running at the same time")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="keep the reviews in compact column types (categoricals, int8, float32)")
+    parser.add_argument('--backend', choices=analyse_sentiment.BACKENDS, default=analyse_sentiment.DEFAULT_BACKEND,
+                        help="sentiment inference backend ('onnx': int8-quantized ONNX Runtime)")
+    parser.add_argument('--topic-training', choices=analyse_topics.TRAINING_MODES,
+                        default=analyse_topics.DEFAULT_TRAINING,
+                        help="'online' trains the topic model on batches of comments (bounded memory)")
+    parser.add_argument('--topic-batch-size', type=int, default=analyse_topics.ONLINE_BATCH_SIZE,
+                        help="comments per batch for --topic-training online")
+    parser.add_argument('--export', choices=merge_with_weather.EXPORT_FORMATS, default='json',
+                        help="format of the Power BI output ('star': month-partitioned Parquet tables)")
+    args = parser.parse_args()
+    if args.topic_batch_size < analyse_topics.ONLINE_TOPICS:
+        parser.error(f"--topic-batch-size must be at least {analyse_topics.ONLINE_TOPICS} (one comment per topic)")
 
-    # STEP 2: Sentiment Analysis
-    run_script('analyse_sentiment.py')
+    # A star-schema export is up to date when its manifest is
+    for stage in STAGES:
+        if stage['name'] == 'merge_with_weather':
+            stage['output'] = merge_with_weather.output_file(args.export)
 
-    # STEP 3: Topic Modeling
-    run_script('analyse_topics.py')
+    # Incremental runs reuse the intermediate files of the previous run
+    write_intermediate = args.write_intermediate or args.incremental
+    force = set(STAGE_NAMES) if 'all' in args.force else set(args.force)
 
-    # STEP 4: Enrich with Weather Data
-    run_script('merge_with_weather.py')
+    previous = load_fingerprints()
+    current = compute_fingerprints(args)
+    plan = plan_pipeline(current, previous, force)
+    print_plan(plan)
+
+    if args.dry_run:
+        return
+
+    if all(action != 'run' for action, _ in plan.values()):
+        print("\nEverything is up to date, nothing to do.")
+        return
+
+    print("\n--- STARTING AUTOMATIC DATA PIPELINE ---")
+    if args.incremental:
+        print("Incremental mode: only new or updated reviews are processed.")
+
+    # Model stages share the thread budget; light stages count as one thread.
+    # All stages run in this process, so the limits below are process-wide:
+    # each model stage may use 'model_threads' threads, and the scheduler
+    # only lets as many model stages run at once as fit in '--max-threads'.
+    # The environment variables only reach libraries that have not started
+    # their thread pools yet and worker processes started later.
+    running_models = [s for s in STAGES if s['models'] and plan[s['name']][0] == 'run']
+    args.model_threads = max(1, args.max_threads // max(1, len(running_models)))
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMBA_NUM_THREADS'):
+        os.environ.setdefault(variable, str(args.model_threads))
+    set_torch_threads(args.model_threads)
+    print(f"Thread budget: {args.max_threads} in total, {args.model_threads} per model stage "
+          f"(process-wide setting).")
+
+    args.run_id = new_run_id()
+    start_wall, start_cpu = time.perf_counter(), cpu_seconds()
+    results = run_graph(plan, current, previous, args, write_intermediate)
+
+    append_run_log({
+        'run_id': args.run_id, 'stage': 'pipeline', 'status': 'failed' if results is None else 'ok',
+        'wall_s': round(time.perf_counter() - start_wall, 3), 'cpu_s': round(cpu_seconds() - start_cpu, 3),
+        'peak_rss_mb': peak_memory_mb(), 'max_threads': args.max_threads, 'incremental': args.incremental,
+        'low_memory': args.low_memory, 'topic_training': args.topic_training, 'backend': args.backend
+    })
+    print(f"\nMetrics of run {args.run_id} appended to '{RUN_LOG_FILE}'.")
+    if results is None:
+        sys.exit(1)
 
     print("\n" + "="*60)
     print("SUCCESS! The full pipeline has completed.")
-    print("You can now open 'final_data_for_powerbi.json' in Power BI.")
+    powerbi_source = powerbi_export.EXPORT_DIR if args.export == 'star' else merge_with_weather.OUTPUT_FILE
+    print(f"You can now open '{powerbi_source}' in Power BI.")
     print("="*60)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
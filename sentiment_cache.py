@@ -0,0 +1,100 @@
+import hashlib
+import os
+import sqlite3
+
+# On-disk cache with the sentiment of every comment that has been scored before
+CACHE_FILE = 'sentiment_cache.sqlite'
+
+
+def base_model(model_id):
+    """The 'name@revision' part of a model identifier, without the backend suffix."""
+    return model_id.split('+', 1)[0]
+
+
+def comment_key(model_id, text):
+    """Content address of a comment: hash of the model identifier plus the text."""
+    return hashlib.sha256(f"{model_id}\0{text}".encode('utf-8')).hexdigest()
+
+
+class SentimentCache:
+    """
+    Persistent mapping comment text -> (sentiment_label, sentiment_score)
+    for one model.
+
+    Entries are keyed on a hash of the model identifier ('name@revision',
+    plus a suffix for a non-default backend) and the comment text. Entries
+    of every backend of the same model are kept side by side, so switching
+    '--backend' or running '--check-onnx' keeps both; entries of a retired
+    model name or revision are removed when the cache is opened.
+    """
+
+    def __init__(self, model_id, cache_file=CACHE_FILE):
+        self.model_id = model_id
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sentiment ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL,"
+            " label TEXT NOT NULL, score REAL NOT NULL)"
+        )
+        retired = [
+            model for (model,) in self.connection.execute("SELECT DISTINCT model FROM sentiment")
+            if base_model(model) != base_model(model_id)
+        ]
+        removed = sum(
+            self.connection.execute("DELETE FROM sentiment WHERE model = ?", (model,)).rowcount
+            for model in retired
+        )
+        self.connection.commit()
+        if removed:
+            print(f"Sentiment cache: {removed} entries of a retired model removed ({', '.join(retired)}).")
+
+    def get_many(self, texts):
+        """
+        Looks up a list of comments. Returns a dict text -> {'label', 'score'}
+        for the comments that are in the cache and updates the hit counters.
+        """
+        keys = {comment_key(self.model_id, text): text for text in set(texts)}
+        found = {}
+
+        key_list = list(keys)
+        # Stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(key_list), 500):
+            batch = key_list[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = self.connection.execute(
+                f"SELECT key, label, score FROM sentiment WHERE key IN ({placeholders})", batch
+            )
+            for key, label, score in rows:
+                found[keys[key]] = {'label': label, 'score': score}
+
+        self.hits += sum(1 for text in texts if text in found)
+        self.misses += sum(1 for text in texts if text not in found)
+        return found
+
+    def put_many(self, results):
+        """Stores a dict text -> {'label', 'score'}."""
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO sentiment (key, model, label, score) VALUES (?, ?, ?, ?)",
+            [
+                (comment_key(self.model_id, text), self.model_id, s['label'], float(s['score']))
+                for text, s in results.items()
+            ]
+        )
+        self.connection.commit()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        print(
+            f"Sentiment cache: {self.hits} hits, {self.misses} misses "
+            f"(hit rate {self.hit_rate():.1%}) in '{os.path.basename(self.cache_file)}'."
+        )
+
+    def close(self):
+        self.connection.close()
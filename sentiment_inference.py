@@ -0,0 +1,162 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from stage_metrics import record_metrics
+from model_client import remote_score
+
+# Defaults for the batched inference engine
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_WORKERS = 1
+MAX_LENGTH = 512
+
+# Inference backends: full precision PyTorch or int8-quantized ONNX Runtime
+BACKENDS = ('torch', 'onnx')
+DEFAULT_BACKEND = 'torch'
+
+# Pipeline of the current (worker) process, loaded once by init_worker()
+_worker_pipeline = None
+
+
+def model_id(model_name, revision, backend=DEFAULT_BACKEND):
+    """Identifier of the model as used for caching ('name@revision[+backend]')."""
+    base_id = f"{model_name}@{revision}"
+    return base_id if backend == 'torch' else f"{base_id}+onnx-int8"
+
+
+def load_sentiment_pipeline(model_name, revision, threads=None, backend=DEFAULT_BACKEND):
+    """
+    Loads the sentiment pipeline for the chosen backend. With 'threads' set,
+    inference is limited to that many intra-op threads in this process.
+    """
+    if backend == 'onnx':
+        from sentiment_onnx import load_onnx_pipeline
+        return load_onnx_pipeline(model_name, revision, threads)
+
+    import torch
+    from transformers import pipeline
+
+    if threads:
+        torch.set_num_threads(threads)
+
+    return pipeline(
+        "sentiment-analysis",
+        model=model_name,
+        tokenizer=model_name,
+        revision=revision
+    )
+
+
+def init_worker(model_name, revision, threads, backend=DEFAULT_BACKEND):
+    """Process pool initializer: one model replica per worker process."""
+    global _worker_pipeline
+    _worker_pipeline = load_sentiment_pipeline(model_name, revision, threads, backend)
+
+
+def score_batch(texts):
+    """Scores one length bucket with the pipeline of this process."""
+    # 'truncation=True' prevents errors with very long reviews
+    return _worker_pipeline(texts, batch_size=len(texts), truncation=True, max_length=MAX_LENGTH)
+
+
+def length_buckets(texts, batch_size):
+    """
+    Groups the positions of 'texts' into batches of similar length.
+
+    Sorting on length first means every batch is padded to roughly the
+    length of its own texts instead of the longest comment overall.
+    """
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def score_in_buckets(sentiment_pipeline, texts, batch_size=DEFAULT_BATCH_SIZE):
+    """Scores 'texts' with one pipeline in length buckets; results in the order of 'texts'."""
+    buckets = length_buckets(texts, batch_size)
+    results = [None] * len(texts)
+    for bucket in buckets:
+        # 'truncation=True' prevents errors with very long reviews
+        scores = sentiment_pipeline([texts[i] for i in bucket], batch_size=len(bucket),
+                                    truncation=True, max_length=MAX_LENGTH)
+        for i, score in zip(bucket, scores):
+            results[i] = score
+    return results
+
+
+def score_comments(texts, model_name, revision, batch_size=DEFAULT_BATCH_SIZE,
+                   workers=DEFAULT_WORKERS, threads_per_worker=None, backend=DEFAULT_BACKEND):
+    """
+    Scores a list of comments with length-bucketed batches, optionally spread
+    over a pool of worker processes. Returns one {'label', 'score'} dict per
+    comment, in the order of 'texts'.
+    """
+    if not texts:
+        return []
+
+    # A running model server already has the model loaded
+    start_time = time.perf_counter()
+    served = remote_score(texts, model_id(model_name, revision, backend), batch_size)
+    if served is not None:
+        elapsed = max(time.perf_counter() - start_time, 1e-9)
+        print(f"Scored {len(texts)} comments with the model server in {elapsed:.1f} s "
+              f"({len(texts) / elapsed:.1f} comments/s).")
+        record_metrics(model_load_s=0.0, inference_s=round(elapsed, 3), served_by='model_server',
+                       comments_scored=len(texts), comments_per_s=round(len(texts) / elapsed, 1))
+        return served
+
+    workers = max(1, workers)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    if backend == 'onnx':
+        # Export once up front instead of letting every worker race for it
+        from sentiment_onnx import export_quantized_model
+        export_quantized_model(model_name, revision)
+
+    buckets = length_buckets(texts, batch_size)
+    bucket_texts = [[texts[i] for i in bucket] for bucket in buckets]
+
+    print(f"Scoring {len(texts)} comments in {len(buckets)} batches of up to {batch_size} "
+          f"({backend} backend, {workers} worker(s), {threads_per_worker} thread(s) each)...")
+
+    start_time = time.perf_counter()
+    load_time = None
+
+    if workers == 1:
+        init_worker(model_name, revision, threads_per_worker, backend)
+        load_time = time.perf_counter() - start_time
+        bucket_results = [score_batch(batch) for batch in bucket_texts]
+    else:
+        # 'spawn' gives every worker a clean interpreter, forking a process
+        # that already has torch threads running can deadlock
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(model_name, revision, threads_per_worker, backend)
+        ) as executor:
+            bucket_results = list(executor.map(score_batch, bucket_texts))
+
+    elapsed = time.perf_counter() - start_time
+
+    # Put every result back on the position of its comment
+    results = [None] * len(texts)
+    for bucket, scores in zip(buckets, bucket_results):
+        for i, score in zip(bucket, scores):
+            results[i] = score
+
+    print(f"Scored {len(texts)} comments in {elapsed:.1f} s ({len(texts) / elapsed:.1f} comments/s).")
+    # With a process pool the models load inside the workers, so load and inference are not split
+    inference_time = elapsed
+    if load_time is not None:
+        inference_time = max(elapsed - load_time, 1e-9)
+        print(f"  Model load {load_time:.1f} s, inference {len(texts) / inference_time:.1f} comments/s.")
+
+    record_metrics(
+        model_load_s=None if load_time is None else round(load_time, 3), inference_s=round(inference_time, 3),
+        comments_scored=len(texts), comments_per_s=round(len(texts) / inference_time, 1)
+    )
+
+    return results
@@ -0,0 +1,119 @@
+import json
+import os
+
+import numpy as np
+
+# Local cache of exported (and quantized) ONNX models
+ONNX_DIR = 'onnx_models'
+ONNX_OPSET = 14
+
+
+def onnx_model_dir(model_name, revision):
+    """Directory of the exported artifact for this model and revision."""
+    safe_name = model_name.replace('/', '--')
+    return os.path.join(ONNX_DIR, f"{safe_name}@{revision}")
+
+
+def export_quantized_model(model_name, revision):
+    """
+    Exports the model to ONNX once and quantizes the weights to int8
+    (dynamic quantization). Returns the directory with 'model.int8.onnx',
+    the tokenizer and the model config. An existing export is reused.
+    """
+    export_dir = onnx_model_dir(model_name, revision)
+    quantized_path = os.path.join(export_dir, 'model.int8.onnx')
+    if os.path.exists(quantized_path):
+        return export_dir
+
+    import torch
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    print(f"Exporting '{model_name}' ({revision}) to ONNX (one-time step)...")
+    os.makedirs(export_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, revision=revision)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name, revision=revision)
+    model.eval()
+
+    # --- 1. Export the full precision graph with dynamic batch and sequence axes ---
+    float_path = os.path.join(export_dir, 'model.onnx')
+    sample = tokenizer(["Lekker gegeten!"], return_tensors='pt')
+    token_axes = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample['input_ids'], sample['attention_mask']),
+            float_path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['logits'],
+            dynamic_axes={
+                'input_ids': token_axes,
+                'attention_mask': token_axes,
+                'logits': {0: 'batch'}
+            },
+            opset_version=ONNX_OPSET
+        )
+
+    # --- 2. Dynamic int8 quantization of the weights ---
+    quantize_dynamic(float_path, quantized_path, weight_type=QuantType.QInt8)
+    os.remove(float_path)
+
+    tokenizer.save_pretrained(export_dir)
+    model.config.save_pretrained(export_dir)
+    with open(os.path.join(export_dir, 'export_info.json'), 'w', encoding='utf-8') as f:
+        json.dump({"model_name": model_name, "revision": revision, "opset": ONNX_OPSET,
+                   "quantization": "dynamic-int8"}, f, indent=2)
+
+    print(f"ONNX model saved in '{export_dir}'.")
+    return export_dir
+
+
+class OnnxSentimentPipeline:
+    """
+    Drop-in replacement for the transformers sentiment pipeline that runs
+    the quantized model with ONNX Runtime. Returns the same
+    [{'label': ..., 'score': ...}] output (softmax of the top class).
+    """
+
+    def __init__(self, export_dir, threads=None):
+        import onnxruntime
+        from transformers import AutoConfig, AutoTokenizer
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(export_dir, 'model.int8.onnx'), options,
+            providers=['CPUExecutionProvider']
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        self.id2label = AutoConfig.from_pretrained(export_dir).id2label
+
+    def __call__(self, texts, batch_size=32, truncation=True, max_length=512):
+        results = []
+        for start in range(0, len(texts), batch_size):
+            encoded = self.tokenizer(
+                texts[start:start + batch_size], padding=True,
+                truncation=truncation, max_length=max_length, return_tensors='np'
+            )
+            logits = self.session.run(['logits'], {
+                'input_ids': encoded['input_ids'].astype(np.int64),
+                'attention_mask': encoded['attention_mask'].astype(np.int64)
+            })[0]
+
+            # Numerically stable softmax
+            exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+            probabilities = exp / exp.sum(axis=1, keepdims=True)
+            best = probabilities.argmax(axis=1)
+
+            results.extend(
+                {'label': self.id2label[int(label)], 'score': float(probabilities[i, label])}
+                for i, label in enumerate(best)
+            )
+        return results
+
+
+def load_onnx_pipeline(model_name, revision, threads=None):
+    """Exports the model if needed and returns an OnnxSentimentPipeline."""
+    return OnnxSentimentPipeline(export_quantized_model(model_name, revision), threads)
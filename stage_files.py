@@ -0,0 +1,200 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Intermediate files between the stages are compressed Parquet tables;
+# only the final Power BI export is written as JSON
+COMPRESSION = 'zstd'
+
+# Column types of the clean reviews (all other stages add columns to these)
+CLEAN_SCHEMA = pa.schema([
+    ('reviewId', pa.string()),
+    ('locationId', pa.string()),
+    ('reviewerName', pa.string()),
+    ('rating', pa.int8()),
+    ('createTime', pa.string()),
+    ('comment', pa.string()),
+    ('comment_original', pa.string()),  # Text the reviewer wrote, without Google's translation
+    ('comment_translated', pa.string()),
+    ('comment_language', pa.string()),
+    ('replyComment', pa.string()),
+    ('comment_group', pa.string()),  # reviewId of the first review with (nearly) the same comment
+])
+
+
+# Low-memory mode: repeated strings as categoricals and small numeric types.
+# The export writes these back as the default mode has them (see iso_times)
+CATEGORY_COLUMNS = ['locationId', 'reviewerName', 'sentiment_label', 'comment_language', 'replyComment']
+# Share of distinct values up to which a column is kept as categorical
+MAX_CATEGORY_SHARE = 0.5
+INT_COLUMNS = {'rating': 'Int8', 'topic_nr': 'Int16'}
+# ISO-8601 texts kept as timestamps
+TIME_COLUMNS = ['createTime']
+TIME_DTYPE = 'datetime64[us, UTC]'
+# Model outputs that are float32 values already: float32 keeps them exactly
+FLOAT32_EXACT_COLUMNS = ['sentiment_score']
+
+# The comment texts, which only the model stages need
+TEXT_COLUMNS = ['comment', 'comment_original', 'comment_translated', 'comment_group']
+
+
+def compact_frame(df):
+    """
+    Returns 'df' with low-memory column types: categoricals for labels and
+    names that repeat, Int8/Int16 for ratings and topics, UTC timestamps for
+    TIME_COLUMNS and float32 for the weather and model scores. Other columns
+    are left as they are.
+    """
+    df = df.copy(deep=False)
+    for column in df.columns:
+        if column in CATEGORY_COLUMNS:
+            # Only worth it when values repeat (reviewer names mostly do not)
+            if df[column].nunique() <= len(df) * MAX_CATEGORY_SHARE:
+                df[column] = df[column].astype('category')
+            elif isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(str).where(df[column].notna())
+        elif column in INT_COLUMNS:
+            df[column] = df[column].astype(INT_COLUMNS[column])
+        elif column in TIME_COLUMNS:
+            df[column] = compact_times(df[column])
+        elif df[column].dtype == 'float64':
+            df[column] = df[column].astype('float32')
+    return df
+
+
+def compact_times(texts):
+    """
+    ISO-8601 UTC texts as TIME_DTYPE timestamps, or the texts unchanged when
+    iso_times() would not give them back exactly (other layouts, nanoseconds).
+    """
+    if isinstance(texts.dtype, pd.DatetimeTZDtype):
+        return texts.astype(TIME_DTYPE)
+    try:
+        times = pd.to_datetime(texts, utc=True, format='ISO8601').astype(TIME_DTYPE)
+    except (ValueError, TypeError):
+        return texts
+    written = iso_times(times)
+    if not ((written == texts) | (written.isna() & texts.isna())).all():
+        return texts
+    return times
+
+
+def iso_times(times):
+    """
+    Timestamps as the ISO-8601 texts of the Google export, such as
+    '2019-11-09T08:01:14.828317Z': with 0, 3 or 6 decimals, the fewest that
+    hold the value (as protobuf writes them). Missing times stay missing.
+    """
+    micros = times.dt.microsecond.fillna(0).astype('int64')
+    decimals = (micros + 1000000).astype(str).str[1:]
+    fraction = decimals.where(micros % 1000 != 0, decimals.str[:3]).where(micros != 0, '')
+    texts = times.dt.strftime('%Y-%m-%dT%H:%M:%S') + ('.' + fraction).where(micros != 0, '') + 'Z'
+    return texts.where(times.notna())
+
+
+def frame_memory_mb(df):
+    """Memory of a DataFrame in MB, including the strings it holds."""
+    return df.memory_usage(deep=True).sum() / 2**20
+
+
+def write_table(df, file_path):
+    """Saves a DataFrame as a Parquet file (written to a temporary file first)."""
+    tmp_file = file_path + '.tmp'
+    df.to_parquet(tmp_file, engine='pyarrow', compression=COMPRESSION, index=False)
+    os.replace(tmp_file, file_path)
+
+
+def read_table(file_path, columns=None, low_memory=False):
+    """
+    Loads a Parquet file into a DataFrame. With 'columns' only those columns
+    are read from disk; with low_memory=True they get the compact types of
+    compact_frame().
+    """
+    df = pd.read_parquet(file_path, engine='pyarrow', columns=columns)
+    return compact_frame(df) if low_memory else df
+
+
+def iter_table(file_path, columns=None):
+    """
+    Loads a Parquet file one row group at a time, as DataFrames; with
+    'columns' only those columns are read from disk.
+    """
+    for batch in pq.ParquetFile(file_path).iter_batches(columns=columns):
+        yield batch.to_pandas()
+
+
+def table_columns(file_path):
+    """Column names of a Parquet file, without reading its data."""
+    return pq.read_schema(file_path).names
+
+
+def write_records(records, file_path, schema):
+    """Saves a list of dicts as a Parquet file with the given column types."""
+    with RecordWriter(file_path, schema) as writer:
+        for record in records:
+            writer.write(record)
+
+
+def set_column(file_path, name, values):
+    """
+    Replaces the values of one column of a Parquet file, one row group at a
+    time. 'values' holds a value for every row, in file order.
+    """
+    source = pq.ParquetFile(file_path)
+    schema = source.schema_arrow
+    index = schema.get_field_index(name)
+    field = schema.field(index)
+    start = 0
+    with pq.ParquetWriter(file_path + '.tmp', schema, compression=COMPRESSION) as writer:
+        for batch in source.iter_batches():
+            column = pa.array(values[start:start + batch.num_rows], type=field.type)
+            writer.write_table(pa.Table.from_batches([batch]).set_column(index, field, column))
+            start += batch.num_rows
+    os.replace(file_path + '.tmp', file_path)
+
+
+def read_records(file_path):
+    """Loads a Parquet file as a list of dicts (missing values as None)."""
+    return pq.read_table(file_path).to_pylist()
+
+
+class RecordWriter:
+    """
+    Writes dicts to a Parquet file in row groups of 'batch_size' rows, so a
+    stream of records is never fully in memory. Use as a context manager.
+    """
+
+    def __init__(self, file_path, schema, batch_size=10000):
+        self.file_path = file_path
+        self.schema = schema
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = 0
+        self.writer = None
+
+    def __enter__(self):
+        self.writer = pq.ParquetWriter(self.file_path + '.tmp', self.schema, compression=COMPRESSION)
+        return self
+
+    def write(self, record):
+        self.batch.append(record)
+        self.count += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_table(pa.Table.from_pylist(self.batch, schema=self.schema))
+            self.batch = []
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        self.writer.close()
+        if exc_type is None:
+            os.replace(self.file_path + '.tmp', self.file_path)
+        else:
+            os.remove(self.file_path + '.tmp')
+        return False
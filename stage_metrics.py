@@ -0,0 +1,178 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# One JSON object per stage per pipeline run
+RUN_LOG_FILE = 'pipeline_runs.jsonl'
+# cProfile output of 'run_pipeline.py --profile'
+PROFILE_DIR = 'profiles'
+# Seconds between two samples of the resident memory while a stage runs
+MEMORY_SAMPLE_S = 0.01
+
+# Counters of the stage running in the current thread
+_current = threading.local()
+_log_lock = threading.Lock()
+
+
+def record_metrics(**values):
+    """
+    Adds named values (counts, timings) to the metrics of the stage that is
+    running in this thread. Does nothing when no stage is being measured,
+    e.g. when a script is run on its own.
+    """
+    counters = getattr(_current, 'counters', None)
+    if counters is not None:
+        counters.update(values)
+
+
+def peak_memory_mb():
+    """
+    Peak resident memory of this process in MB since it started, or None if
+    it cannot be measured. A process-level figure: it covers every stage the
+    process ran so far (StageMetrics samples the peak of each stage).
+    """
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 2**20
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+
+def current_memory_mb():
+    """Resident memory of this process right now in MB, or None if it cannot be measured."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 2**20
+
+
+class MemorySampler:
+    """
+    Samples the resident memory every MEMORY_SAMPLE_S seconds in a background
+    thread and keeps the highest value ('peak_mb', None if not measurable).
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_S):
+        self.interval = interval
+        self.peak_mb = current_memory_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_memory_mb())
+
+    def start(self):
+        if self.peak_mb is not None:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops sampling and returns the peak in MB (rounded), or None."""
+        if self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+            self.peak_mb = max(self.peak_mb, current_memory_mb())
+        return round(self.peak_mb, 1) if self.peak_mb is not None else None
+
+
+def cpu_seconds():
+    """CPU time of this process and its finished child processes."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def new_run_id():
+    return datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def append_run_log(record, log_file=RUN_LOG_FILE):
+    with _log_lock, open(log_file, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+class StageMetrics:
+    """
+    Measures one stage in the current thread:
+
+        with StageMetrics(run_id, 'clean_reviews') as metrics:
+            result = ...
+        metrics.finish('ok', rows_in=..., rows_out=len(result))
+
+    The peak memory of the stage ('peak_rss_mb') is the highest resident
+    memory sampled while it ran (see MemorySampler); like the CPU time it is
+    measured for the process, so it includes other stages running at the
+    same time. With profile=True the stage is run under cProfile and the
+    stats are written to PROFILE_DIR.
+    """
+
+    def __init__(self, run_id, stage, profile=False):
+        self.run_id = run_id
+        self.stage = stage
+        self.profiler = cProfile.Profile() if profile else None
+        self.counters = {}
+
+    def __enter__(self):
+        _current.counters = self.counters
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_seconds()
+        self.memory = MemorySampler().start()
+        if self.profiler:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler:
+            self.profiler.disable()
+        self.wall_s = time.perf_counter() - self.start_wall
+        self.cpu_s = cpu_seconds() - self.start_cpu
+        self.peak_rss_mb = self.memory.stop()
+        _current.counters = None
+        return False
+
+    def save_profile(self):
+        """Writes the .prof file (for pstats/snakeviz) and a text top 30; returns its path."""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, f"{self.run_id}_{self.stage}")
+        self.profiler.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            pstats.Stats(self.profiler, stream=f).sort_stats('cumulative').print_stats(30)
+        return base + '.prof'
+
+    def finish(self, status, rows_in=None, rows_out=None, **values):
+        """Writes the metrics record (plus any named 'values') to the run log and returns it."""
+        record = {
+            'run_id': self.run_id,
+            'stage': self.stage,
+            'status': status,
+            'wall_s': round(self.wall_s, 3),
+            'cpu_s': round(self.cpu_s, 3),
+            'peak_rss_mb': self.peak_rss_mb,
+            'rows_in': rows_in,
+            'rows_out': rows_out,
+            **self.counters,
+            **values,
+        }
+        if self.profiler:
+            record['profile'] = self.save_profile()
+        append_run_log(record)
+        return record
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import parse_weather
+
+# Coordinates of the review locations: locationId,name,lat,lon
+# (the Google export only has the location ID, so these are filled in by hand;
+# the names come from the owner replies, the coordinates are still to be added)
+LOCATIONS_FILE = 'locations.csv'
+
+# Used for locations without coordinates (Eindhoven, the original download)
+DEFAULT_STATION = 370
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def load_locations():
+    """
+    Returns the review locations indexed by 'locationId', with NaN lat/lon
+    for the locations whose coordinates are not filled in yet.
+    """
+    if not os.path.exists(LOCATIONS_FILE):
+        return pd.DataFrame(columns=['name', 'lat', 'lon'], index=pd.Index([], name='locationId'))
+
+    df = pd.read_csv(LOCATIONS_FILE, dtype={'locationId': str, 'name': str})
+    return df.set_index('locationId')
+
+
+def load_stations():
+    """Returns the KNMI stations from the header of the weather download, indexed by 'STN'."""
+    if not os.path.exists(parse_weather.INPUT_FILE):
+        return pd.DataFrame(columns=['name', 'lat', 'lon'], index=pd.Index([], name='STN'))
+
+    with open(parse_weather.INPUT_FILE, 'r', encoding='utf-8') as f:
+        header = parse_weather.read_knmi_header(f)
+    stations = header['stations'] if header else {}
+    df = pd.DataFrame.from_dict(stations, orient='index', columns=['name', 'lat', 'lon'])
+    df.index.name = 'STN'
+    return df
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km; the arguments broadcast like numpy arrays."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def build_station_index(location_ids, available_stations=None):
+    """
+    Maps every location ID to its nearest KNMI station.
+
+    available_stations: only consider these station numbers (e.g. the
+    stations that are in the weather data). Locations without coordinates,
+    or when no station is known, get DEFAULT_STATION.
+
+    Returns a DataFrame indexed by 'locationId' with 'station' and
+    'distance_km' (NaN for the fallback).
+    """
+    location_ids = pd.Index(pd.unique(pd.Series(location_ids).dropna()), name='locationId')
+    locations = load_locations().reindex(location_ids)
+    stations = load_stations()
+    if available_stations is not None:
+        stations = stations[stations.index.isin(available_stations)]
+
+    index = pd.DataFrame({'station': DEFAULT_STATION, 'distance_km': np.nan}, index=location_ids)
+    known = (locations['lat'].notna() & locations['lon'].notna()).to_numpy()
+
+    if known.any() and len(stations):
+        # Distance matrix locations x stations, nearest station per row
+        distances = haversine_km(
+            locations.loc[known, 'lat'].to_numpy(float)[:, None],
+            locations.loc[known, 'lon'].to_numpy(float)[:, None],
+            stations['lat'].to_numpy(float)[None, :],
+            stations['lon'].to_numpy(float)[None, :],
+        )
+        nearest = distances.argmin(axis=1)
+        index.loc[known, 'station'] = stations.index.to_numpy()[nearest]
+        index.loc[known, 'distance_km'] = distances[np.arange(len(nearest)), nearest]
+
+    missing = location_ids[~known]
+    if len(missing):
+        names = locations.loc[missing, 'name'].fillna('unknown location')
+        print(f"WARNING: No coordinates in '{LOCATIONS_FILE}' for {len(missing)} location(s), "
+              f"using station {DEFAULT_STATION} for them. Fill in 'lat' and 'lon' for:")
+        for location_id, name in names.items():
+            print(f"  {location_id} ({name})")
+
+    index['station'] = index['station'].astype(int)
+    return index
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from weather_rollups import WeatherRollups, LEVELS, SEASONS, DRY_DAY_MM
+
+MEASURES = ['temp_max_c', 'temp_min_c', 'precip_amount_mm']
+
+
+@pytest.fixture(scope='module')
+def df_weather():
+    """Two stations with about three years of random weather, gaps and missing values."""
+    rng = np.random.default_rng(7)
+    frames = []
+    for stn, first, last in ((260, '2019-11-20', '2022-03-05'), (370, '2020-02-01', '2022-12-31')):
+        dates = pd.date_range(first, last, freq='D')
+        dates = dates[rng.random(len(dates)) > 0.02]
+        df = pd.DataFrame({'STN': stn, 'date': dates})
+        df['temp_max_c'] = np.round(rng.normal(15, 8, len(df)), 1)
+        df['temp_min_c'] = np.round(df['temp_max_c'] - rng.uniform(0, 10, len(df)), 1)
+        df['precip_amount_mm'] = np.round(rng.exponential(2, len(df)) * (rng.random(len(df)) > 0.4), 1)
+        for m in MEASURES:
+            df.loc[rng.random(len(df)) < 0.05, m] = np.nan
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def brute_force(df_weather):
+    """The summary per station computed directly from the days."""
+    rows = []
+    for stn, df in df_weather.groupby('STN'):
+        row = {'STN': stn, 'n_days': len(df), 'dry_days': int((df['precip_amount_mm'] <= DRY_DAY_MM).sum())}
+        for m in MEASURES:
+            values = df[m]
+            row[f'{m}_sum'] = values.sum()
+            row[f'{m}_mean'] = values.mean()
+            for extreme in ('min', 'max'):
+                best = getattr(values, extreme)()
+                row[f'{m}_{extreme}'] = best
+                # The earliest day with the extreme value
+                row[f'{m}_{extreme}_day'] = df.loc[values == best, 'date'].min() if values.notna().any() else pd.NaT
+        rows.append(row)
+    return pd.DataFrame(rows) if rows else pd.DataFrame({'STN': []})
+
+
+def assert_same_summary(df_summary, df_expected):
+    df_summary = df_summary.set_index('STN').sort_index()
+    df_expected = df_expected.set_index('STN').sort_index()
+    assert df_summary.index.tolist() == df_expected.index.tolist()
+    for column in df_expected.columns:
+        if column.endswith('_day'):
+            assert df_summary[column].tolist() == df_expected[column].tolist(), column
+        else:
+            np.testing.assert_allclose(df_summary[column].to_numpy(float), df_expected[column].to_numpy(float),
+                                       err_msg=column)
+
+
+def test_summary_of_random_ranges_matches_brute_force(df_weather):
+    rollups = WeatherRollups.from_frame(df_weather)
+    rng = np.random.default_rng(11)
+    days = pd.date_range('2019-10-01', '2023-01-31', freq='D')
+    for _ in range(40):
+        first, last = sorted(rng.choice(days, 2))
+        selected = df_weather[df_weather['date'].between(first, last)]
+        df_summary = rollups.summary(first, last)
+        df_summary = df_summary[df_summary['n_days'] > 0]
+        assert_same_summary(df_summary, brute_force(selected))
+
+
+def test_summary_of_one_station_without_data_in_range(df_weather):
+    rollups = WeatherRollups.from_frame(df_weather)
+    df_summary = rollups.summary('2022-06-01', '2022-06-30', stations=[260])
+    # No rows, or a row without days; never a made-up extreme
+    assert df_summary.empty or (df_summary['n_days'] == 0).all()
+
+
+def test_periods_match_brute_force(df_weather):
+    rollups = WeatherRollups.from_frame(df_weather)
+    df_months = rollups.periods('month')
+    for (stn, start), df in df_weather.groupby(['STN', df_weather['date'].dt.to_period('M')]):
+        row = df_months[(df_months['STN'] == stn) & (df_months['start'] == start.start_time)]
+        assert len(row) == 1
+        assert_same_summary(row, brute_force(df))
+
+
+def test_season_matches_brute_force(df_weather):
+    rollups = WeatherRollups.from_frame(df_weather)
+    months = df_weather['date'].dt.month
+    season_year = df_weather['date'].dt.year + (months == 12)
+    selected = df_weather[months.isin(SEASONS['winter']) & (season_year == 2021)]
+    assert_same_summary(rollups.season('winter', 2021), brute_force(selected))
+
+
+def test_update_equals_rebuild(df_weather):
+    old = df_weather[df_weather['date'] < '2022-01-01']
+    new = df_weather.copy()
+    # A correction of an old day as well as new days
+    new.loc[new['date'] == '2021-05-03', 'temp_max_c'] = 40.0
+
+    rollups = WeatherRollups.from_frame(old)
+    assert rollups.update(new) > 0
+    rebuilt = WeatherRollups.from_frame(new)
+    for level in LEVELS:
+        pd.testing.assert_frame_equal(rollups.tables[level], rebuilt.tables[level], check_like=True)
@@ -0,0 +1,303 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from pipeline_fingerprints import file_digest
+from stage_files import write_table
+from weather_store import to_day_numbers
+
+# Precomputed weather aggregates per station: one table per level, one row
+# per period (identified by its first day number). A date range is answered
+# by combining a few rows: whole years, then months, weeks and days at the edges.
+ROLLUP_DIR = 'weather_rollups'
+ROLLUP_INDEX_FILE = os.path.join(ROLLUP_DIR, 'index.json')
+
+# From large to small; every level's periods are covered exactly by those of the next
+LEVELS = ['year', 'month', 'week', 'day']
+
+# Days with this much precipitation or less are dry
+DRY_DAY_MM = 0.0
+
+# Meteorological seasons (December counts towards the winter of the next year)
+SEASONS = {'winter': [12, 1, 2], 'spring': [3, 4, 5], 'summer': [6, 7, 8], 'autumn': [9, 10, 11]}
+
+
+def period_start(days, level):
+    """First day number of the period of 'level' that holds each day number."""
+    days = np.asarray(days, dtype=np.int64)
+    if level == 'day':
+        return days
+    if level == 'week':
+        # Weeks start on Monday; day 0 (1970-01-01) was a Thursday
+        return days - (days + 3) % 7
+    unit = 'M' if level == 'month' else 'Y'
+    return days.astype('datetime64[D]').astype(f'datetime64[{unit}]').astype('datetime64[D]').astype(np.int64)
+
+
+def period_end(days, level):
+    """Last day number of the period of 'level' that holds each day number."""
+    days = np.asarray(days, dtype=np.int64)
+    if level == 'day':
+        return days
+    if level == 'week':
+        return period_start(days, 'week') + 6
+    unit = 'M' if level == 'month' else 'Y'
+    next_start = days.astype('datetime64[D]').astype(f'datetime64[{unit}]') + 1
+    return next_start.astype('datetime64[D]').astype(np.int64) - 1
+
+
+def day_rows(df_weather):
+    """The 'day' level: one rollup row per station and day of the parsed weather data."""
+    measures = [
+        c for c in df_weather.columns
+        if c not in ('STN', 'date') and pd.api.types.is_numeric_dtype(df_weather[c])
+    ]
+    days = to_day_numbers(df_weather['date'])
+    df = pd.DataFrame({'STN': df_weather['STN'].to_numpy(np.int64), 'start': days, 'n_days': 1})
+    if 'precip_amount_mm' in measures:
+        df['dry_days'] = (df_weather['precip_amount_mm'].to_numpy() <= DRY_DAY_MM).astype(np.int64)
+    for m in measures:
+        values = df_weather[m].to_numpy(float)
+        present = ~np.isnan(values)
+        df[f'{m}_sum'] = np.where(present, values, 0.0)
+        df[f'{m}_count'] = present.astype(np.int64)
+        df[f'{m}_min'] = df[f'{m}_max'] = values
+        # Day numbers as floats: NaN when a period has no value
+        df[f'{m}_min_day'] = df[f'{m}_max_day'] = np.where(present, days, np.nan)
+    return df.sort_values(['STN', 'start'], ignore_index=True), measures
+
+
+def combine(df_rows, by, measures):
+    """
+    Combines rollup rows per group of 'by': sums and counts are added, minima
+    and maxima keep the day they occurred on (the earliest day on ties).
+    """
+    additive = ['n_days'] + [c for c in df_rows.columns if c == 'dry_days' or c.endswith(('_sum', '_count'))]
+    grouped = df_rows.groupby(by, sort=True)
+    df = grouped[additive].sum().reset_index()
+    groups = grouped.ngroup().to_numpy()
+
+    for m in measures:
+        for extreme, sign in (('min', 1), ('max', -1)):
+            value, day = f'{m}_{extreme}', f'{m}_{extreme}_day'
+            values = df_rows[value].to_numpy(float)
+            days = df_rows[day].to_numpy(float)
+            present = np.flatnonzero(~np.isnan(values))
+            # Per group the best value first, earliest day first on ties
+            order = present[np.lexsort((days[present], sign * values[present], groups[present]))]
+            is_first = np.ones(len(order), dtype=bool)
+            is_first[1:] = groups[order][1:] != groups[order][:-1]
+            first = order[is_first]
+            best_values, best_days = np.full(len(df), np.nan), np.full(len(df), np.nan)
+            best_values[groups[first]], best_days[groups[first]] = values[first], days[first]
+            df[value] = best_values
+            df[day] = best_days
+    return df
+
+
+def roll_up(df_days, measures, level):
+    """The rows of 'level' built from day rows."""
+    if level == 'day':
+        return df_days
+    return combine(df_days.assign(start=period_start(df_days['start'], level)), ['STN', 'start'], measures)
+
+
+def cover(first_day, last_day, levels=LEVELS):
+    """
+    (level, first start, last start) blocks of whole periods that together
+    cover exactly the days first_day..last_day: the largest periods in
+    the middle, smaller ones towards the edges.
+    """
+    if first_day > last_day:
+        return []
+    level, smaller = levels[0], levels[1:]
+    if not smaller:
+        return [(level, first_day, last_day)]
+    # Whole periods of this level within the range
+    whole_first = int(period_start(first_day, level))
+    if whole_first < first_day:
+        whole_first = int(period_end(first_day, level)) + 1
+    whole_last = int(period_start(last_day, level))
+    if period_end(last_day, level) > last_day:
+        whole_last = int(period_start(whole_last - 1, level))
+    if whole_first > whole_last:
+        return cover(first_day, last_day, smaller)
+    return (cover(first_day, whole_first - 1, smaller) + [(level, whole_first, whole_last)]
+            + cover(int(period_end(whole_last, level)) + 1, last_day, smaller))
+
+
+class WeatherRollups:
+    """
+    The rollup tables of all levels, sorted by (STN, start). Summaries of
+    any date range combine at most a few dozen rows, however long the range.
+    """
+
+    def __init__(self, tables, measures):
+        self.tables = {}
+        # Per level a sorted key per row (station and start in one number) to find rows with searchsorted
+        self.keys = {}
+        for level, df_level in tables.items():
+            self.set_table(level, df_level)
+        self.measures = list(measures)
+
+    def set_table(self, level, df_level):
+        df_level = df_level.sort_values(['STN', 'start'], ignore_index=True)
+        self.tables[level] = df_level
+        self.keys[level] = row_keys(df_level['STN'].to_numpy(), df_level['start'].to_numpy())
+
+    @property
+    def stations(self):
+        return sorted(self.tables['day']['STN'].unique().tolist())
+
+    @classmethod
+    def from_frame(cls, df_weather):
+        df_days, measures = day_rows(df_weather)
+        return cls({level: roll_up(df_days, measures, level) for level in LEVELS}, measures)
+
+    def update(self, df_weather):
+        """
+        Brings the rollups up to date with new parsed weather data. Per station
+        only the periods from the first new or changed day on are rebuilt.
+        Returns the number of changed days.
+        """
+        df_new, measures = day_rows(df_weather)
+        if measures != self.measures:
+            # Other columns: rebuild everything
+            rebuilt = WeatherRollups.from_frame(df_weather)
+            self.tables, self.keys, self.measures = rebuilt.tables, rebuilt.keys, rebuilt.measures
+            return len(df_new)
+
+        df_old = self.tables['day']
+        compared = df_new.merge(df_old, on=['STN', 'start'], how='outer', suffixes=('', '_old'), indicator=True)
+        columns = [c for c in df_new.columns if c not in ('STN', 'start')]
+        new_values = compared[columns].to_numpy(float)
+        old_values = compared[[f'{c}_old' for c in columns]].to_numpy(float)
+        same = (new_values == old_values) | (np.isnan(new_values) & np.isnan(old_values))
+        changed = compared[(compared['_merge'] != 'both') | ~same.all(axis=1)]
+        if changed.empty:
+            return 0
+
+        first_changed = changed.groupby('STN')['start'].min()
+        for level in LEVELS:
+            since = pd.Series(period_start(first_changed.to_numpy(), level), index=first_changed.index)
+            df_level = self.tables[level]
+            keep = df_level['start'] < df_level['STN'].map(since).fillna(np.iinfo(np.int64).max)
+            rebuild = df_new['start'] >= df_new['STN'].map(since).fillna(np.iinfo(np.int64).max)
+            self.set_table(level, pd.concat([df_level[keep], roll_up(df_new[rebuild], measures, level)]))
+        return len(changed)
+
+    def positions(self, level, first_start, last_start, stations):
+        """Row positions in the table of 'level' of the stations' periods starting in the range."""
+        stations = np.asarray(stations, dtype=np.int64)
+        keys = self.keys[level]
+        lows = np.searchsorted(keys, row_keys(stations, first_start))
+        highs = np.searchsorted(keys, row_keys(stations, last_start), side='right')
+        return np.concatenate([np.arange(low, high) for low, high in zip(lows, highs)])
+
+    def rows(self, level, first_start, last_start, stations=None):
+        """Rows of 'level' with a start between first_start and last_start."""
+        stations = self.stations if stations is None else stations
+        return self.tables[level].iloc[self.positions(level, first_start, last_start, stations)]
+
+    def summary(self, first_date=None, last_date=None, stations=None):
+        """
+        Summary per station of the days from first_date up to and including
+        last_date (default: all data), combined from the rollup rows.
+        """
+        days = self.tables['day']['start']
+        first_day = int(to_day_numbers([first_date])[0]) if first_date is not None else int(days.min())
+        last_day = int(to_day_numbers([last_date])[0]) if last_date is not None else int(days.max())
+
+        parts = [self.rows(level, first, last, stations) for level, first, last in cover(first_day, last_day)]
+        # An empty range (last before first) gives an empty summary
+        df_rows = pd.concat(parts or [self.tables['day'].iloc[:0]], ignore_index=True)
+        return finish(combine(df_rows, ['STN'], self.measures), self.measures)
+
+    def periods(self, level, first_date=None, last_date=None, stations=None):
+        """One summary row per period of 'level' that starts within the date range."""
+        starts = self.tables[level]['start']
+        first_start = int(to_day_numbers([first_date])[0]) if first_date is not None else int(starts.min())
+        last_start = int(to_day_numbers([last_date])[0]) if last_date is not None else int(starts.max())
+        return finish(self.rows(level, first_start, last_start, stations), self.measures)
+
+    def season(self, season, year=None, stations=None):
+        """
+        Summary of a season (see SEASONS) per station: of one year, or of all
+        years together. Built from the month rows only.
+        """
+        months = SEASONS[season]
+        df_months = self.tables['month']
+        dates = df_months['start'].to_numpy().astype('datetime64[D]')
+        month = pd.DatetimeIndex(dates).month
+        # December belongs to the winter of the next year
+        season_year = pd.DatetimeIndex(dates).year + (month == 12)
+        selected = np.isin(month, months)
+        if year is not None:
+            selected &= season_year == year
+        if stations is not None:
+            selected &= df_months['STN'].isin(stations).to_numpy()
+        return finish(combine(df_months[selected], ['STN'], self.measures), self.measures)
+
+    def save(self, source_digest, rollup_dir=ROLLUP_DIR, index_file=ROLLUP_INDEX_FILE):
+        os.makedirs(rollup_dir, exist_ok=True)
+        for level, df_level in self.tables.items():
+            write_table(df_level, os.path.join(rollup_dir, f'{level}.parquet'))
+        with open(index_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'source_digest': source_digest, 'measures': self.measures, 'levels': LEVELS}, f, indent=2)
+        os.replace(index_file + '.tmp', index_file)
+
+    @classmethod
+    def load(cls, rollup_dir=ROLLUP_DIR, index_file=ROLLUP_INDEX_FILE):
+        """Returns (rollups, digest of the weather data they were built from), or (None, None)."""
+        if not os.path.exists(index_file):
+            return None, None
+        with open(index_file, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        level_files = {level: os.path.join(rollup_dir, f'{level}.parquet') for level in index['levels']}
+        if index['levels'] != LEVELS or not all(os.path.exists(p) for p in level_files.values()):
+            return None, None
+        tables = {level: pd.read_parquet(path, engine='pyarrow') for level, path in level_files.items()}
+        return cls(tables, index['measures']), index['source_digest']
+
+
+def row_keys(stations, starts):
+    """One sortable number per (station, period start); start day numbers fit in 32 bits."""
+    return np.asarray(stations, dtype=np.int64) * (1 << 32) + (np.asarray(starts, dtype=np.int64) + (1 << 31))
+
+
+def finish(df_rows, measures):
+    """Adds averages and readable dates to combined rollup rows."""
+    df = df_rows.copy()
+    for m in measures:
+        df[f'{m}_mean'] = df[f'{m}_sum'] / df[f'{m}_count'].where(df[f'{m}_count'] > 0)
+    day_columns = ['start'] + [c for c in df.columns if c.endswith('_day')]
+    for c in day_columns:
+        if c in df.columns:
+            df[c] = pd.to_datetime(df[c].astype(float), unit='D')
+    return df
+
+
+def update_rollups(weather_file, df_weather=None):
+    """
+    The rollups of the weather CSV 'weather_file', brought up to date if the
+    file changed since they were saved. Returns None if there is no data.
+    """
+    digest = file_digest(weather_file)
+    rollups, saved_digest = WeatherRollups.load()
+    if rollups is not None and saved_digest == digest:
+        return rollups
+    if df_weather is None:
+        if not os.path.exists(weather_file):
+            return rollups
+        df_weather = pd.read_csv(weather_file, parse_dates=['date'])
+
+    if rollups is None:
+        rollups = WeatherRollups.from_frame(df_weather)
+        print(f"Weather rollups built for {len(df_weather)} days.")
+    else:
+        changed = rollups.update(df_weather)
+        print(f"Weather rollups updated: {changed} new or changed days.")
+    rollups.save(digest)
+    return rollups
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Day-indexed weather per station, built by 'parse_weather.py'
+STORE_FILE = 'weather_store.bin'
+STORE_INDEX_FILE = 'weather_store.json'
+STORE_DTYPE = 'float64'
+
+# Reviews are matched to the weather of their local calendar day
+REVIEW_TIMEZONE = 'Europe/Amsterdam'
+
+# Day number used for missing timestamps; always outside the store
+MISSING_DAY = -(1 << 40)
+
+# Derived features: trailing precipitation sums (window in days) and the
+# deviation from the mean temperature of the same calendar day in all years
+ROLLING_PRECIP = {'precip_3d_mm': 3, 'precip_7d_mm': 7}
+ANOMALY_FEATURE = 'temp_anomaly_c'
+
+
+def to_day_numbers(dates):
+    """Days since 1970-01-01 for an array/Series of dates (datetime-like)."""
+    return np.asarray(pd.to_datetime(dates), dtype='datetime64[D]').astype(np.int64)
+
+
+def review_days(create_times, timezone=REVIEW_TIMEZONE):
+    """
+    Day numbers of the local calendar day of ISO-8601 UTC timestamps such as
+    '2019-11-09T23:23:35.246140Z'. Unparseable values get MISSING_DAY.
+    """
+    timestamps = pd.to_datetime(pd.Series(create_times), utc=True, format='ISO8601', errors='coerce')
+    local_dates = timestamps.dt.tz_convert(timezone).dt.tz_localize(None).dt.normalize()
+    days = np.full(len(local_dates), MISSING_DAY, dtype=np.int64)
+    valid = local_dates.notna().to_numpy()
+    days[valid] = to_day_numbers(local_dates[valid])
+    return days
+
+
+def rolling_sum(values, window):
+    """Trailing sum over 'window' days along axis 1; NaN until the window is full."""
+    result = np.full(values.shape, np.nan)
+    if values.shape[1] >= window:
+        result[:, window - 1:] = sliding_window_view(values, window, axis=1).sum(axis=-1)
+    return result
+
+
+class WeatherStore:
+    """
+    Weather as a dense (station, day, feature) array. A value is found with
+    integer offsets: the station's row and the day number minus 'first_day'.
+    Days without data are NaN.
+    """
+
+    def __init__(self, data, stations, first_day, features):
+        self.data = data
+        self.stations = np.asarray(stations, dtype=np.int64)
+        self.first_day = int(first_day)
+        self.features = list(features)
+
+    @property
+    def n_days(self):
+        return self.data.shape[1]
+
+    @classmethod
+    def from_frame(cls, df_weather):
+        """Builds the store (incl. derived features) from the parsed weather data."""
+        days = to_day_numbers(df_weather['date'])
+        stations = np.sort(df_weather['STN'].unique())
+        base_features = [
+            c for c in df_weather.columns
+            if c not in ('STN', 'date') and pd.api.types.is_numeric_dtype(df_weather[c])
+        ]
+        features = list(base_features)
+        if 'precip_amount_mm' in features:
+            features += list(ROLLING_PRECIP)
+        if 'temp_avg_c' in features:
+            features.append(ANOMALY_FEATURE)
+
+        first_day = days.min()
+        n_days = days.max() - first_day + 1
+        data = np.full((len(stations), n_days, len(features)), np.nan, dtype=STORE_DTYPE)
+        rows = np.searchsorted(stations, df_weather['STN'].to_numpy())
+        data[rows, days - first_day, :len(base_features)] = df_weather[base_features].to_numpy(float)
+
+        # Derived features, computed for all stations at once
+        if 'precip_amount_mm' in features:
+            precip = data[:, :, features.index('precip_amount_mm')]
+            for name, window in ROLLING_PRECIP.items():
+                data[:, :, features.index(name)] = np.round(rolling_sum(precip, window), 1)
+
+        if 'temp_avg_c' in features:
+            temp = data[:, :, features.index('temp_avg_c')]
+            calendar = pd.DatetimeIndex(np.arange(first_day, first_day + n_days).astype('datetime64[D]'))
+            calendar_day = calendar.month * 100 + calendar.day
+            normal = pd.DataFrame(temp.T).groupby(calendar_day).transform('mean').to_numpy().T
+            data[:, :, features.index(ANOMALY_FEATURE)] = np.round(temp - normal, 2)
+
+        return cls(data, stations, first_day, features)
+
+    def digest(self):
+        """SHA-256 of the stations, days, features and values; changes whenever any weather does."""
+        h = hashlib.sha256()
+        h.update(json.dumps([self.stations.tolist(), self.first_day, self.features]).encode('utf-8'))
+        h.update(np.ascontiguousarray(self.data, dtype=STORE_DTYPE).tobytes())
+        return h.hexdigest()
+
+    def save(self, store_file=STORE_FILE, index_file=STORE_INDEX_FILE):
+        with open(store_file + '.tmp', 'wb') as f:
+            f.write(np.ascontiguousarray(self.data, dtype=STORE_DTYPE).tobytes())
+        os.replace(store_file + '.tmp', store_file)
+
+        with open(index_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                "stations": self.stations.tolist(),
+                "first_day": self.first_day,
+                "first_date": str(np.datetime64(self.first_day, 'D')),
+                "n_days": self.n_days,
+                "features": self.features,
+                "dtype": STORE_DTYPE
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, store_file=STORE_FILE, index_file=STORE_INDEX_FILE):
+        """Opens a saved store as a read-only memory map, or returns None."""
+        if not (os.path.exists(store_file) and os.path.exists(index_file)):
+            return None
+        with open(index_file, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        shape = (len(index['stations']), index['n_days'], len(index['features']))
+        data = np.memmap(store_file, dtype=index['dtype'], mode='r', shape=shape)
+        return cls(data, index['stations'], index['first_day'], index['features'])
+
+    def lookup(self, stations, days, features=None):
+        """
+        Weather of (station, day) pairs as a DataFrame with one row per pair
+        and one column per feature. Unknown stations or days give NaN.
+        """
+        features = list(features or self.features)
+        feature_idx = [self.features.index(f) for f in features]
+        stations = np.asarray(stations, dtype=np.int64)
+        days = np.asarray(days, dtype=np.int64)
+
+        rows = np.searchsorted(self.stations, stations).clip(max=len(self.stations) - 1)
+        offsets = days - self.first_day
+        valid = (self.stations[rows] == stations) & (offsets >= 0) & (offsets < self.n_days)
+
+        values = np.full((len(days), len(features)), np.nan)
+        values[valid] = self.data[rows[valid], offsets[valid]][:, feature_idx]
+        return pd.DataFrame(values, columns=features)